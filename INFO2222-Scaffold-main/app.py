@@ -2,70 +2,159 @@
 app.py contains all of the server application
 this is where you'll find all of the get/post request handlers
 the socket event handlers are inside of socket_routes.py
+create_app() builds the Flask app, binds Socket.IO and the session store to it and points db at
+its database, the default `app` is only built the first time something asks for it,
+so importing this module (from a script or a test) does not touch the disk
+Socket.IO and the socket state are per process, so there should be one app per process
 '''
 
-from flask import Flask, jsonify, render_template, request, abort, url_for ,redirect, session
-from flask_socketio import SocketIO
+from flask import Blueprint, Flask, jsonify, render_template, request, abort, url_for ,redirect, session
 from datetime import datetime
+from typing import Optional
+import logging
+import logging_setup
+
 import db
+import json_codec
+import metrics
+import query_stats
+import tracing
+import profiler
+import memwatch
 import secrets
 import os
-from bcrypt import gensalt, hashpw, checkpw
+import threading
+import time
 from functools import wraps
 from sqlalchemy.orm import aliased
-from bleach import clean
 from sqlalchemy.orm import Session
-from models import  User, Friendship,GroupChat,GroupMessage,GroupUser
-from db import engine
+from models import  User, Friendship,GroupChat,GroupMessage,GroupUser,RequestStatus,GROUP_ROOM_OFFSET
+
+# don't remove this!! it registers the socket event handlers
+import socket_routes
+from socket_routes import socketio
+from ratelimit import limiter, limit_route, parse_limits
 
-# import logging
+logger = logging.getLogger(__name__)
 
 # this turns off Flask Logging, uncomment this to turn off Logging
 # log = logging.getLogger('werkzeug')
 # log.setLevel(logging.ERROR)
 
-app = Flask(__name__,static_folder='static')
-
-# secret key used to sign the session cookie
-app.config['SECRET_KEY'] = secrets.token_hex()
-socketio = SocketIO(app)
+# every route below, registered on the app by create_app
+routes = Blueprint("chat", __name__)
+
+# the engine db creates on first use is instrumented then
+db.on_engine(metrics.instrument_engine)
+db.on_engine(query_stats.instrument_engine)
+db.on_engine(tracing.instrument_engine)
+# get_engine runs inside every db call, a span for it would only be noise
+tracing.instrument_module(db, skip=("get_engine",))
+
+# builds an app, config overrides the defaults set here, e.g.
+#     create_app({"DATABASE_URL": "sqlite://", "TESTING": True})
+# for a test with its own in-memory database
+def create_app(config: Optional[dict] = None) -> Flask:
+    logging_setup.setup_logging()
+
+    app = Flask(__name__,static_folder='static')
+    # routes and socket packets share the orjson backed codec
+    app.json = json_codec.FastJSONProvider(app)
+
+    # secret key used to sign the session cookie
+    app.config['SECRET_KEY'] = secrets.token_hex()
+    app.config['DATABASE_URL'] = os.environ.get("DATABASE_URL", db.DATABASE_URL)
+    # overrides of ratelimit.LIMITS, e.g. "send.sid=10/20,login=off", or "off" for no limits at all
+    app.config['RATE_LIMITS'] = os.environ.get("RATE_LIMITS", "")
+
+    # clients connect straight over websocket, long-polling is only kept as a fallback
+    # SOCKETIO_TRANSPORTS=websocket turns it off completely
+    app.config['SOCKETIO_TRANSPORTS'] = os.environ.get("SOCKETIO_TRANSPORTS", "websocket,polling").split(",")
+    # a dead socket is noticed within interval + timeout seconds
+    app.config['SOCKETIO_PING_INTERVAL'] = int(os.environ.get("SOCKETIO_PING_INTERVAL", 20))
+    app.config['SOCKETIO_PING_TIMEOUT'] = int(os.environ.get("SOCKETIO_PING_TIMEOUT", 10))
+
+    # Flask application configuration
+    app.config['SESSION_TYPE'] = 'filesystem'  # session store in session_files
+    app.config['SESSION_FILE_DIR'] = 'session_files'  
+    app.config['SESSION_PERMANENT'] = False  
+    # app.config['SESSION_USE_SIGNER'] = True  # signature of session
+    # app.config['SESSION_COOKIE_SECURE'] = True  # can only send cookie in HTTPS 
+    # app.config['SESSION_COOKIE_HTTPONLY'] = True  # JavaScript cannot visit cookie
+    # app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # CSRF Protection
+
+    app.config.update(config or {})
+
+    app.jinja_env.globals['socketio_polling_fallback'] = "polling" in app.config['SOCKETIO_TRANSPORTS']
+
+    limiter.configure(parse_limits(app.config['RATE_LIMITS']))
+
+    # the engine itself is only created by the first query, a new one for every app
+    db.configure(app.config['DATABASE_URL'])
+
+    metrics.instrument_app(app)
+    query_stats.instrument_app(app)
+    tracing.instrument_app(app)
+    app.register_blueprint(routes)
+
+    # there is one Socket.IO server per process, with the presence, rooms and caches of
+    # socket_routes behind it, so run one app per process: a second create_app() takes it
+    # over and the previous app stops getting socket events
+    if socketio.server is not None:
+        logger.warning("Socket.IO is moved to a new app, only one app per process gets socket events")
+        # the cached history belongs to the previous app's database
+        socket_routes.message_cache.clear()
+    socketio.init_app(app, json=json_codec,
+                      transports=app.config['SOCKETIO_TRANSPORTS'],
+                      ping_interval=app.config['SOCKETIO_PING_INTERVAL'],
+                      ping_timeout=app.config['SOCKETIO_PING_TIMEOUT'])
+    # eventlet and gevent run every request as a greenlet of this thread, the profiler sees them from here on
+    if socketio.async_mode in ("eventlet", "gevent", "gevent_uwsgi"):
+        profiler.track_greenlets()
+
+    from flask_session import Session  #Session
+    Session(app)  
+    # session files only go away on logout, or once flask-session prunes them past its threshold
+    memwatch.watch("session_files", lambda: len(os.listdir(app.config['SESSION_FILE_DIR'])))
+
+    return app
+
+
+# the app of `python app.py`, of WSGI servers pointed at app:app and of scripts doing `app.app`,
+# built on first access
+default_app: Optional[Flask] = None
+default_app_lock = threading.Lock()
+
+def __getattr__(name: str):
+    global default_app
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with default_app_lock:
+        if default_app is None:
+            default_app = create_app()
+    return default_app
 
-from flask_session import Session  #Session
-# Flask application configuration
-app.config['SESSION_TYPE'] = 'filesystem'  # session store in session_files
-app.config['SESSION_FILE_DIR'] = 'session_files'  
-app.config['SESSION_PERMANENT'] = False  
-# app.config['SESSION_USE_SIGNER'] = True  # signature of session
-# app.config['SESSION_COOKIE_SECURE'] = True  # can only send cookie in HTTPS 
-# app.config['SESSION_COOKIE_HTTPONLY'] = True  # JavaScript cannot visit cookie
-# app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # CSRF Protection
-
-Session(app)  
-
-
-# don't remove this!!
-import socket_routes
 
 # index page
-@app.route("/")
+@routes.route("/")
 def index():
     return render_template("index.jinja")
 
 # login page
-@app.route("/login")
+@routes.route("/login")
 def login():    
-    print("Hi?")
     return render_template("login.jinja")
 
-@app.route('/logout')
+@routes.route('/logout')
 def logout():
     # clear the session
     session.clear()
     # redirect to the index page
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
 # handles a post request when the user clicks the log in button
-@app.route("/login/user", methods=["POST"])
+@routes.route("/login/user", methods=["POST"])
+@limit_route("login")
 def login_user():
     if not request.is_json:
         abort(404)
@@ -82,41 +171,43 @@ def login_user():
 
     if password != user.password:
         return "Error: Password does not match!🤡"
-    print("Hi1?")
     # after successful user login authentication
     session['username'] = username   # store user name into session 
-    print("Hi2?")
+    logger.info("user logged in", extra={"username": username})
 
-    return url_for('home', username=request.json.get("username"))
+    return url_for('.home', username=request.json.get("username"))
 
 # handles a get request to the signup page
-@app.route("/signup")
+@routes.route("/signup")
 def signup():
     return render_template("signup.jinja")
 
 # handles a post request when the user clicks the signup button
-@app.route("/signup/user", methods=["POST"])
+@routes.route("/signup/user", methods=["POST"])
+@limit_route("signup")
 def signup_user():
     if not request.is_json:
         abort(404)
+    # bleach is only needed here, importing it at the top made every boot slower
+    from bleach import clean
     username = clean(request.json.get("username"))
     password = request.json.get("password")
 
     if db.get_user(username) is None:
         db.insert_user(username, password)  
         session['username'] = username 
-        return url_for('home', username=username)
+        return url_for('.home', username=username)
 
     return "Error: User already exists!"
 
 
 # handler when a "404" error happens
-@app.errorhandler(404)
+@routes.app_errorhandler(404)
 def page_not_found(_):
     return render_template('404.jinja'), 404
 
 # home page, where the messaging app is
-@app.route("/home")
+@routes.route("/home")
 def home():
     if request.args.get("username") is None:
         abort(404)
@@ -129,30 +220,30 @@ def home():
     return render_template("home.jinja", username=request.args.get("username"))
 
 
-@app.route('/knowledge')
+@routes.route('/knowledge')
 def show_knowledge():
     username = session.get('username')
     if not username:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     user = db.get_user(username)
     if not user:
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     
     articles = db.get_all_articles()
     can_delete_comments = user.role in ['admin', 'staff']
     return render_template('knowledge.jinja', username=username, articles=articles, can_delete_comments=can_delete_comments)
 
 
-@app.route('/knowledge/new_article')
+@routes.route('/knowledge/new_article')
 def new_article_form():
     username = session.get('username') 
     if not username:
 
-        return redirect(url_for('login'))
+        return redirect(url_for('.login'))
     return render_template('new_article.jinja', username=username)
 
-@app.route("/knowledge/new_article", methods=["POST"])
+@routes.route("/knowledge/new_article", methods=["POST"])
 def submit_article():
     if 'username' not in session:
         abort(403) 
@@ -173,14 +264,14 @@ def submit_article():
     return jsonify({"success": True})
 
 
-@app.route('/article/<int:article_id>')
+@routes.route('/article/<int:article_id>')
 def article_detail(article_id):
     article = db.get_article_by_id(article_id)
     if article is None:
         abort(404)  
     return render_template('article_detail.jinja', article=article)
 
-@app.route('/api/article/<int:article_id>')
+@routes.route('/api/article/<int:article_id>')
 def api_article_detail(article_id):
     article = db.get_article_by_id(article_id)
     if article is None:
@@ -195,7 +286,7 @@ def api_article_detail(article_id):
     })
 
 
-@app.route('/api/articles')
+@routes.route('/api/articles')
 def api_articles_list():
     articles = db.get_all_articles() 
     articles_data = [{
@@ -204,7 +295,7 @@ def api_articles_list():
     } for article in articles]
     return jsonify(articles_data)
 
-@app.route("/api/delete_article/<article_id>", methods=["POST"])
+@routes.route("/api/delete_article/<article_id>", methods=["POST"])
 def delete_article(article_id):
     if 'username' not in session:
         abort(403)
@@ -217,7 +308,7 @@ def delete_article(article_id):
     return jsonify({"success": True})
 
 
-@app.route("/api/edit_article/<int:article_id>", methods=["POST"])
+@routes.route("/api/edit_article/<int:article_id>", methods=["POST"])
 def edit_article(article_id):
     if 'username' not in session:
         abort(403)
@@ -242,7 +333,7 @@ def edit_article(article_id):
 
 
 
-@app.route("/api/add_comment", methods=["POST"])
+@routes.route("/api/add_comment", methods=["POST"])
 def add_comment():
     if 'username' not in session:
         abort(403)
@@ -259,7 +350,7 @@ def add_comment():
     return jsonify({"success": True, "comment_id": comment_id})
 
 
-@app.route('/api/comments/<int:article_id>')
+@routes.route('/api/comments/<int:article_id>')
 def get_comments(article_id):
     comments = db.get_comments_by_article_id(article_id)
     comments_data = []
@@ -270,13 +361,13 @@ def get_comments(article_id):
             'commenter': comment.commenter,
             'commenter_role': commenter.role,  
             'content': comment.content,
-            'comment_date': comment.comment_date.strftime("%Y-%m-%d %H:%M:%S")
+            'comment_date': comment.comment_date
         })
     return jsonify(comments_data)
 
 
 
-@app.route("/api/get_user_status", methods=["GET"])
+@routes.route("/api/get_user_status", methods=["GET"])
 def get_user_status():
     if 'username' not in session:
         return jsonify({"is_muted": True})
@@ -288,7 +379,7 @@ def get_user_status():
     else:
         return jsonify({"is_muted": True})
 
-@app.route("/api/delete_comment/<int:comment_id>", methods=["POST"])
+@routes.route("/api/delete_comment/<int:comment_id>", methods=["POST"])
 def delete_comment(comment_id):
     if 'username' not in session:
         abort(403)
@@ -305,8 +396,8 @@ def delete_comment(comment_id):
                     return jsonify({"error": "Permission denied"}), 403
             else:
                 return jsonify({"error": "Comment not found"}), 404
-        except Exception as e:
-            print(f"Error deleting comment: {e}")
+        except Exception:
+            logger.exception("error deleting comment", extra={"comment_id": comment_id})
             return jsonify({"error": "An error occurred"}), 500
     else:
         abort(403)
@@ -316,7 +407,8 @@ def delete_comment(comment_id):
 #============================================================================
 # FRIEND
 
-@app.route("/send_friend_request", methods=["POST"])
+@routes.route("/send_friend_request", methods=["POST"])
+@limit_route("send_friend_request")
 def send_request():
     if 'username' not in session:
         return jsonify({"error": "Authentication required"}), 401
@@ -335,14 +427,24 @@ def send_request():
 
     result = db.send_friend_request(sender, receiver)
     if result:
-        print("Emitting friend_request_update event")
-        socketio.emit('friend_request_update', {'message': 'Update your friend requests list'})
-        print("done")
+        friend_request = db.find_pending_friend_request(sender, receiver)
+        if friend_request:
+            socket_routes.notify_users('friend_request_update',
+                                       {'action': 'added', 'request': friend_request_data(friend_request)},
+                                       sender, receiver)
         return jsonify({"message": "Friend request sent successfully"})
     else:
         return jsonify({"error": "An error occurred while processing your request"}), 400
     
-@app.route('/get_friend_requests')
+def friend_request_data(fr):
+    return {
+        "id": fr.id,
+        "sender": fr.sender_id,
+        "receiver": fr.receiver_id,
+        "status": fr.status
+    }
+
+@routes.route('/get_friend_requests')
 def get_friend_requests():
     current_user = request.args.get('username')
     if not current_user:
@@ -350,19 +452,13 @@ def get_friend_requests():
     
     try:
         friend_requests = db.get_friend_requests_for_user(current_user)
-        return jsonify([{
-            "id": fr.id,
-            "sender": fr.sender_id,
-            "receiver": fr.receiver_id,
-            "status": fr.status
-        } for fr in friend_requests])
+        return jsonify([friend_request_data(fr) for fr in friend_requests])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route("/update_friend_request", methods=["POST"])
+@routes.route("/update_friend_request", methods=["POST"])
 def update_friend_request():
     data = request.get_json()
-    print(data)
     if not data or 'request_id' not in data or 'status' not in data:
         return jsonify({"error": "Invalid data"}), 400
     
@@ -370,30 +466,182 @@ def update_friend_request():
     new_status = data['status']
     
     try:
+        friend_request = db.get_friend_request(request_id)
         result = db.update_friend_request_status(request_id, new_status)
-        print("Update successful") 
-        socketio.emit('friend_request_update', {'message': 'Update your friend requests list'})
+        if friend_request:
+            sender, receiver = friend_request.sender_id, friend_request.receiver_id
+            # the request leaves both pending lists whatever the new status is
+            socket_routes.notify_users('friend_request_update',
+                                       {'action': 'removed', 'request': {'id': friend_request.id}},
+                                       sender, receiver)
+            if result[0] and new_status == RequestStatus.APPROVED.value:
+                socket_routes.notify_users('update_friend_list',
+                                           {'action': 'added', 'friend': friend_entry(receiver)}, sender)
+                socket_routes.notify_users('update_friend_list',
+                                           {'action': 'added', 'friend': friend_entry(sender)}, receiver)
         return jsonify({"message": "Friend request updated successfully."})
     except Exception as e:
-        print(f"Error: {e}") 
+        logger.exception("error updating friend request", extra={"request_id": request_id})
         return jsonify({"error": str(e)}), 500
 
-@app.route("/get_friends")
+# friend list entry with the live online flag, user_online is only written in batches
+def friend_entry(username):
+    friend = db.get_friend_entry(username)
+    if friend:
+        friend['is_online'] = socket_routes.presence.is_online(username)
+    return friend
+
+@routes.route("/get_friends")
+@limit_route("get_friends")
 def get_friends():
     username = request.args.get("username")
-    user = db.get_online_user(username)
-    #user.set_online(True)
-    print(username)
-    print(user.get_online())
-    print(3333333333333333333333333333333333333333333333333)
     if not username:
         return jsonify({"error": "Missing username"}), 400
 
     friends = db.get_friends_for_user(username)
+    rooms = db.get_rooms_for_user(username)
+    unread = socket_routes.read_cursors.unread_counts(username, list(rooms.values()))
+    for friend in friends:
+        friend['is_online'] = socket_routes.presence.is_online(friend['username'])
+        friend['unread'] = unread.get(rooms.get(friend['username']), 0)
     return jsonify(friends)
 
 
-@app.route("/get_role/<username>", methods=["GET"])
+# the user's conversations, most recently active first, read from conversation_summary
+@routes.route("/get_conversations")
+@limit_route("get_conversations")
+def get_conversations():
+    if 'username' not in session:
+        return jsonify({"error": "Authentication required"}), 401
+
+    username = session['username']
+    page = max(request.args.get("page", 0, type=int), 0)
+    per_page = min(max(request.args.get("per_page", 20, type=int), 1), 100)
+
+    summaries, has_more = db.get_conversation_summaries(username, page, per_page)
+    return jsonify({
+        "conversations": [{
+            "room_id": summary.room_id,
+            "title": summary.title,
+            "is_group": summary.is_group,
+            "last_message_id": summary.last_message_id,
+            "last_sender": summary.last_sender,
+            "snippet": summary.snippet,
+            "last_at": summary.last_at,
+            "unread": 0 if socket_routes.read_cursors.covers(username, summary.room_id, summary.last_message_id)
+                      else summary.unread_count
+        } for summary in summaries],
+        "page": page,
+        "has_more": has_more
+    })
+
+
+# only lets logged in admins through, everyone else gets a 403
+def admin_required(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if 'username' not in session:
+            abort(403)
+        current_user = db.get_user(session['username'])
+        if current_user is None or current_user.role != 'admin':
+            abort(403)
+        return f(*args, **kwargs)
+    return wrapper
+
+# how many calls each rate limit let through and turned away
+@routes.route("/admin/rate_limits", methods=["GET"])
+@admin_required
+def rate_limits():
+    return jsonify(limiter.stats())
+
+# everything in metrics.registry, in the Prometheus text format
+@routes.route("/metrics", methods=["GET"])
+@admin_required
+def prometheus_metrics():
+    return metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# outbound queue sizes, drops and disconnects of slow sockets
+@routes.route("/admin/outbound", methods=["GET"])
+@admin_required
+def outbound_stats():
+    return jsonify(socket_routes.outbound.stats())
+
+# the slowest recent requests and socket events, with their span trees
+@routes.route("/admin/traces", methods=["GET"])
+@admin_required
+def slowest_traces():
+    traces = [(trace, tracing.span_tree(trace)) for trace in tracing.slowest_traces()]
+    return render_template("admin_traces.jinja", traces=traces, ring_size=tracing.TRACE_RING_SIZE,
+                           username=session["username"])
+
+# starts sampling every thread for ?seconds= (default 5, at most 60) every ?interval_ms= (default 10)
+# on a background thread, GET /admin/profile downloads the result once it is done
+@routes.route("/admin/profile", methods=["POST"])
+@admin_required
+def start_profile():
+    try:
+        seconds = float(request.args.get("seconds", profiler.DEFAULT_SECONDS))
+        interval = float(request.args.get("interval_ms", profiler.DEFAULT_INTERVAL * 1000)) / 1000
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    if not seconds > 0 or not interval > 0:
+        return jsonify({"error": "seconds and interval_ms must be positive"}), 400
+    if not profiler.start(seconds, interval):
+        return jsonify({"error": "A profile is already being taken"}), 409
+    return jsonify({"running": True, "seconds": min(seconds, profiler.MAX_SECONDS)}), 202
+
+# the last finished profile as a download, ?format=speedscope for speedscope JSON, collapsed stacks otherwise
+# 202 while one is still being taken
+@routes.route("/admin/profile", methods=["GET"])
+@admin_required
+def profile():
+    output = request.args.get("format", "collapsed")
+    if output not in ("collapsed", "speedscope"):
+        return jsonify({"error": "format must be collapsed or speedscope"}), 400
+    if profiler.running.locked():
+        return jsonify({"running": True}), 202
+    result = profiler.latest
+    if result is None:
+        return jsonify({"error": "No profile taken yet, POST /admin/profile starts one"}), 404
+
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(result.started))
+    if output == "speedscope":
+        return json_codec.dumps(result.speedscope()), 200, {
+            "Content-Type": "application/json",
+            "Content-Disposition": f"attachment; filename=profile-{stamp}.speedscope.json"}
+    return result.collapsed(), 200, {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Content-Disposition": f"attachment; filename=profile-{stamp}.collapsed.txt"}
+
+# makes the current memory the baseline of a soak test, starting tracemalloc if it is not running
+@routes.route("/admin/memory/baseline", methods=["POST"])
+@admin_required
+def memory_baseline():
+    return jsonify(memwatch.start())
+
+# memory against the baseline, with the ?top= (default 20) allocation sites that grew the most
+# ?group=traceback groups whole call chains instead of single lines
+@routes.route("/admin/memory", methods=["GET"])
+@admin_required
+def memory():
+    try:
+        top = int(request.args.get("top", memwatch.TOP))
+    except ValueError:
+        return jsonify({"error": "top must be a number"}), 400
+    group = request.args.get("group", "lineno")
+    if group not in ("lineno", "traceback"):
+        return jsonify({"error": "group must be lineno or traceback"}), 400
+    return jsonify(memwatch.report(max(top, 0), group))
+
+# stops tracemalloc, which slows every allocation down while it runs
+@routes.route("/admin/memory/stop", methods=["POST"])
+@admin_required
+def memory_stop():
+    memwatch.stop()
+    return jsonify({"tracing": False})
+
+
+@routes.route("/get_role/<username>", methods=["GET"])
 def get_role(username):
     user = db.get_user(username)
     if user:
@@ -401,7 +649,7 @@ def get_role(username):
     else:
         return {"error": "User not found"}, 404
 
-@app.route("/get_all_users", methods=["GET"])
+@routes.route("/get_all_users", methods=["GET"])
 def get_all_users():
     if 'username' not in session:
         abort(403)
@@ -413,7 +661,7 @@ def get_all_users():
     else:
         abort(403)
 
-@app.route("/settings", methods=["GET"])
+@routes.route("/settings", methods=["GET"])
 def settings():
     if 'username' not in session:
         abort(403)
@@ -430,7 +678,7 @@ def settings():
     else:
         return "Error: User not found", 404
 
-@app.route("/toggle_mute/<username>", methods=["POST"])
+@routes.route("/toggle_mute/<username>", methods=["POST"])
 def toggle_mute(username):
     if 'username' not in session:
         abort(403)
@@ -453,7 +701,7 @@ def toggle_mute(username):
 
 
 
-@app.route("/toggle_role/<username>", methods=["POST"])
+@routes.route("/toggle_role/<username>", methods=["POST"])
 def toggle_role(username):
     if 'username' not in session:
         abort(403)
@@ -480,7 +728,7 @@ def is_user_muted(username):
 
 
 #################################################################################
-@app.route('/remove_friend', methods=['POST'])
+@routes.route('/remove_friend', methods=['POST'])
 def remove_friend():
     if 'username' not in session:
         return jsonify({"error": "User not logged in"}), 401
@@ -491,24 +739,24 @@ def remove_friend():
 
     user_username = session['username']
     friend_username = data['friend_username']
-    print(f"Removing friend: {friend_username} for user: {user_username}")
-
     if db.db_remove_friend(user_username, friend_username):
-        print("Friend removed successfully")
+        logger.info("friend removed", extra={"username": user_username, "friend": friend_username})
         # Emit update event to both users
-        socketio.emit('update_friend_list', {'message': 'Friend list updated'})
-        socketio.emit('update_friend_list', {'message': 'Friend list updated'})
+        socket_routes.notify_users('update_friend_list',
+                                   {'action': 'removed', 'friend': {'username': friend_username}}, user_username)
+        socket_routes.notify_users('update_friend_list',
+                                   {'action': 'removed', 'friend': {'username': user_username}}, friend_username)
         #socketio.emit('friend_removed', {'message': 'You have been removed as a friend by ' + user_username})
-        print(f"Emitted update_friend_list and friend_removed event to {user_username} and {friend_username}")
         return jsonify({"message": "Friend removed successfully"})
     else:
-        print("Failed to remove friend")
+        logger.warning("failed to remove friend", extra={"username": user_username, "friend": friend_username})
         return jsonify({"error": "Friend could not be removed"}), 400
     
 ##############################################################################
 # group chat
 ##############################################################################
-@app.route('/create_group', methods=['POST'])
+@routes.route('/create_group', methods=['POST'])
+@limit_route("create_group")
 def create_group_route():
     data = request.get_json()
     group_name = data.get('name')
@@ -520,9 +768,15 @@ def create_group_route():
     result = db.create_group(group_name, creator_username,usernames)
     if "error" in result:
         return jsonify(result), 400
+
+    group = {"id": result["group_id"], "name": group_name}
+    socket_routes.notify_users('group_update', {'action': 'added', 'group': {**group, "is_owner": True}},
+                               creator_username)
+    socket_routes.notify_users('group_update', {'action': 'added', 'group': {**group, "is_owner": False}},
+                               *[username for username in usernames if username != creator_username])
     return jsonify(result)
 
-@app.route('/join_group', methods=['POST'])
+@routes.route('/join_group', methods=['POST'])
 def join_group():
     data = request.get_json()
     group_id = data.get('group_id')
@@ -531,24 +785,32 @@ def join_group():
     if not group_id or not username:
         return jsonify({"error": "Group ID and username are required"}), 400
 
-    with Session(engine) as session:
-        group_user = GroupUser(group_id=group_id, username=username)
-        session.add(group_user)
-        session.commit()
+    group = db.get_group(group_id)
+    if group is None:
+        return jsonify({"error": "Group does not exist"}), 404
+
+    db.add_group_user(group_id, username)
+    socket_routes.notify_users('group_update',
+                               {'action': 'added', 'group': {"id": group.id, "name": group.name, "is_owner": False}},
+                               username)
     
     return jsonify({"message": "Joined group successfully"})
 
-@app.route('/get_groups', methods=['GET'])
+@routes.route('/get_groups', methods=['GET'])
+@limit_route("get_groups")
 def get_groups_route():
     username = request.args.get('username')
     if not username:
         return jsonify({"error": "Username is required"}), 400
 
     groups = db.get_groups_for_user(username)
-    print(groups)
+    unread = socket_routes.read_cursors.unread_counts(
+        username, [group["id"] + GROUP_ROOM_OFFSET for group in groups])
+    for group in groups:
+        group["unread"] = unread.get(group["id"] + GROUP_ROOM_OFFSET, 0)
     return jsonify(groups)
 
-@app.route("/add_member_to_group", methods=["POST"])
+@routes.route("/add_member_to_group", methods=["POST"])
 def add_member_to_group_route():
     data = request.get_json()
     group_id = data.get('group_id')
@@ -559,9 +821,14 @@ def add_member_to_group_route():
     result = db.add_member_to_group(group_id, owner_username, new_member_username)
     if 'error' in result:
         return jsonify(result), 400
+
+    group = db.get_group(group_id)
+    socket_routes.notify_users('group_update',
+                               {'action': 'added', 'group': {"id": group.id, "name": group.name, "is_owner": False}},
+                               new_member_username)
     return jsonify(result)
 
-@app.route("/remove_member_from_group", methods=["POST"])
+@routes.route("/remove_member_from_group", methods=["POST"])
 def remove_member_from_group_route():
     data = request.get_json()
     group_id = data.get('group_id')
@@ -572,6 +839,9 @@ def remove_member_from_group_route():
     result = db.remove_member_from_group(group_id, owner_username, remove_member_username)
     if 'error' in result:
         return jsonify(result), 400
+
+    socket_routes.notify_users('group_update', {'action': 'removed', 'group': {"id": group_id}},
+                               remove_member_username)
     return jsonify(result)
 
 #######################################################
@@ -588,8 +858,8 @@ if __name__ == '__main__':
     # db.print_table_names()
     # db.drop_all_tables("sqlite:///database/main.db")
 
-    #socketio.run(app, host='0.0.0.0', port=8999, debug=True, ssl_context=('./certs/server.crt', './certs/server.key'))
-    socketio.run(app, host='0.0.0.0', port=8998, debug=True)
+    #socketio.run(create_app(), host='0.0.0.0', port=8999, debug=True, ssl_context=('./certs/server.crt', './certs/server.key'))
+    socketio.run(create_app(), host='0.0.0.0', port=8998, debug=True)
     # db.print_all_users()
     # print(db.get_messages_by_room_id(4))
     # print(db.get_messages_by_room_id(4))
\ No newline at end of file
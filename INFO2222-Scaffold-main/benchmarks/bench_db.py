@@ -0,0 +1,394 @@
+'''
+bench_db
+times the read functions of db.py on generated databases of increasing size,
+so a query that scales badly shows up before it meets a big main.db
+
+the databases are generated from a seed, so every run at a scale sees the same data,
+and cached in --data-dir (the generator version is part of the name, change it when
+the generated data changes)
+
+run from the project folder with
+    python benchmarks/bench_db.py [--scales tiny,small,large] [--repeat 20] [--output results.json]
+the JSON report goes to --output, or stdout, a summary table to stderr
+'''
+
+from datetime import datetime, timedelta
+from itertools import accumulate
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT)
+
+from sqlalchemy import create_engine, event, insert
+import sqlalchemy
+
+# bump when generate() changes, cached databases of older versions are then regenerated
+DATA_VERSION = 1
+
+# friendships are pairs, each stored as two rows like add_friend does
+SCALES: Dict[str, Dict[str, int]] = {
+    "tiny":  {"users": 100,    "friendships": 500,     "messages": 5_000,     "group_messages": 1_000,
+              "groups": 20,    "articles": 10,         "comments": 200},
+    "small": {"users": 1_000,  "friendships": 10_000,  "messages": 100_000,   "group_messages": 25_000,
+              "groups": 500,   "articles": 100,        "comments": 5_000},
+    "large": {"users": 10_000, "friendships": 100_000, "messages": 1_000_000, "group_messages": 250_000,
+              "groups": 5_000, "articles": 1_000,      "comments": 50_000},
+}
+DEFAULT_SCALES = "tiny,small"
+# how many different users, rooms, groups... each function is called with
+PROBES = 20
+PAGE_SIZE = 50
+CHUNK = 50_000
+WORDS = ("hey", "are", "you", "coming", "to", "the", "lecture", "today", "I", "think", "so", "what", "about",
+         "assignment", "due", "friday", "lol", "yes", "no", "maybe", "see", "later", "ok", "thanks")
+
+
+##############################################################################
+# data
+##############################################################################
+
+def sentence(rng: random.Random, low: int = 2, high: int = 16) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+# zipf-like weights, a few busy conversations and a long quiet tail like a real chat
+def skewed(count: int) -> list:
+    return list(accumulate(1 / (rank + 1) ** 0.8 for rank in range(count)))
+
+def insert_chunked(connection, table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == CHUNK:
+            connection.execute(insert(table), batch)
+            batch = []
+    if batch:
+        connection.execute(insert(table), batch)
+
+
+def generate(path: str, sizes: Dict[str, int], seed: int):
+    from models import (Base, User, UserOnline, Friendship, FriendRequest, RoomInfo, Message, GroupChat,
+                        GroupUser, GroupMessage, ConversationCounter, ConversationSummary, ReadCursor,
+                        Article, Comment, GROUP_ROOM_OFFSET)
+    rng = random.Random(seed)
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    start = datetime(2024, 1, 1)
+
+    users = [f"user{i:05d}" for i in range(sizes["users"])]
+    pairs = set()
+    wanted = min(sizes["friendships"], len(users) * (len(users) - 1) // 2)
+    while len(pairs) < wanted:
+        a, b = rng.sample(users, 2)
+        pairs.add((min(a, b), max(a, b)))
+    pairs = sorted(pairs)
+    rng.shuffle(pairs)
+    # direct message room ids stay below the group offset, so only that many pairs have talked
+    rooms = pairs[:GROUP_ROOM_OFFSET - 1]
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        connection.execute(insert(User.__table__), [
+            {"username": username, "password": "x", "role": "staff" if i % 20 == 0 else "student", "is_muted": False}
+            for i, username in enumerate(users)])
+        connection.execute(insert(UserOnline.__table__), [
+            {"username": username, "is_online": rng.random() < 0.1} for username in users])
+        insert_chunked(connection, Friendship.__table__, (
+            {"user_username": a, "friend_username": b} for pair in pairs for a, b in (pair, pair[::-1])))
+        connection.execute(insert(FriendRequest.__table__), [
+            {"sender_id": a, "receiver_id": b, "status": "pending"}
+            for a, b in (rng.sample(users, 2) for _ in range(len(users)))])
+        connection.execute(insert(RoomInfo.__table__), [
+            {"room_id": room_id, "user_a": a, "user_b": b} for room_id, (a, b) in enumerate(rooms, 1)])
+
+        # (room id, members) of every conversation, direct rooms first, then groups
+        conversations = [(room_id, [a, b]) for room_id, (a, b) in enumerate(rooms, 1)]
+        groups = []
+        for group_id in range(1, sizes["groups"] + 1):
+            groups.append((group_id, rng.sample(users, min(len(users), rng.randint(3, 12)))))
+        connection.execute(insert(GroupChat.__table__), [
+            {"id": group_id, "name": f"group {group_id}", "created_at": start} for group_id, _ in groups])
+        connection.execute(insert(GroupUser.__table__), [
+            {"group_id": group_id, "username": username, "joined_at": start, "is_owner": i == 0}
+            for group_id, members in groups for i, username in enumerate(members)])
+
+        # room id -> [message count, last message id, last sender, last content, last time]
+        last = {}
+        def messages(count: int, targets: list, group: bool):
+            weights = skewed(len(targets))
+            for number in range(1, count + 1):
+                room_id, members = rng.choices(targets, cum_weights=weights)[0]
+                key = room_id + GROUP_ROOM_OFFSET if group else room_id
+                entry = last.setdefault(key, [0, 0, None, None, None])
+                entry[0] += 1
+                sender, content = rng.choice(members), sentence(rng)
+                when = start + timedelta(seconds=number * 30)
+                entry[1:] = [number, sender, content, when]
+                row = {"id": number, "seq": entry[0], "sender": sender, "content": content}
+                if group:
+                    row.update(group_id=room_id, timestamp=when)
+                else:
+                    row.update(room_id=room_id)
+                yield row
+        if conversations:
+            insert_chunked(connection, Message.__table__, messages(sizes["messages"], conversations, False))
+        if groups:
+            insert_chunked(connection, GroupMessage.__table__, messages(sizes["group_messages"], groups, True))
+
+        connection.execute(insert(ConversationCounter.__table__), [
+            {"room_id": key, "message_count": entry[0], "last_message_id": entry[1]} for key, entry in last.items()])
+        summaries, cursors = [], []
+        for key, members, title in [(room_id, members, None) for room_id, members in conversations] + \
+                                   [(group_id + GROUP_ROOM_OFFSET, members, f"group {group_id}") for group_id, members in groups]:
+            entry = last.get(key, [0, 0, None, None, None])
+            for username in members:
+                summaries.append({
+                    "username": username, "room_id": key, "is_group": title is not None,
+                    "title": title or next(member for member in members if member != username),
+                    "last_message_id": entry[1], "last_sender": entry[2], "snippet": (entry[3] or "")[:80],
+                    "last_at": entry[4], "unread_count": rng.randint(0, entry[0]) if entry[0] else 0})
+            # the first member has read everything
+            cursors.append({"username": members[0], "room_id": key, "last_message_id": entry[1], "read_count": entry[0]})
+        insert_chunked(connection, ConversationSummary.__table__, summaries)
+        insert_chunked(connection, ReadCursor.__table__, cursors)
+
+        connection.execute(insert(Article.__table__), [
+            {"id": article_id, "title": sentence(rng, 2, 6), "content": sentence(rng, 50, 200),
+             "author": rng.choice(users), "publish_date": start + timedelta(days=article_id)}
+            for article_id in range(1, sizes["articles"] + 1)])
+        if sizes["articles"]:
+            insert_chunked(connection, Comment.__table__, (
+                {"article_id": rng.randint(1, sizes["articles"]), "commenter": rng.choice(users),
+                 "content": sentence(rng), "comment_date": start + timedelta(minutes=i)}
+                for i in range(sizes["comments"])))
+    engine.dispose()
+
+
+def database_for(data_dir: str, scale: str, seed: int, regenerate: bool):
+    path = os.path.join(data_dir, f"{scale}-seed{seed}-v{DATA_VERSION}.db")
+    if os.path.exists(path) and not regenerate:
+        return path, None
+    started = time.perf_counter()
+    partial = path + ".partial"
+    if os.path.exists(partial):
+        os.remove(partial)
+    generate(partial, SCALES[scale], seed)
+    os.replace(partial, path)
+    return path, time.perf_counter() - started
+
+
+##############################################################################
+# benchmarks
+##############################################################################
+
+# the calls to time, each with the arguments of PROBES different users, rooms, groups...
+# picked from the generated data so every call hits rows that exist
+def cases(path: str, seed: int) -> Dict[str, tuple]:
+    from models import GROUP_ROOM_OFFSET
+    rng = random.Random(seed + 1)
+    connection = sqlite3.connect(path)
+    rooms = connection.execute("SELECT room_id, user_a, user_b FROM RoomInfo").fetchall()
+    busy = connection.execute("SELECT room_id, message_count FROM conversation_counter WHERE room_id < ? "
+                              "ORDER BY message_count DESC", (GROUP_ROOM_OFFSET,)).fetchall()
+    members = connection.execute("SELECT group_id, username FROM group_users").fetchall()
+    articles = [row[0] for row in connection.execute("SELECT id FROM articles")]
+    connection.close()
+
+    picked_rooms = rng.sample(rooms, min(PROBES, len(rooms)))
+    users = [a for _, a, _ in picked_rooms]
+    # half the history probes on the busiest rooms, half on random ones
+    history = [room_id for room_id, _ in busy[:PROBES // 2]] + [room_id for room_id, _, _ in picked_rooms][:PROBES // 2]
+    counts = dict(busy)
+    picked_members = rng.sample(members, min(PROBES, len(members)))
+    picked_articles = rng.sample(articles, min(PROBES, len(articles)))
+    user_rooms = {}
+    for room_id, a, b in rooms:
+        user_rooms.setdefault(a, []).append(room_id)
+        user_rooms.setdefault(b, []).append(room_id)
+
+    import db
+    return {
+        "get_user":                   (db.get_user, [(user,) for user in users]),
+        "get_friends_for_user":       (db.get_friends_for_user, [(user,) for user in users]),
+        "get_friend_usernames":       (db.get_friend_usernames, [(user,) for user in users]),
+        "are_friends":                (db.are_friends, [(a, b) for _, a, b in picked_rooms]),
+        "get_friend_requests_for_user": (db.get_friend_requests_for_user, [(user,) for user in users]),
+        "find_room_id_by_users":      (db.find_room_id_by_users, [(a, b) for _, a, b in picked_rooms]),
+        "find_free_room_id":          (db.find_free_room_id, [()]),
+        "get_rooms_for_user":         (db.get_rooms_for_user, [(user,) for user in users]),
+        "get_unread_counts":          (db.get_unread_counts, [(user, user_rooms[user]) for user in users]),
+        "get_conversation_summaries": (db.get_conversation_summaries, [(user, 0, 20) for user in users]),
+        "get_messages_by_room_id":    (db.get_messages_by_room_id, [(room_id, PAGE_SIZE) for room_id in history]),
+        "get_messages_since":         (db.get_messages_since,
+                                       [(room_id, max(0, counts.get(room_id, 0) - PAGE_SIZE), PAGE_SIZE) for room_id in history]),
+        "get_groups_for_user":        (db.get_groups_for_user, [(user,) for _, user in picked_members]),
+        "is_user_in_group":           (db.is_user_in_group, [(user, group_id) for group_id, user in picked_members]),
+        "get_group_messages":         (db.get_group_messages, [(group_id, PAGE_SIZE) for group_id, _ in picked_members]),
+        "get_all_articles":           (db.get_all_articles, [()]),
+        "get_comments_by_article_id": (db.get_comments_by_article_id, [(article_id,) for article_id in picked_articles]),
+    }
+
+
+def percentile(values: List[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(share * len(values)) - 1))]
+
+# counts the statements the benchmarking thread runs through an engine, so a call that starts
+# looping over queries (an N+1) shows up exactly, whatever the timings on the machine are like
+# statements of other threads (the app's flush loop) are left out, they would make the count vary
+class QueryCounter():
+    def __init__(self, engine):
+        self.count = 0
+        self.thread = threading.get_ident()
+        event.listen(engine, "before_cursor_execute", self.record)
+
+    def record(self, *args):
+        if threading.get_ident() == self.thread:
+            self.count += 1
+
+
+def summarize(timings: List[float], queries: int) -> dict:
+    return {
+        "calls": len(timings),
+        "median_ms": round(statistics.median(timings) * 1000, 4),
+        "p95_ms": round(percentile(timings, 0.95) * 1000, 4),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 4),
+        "min_ms": round(min(timings) * 1000, 4),
+        "mean_ms": round(statistics.fmean(timings) * 1000, 4),
+        "queries": round(queries / len(timings), 2),
+    }
+
+# every case is called once to warm the SQLite page cache, then `repeat` times round robin
+def time_calls(f, arguments: list, repeat: int, counter: QueryCounter) -> dict:
+    for args in arguments:
+        f(*args)
+    timings = []
+    queries = counter.count
+    for _ in range(repeat):
+        for args in arguments:
+            started = time.perf_counter()
+            f(*args)
+            timings.append(time.perf_counter() - started)
+    return summarize(timings, counter.count - queries)
+
+
+# a fixed mix of Python and SQLite work, best of a few runs, in ms
+# compare.py scales timings by it, so a run on a busier or slower machine is not a regression
+def calibrate(runs: int = 10) -> float:
+    def workload():
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, room INTEGER, body TEXT)")
+        connection.executemany("INSERT INTO t (room, body) VALUES (?, ?)", ((i % 50, f"message {i}") for i in range(20_000)))
+        connection.execute("CREATE INDEX ix_t_room ON t (room)")
+        for room in range(50):
+            connection.execute("SELECT id, body FROM t WHERE room = ? ORDER BY id DESC LIMIT 50", (room,)).fetchall()
+        connection.close()
+        sum(len(str(i)) for i in range(200_000))
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        workload()
+        timings.append(time.perf_counter() - started)
+    return round(min(timings) * 1000, 3)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    os.makedirs(args.data_dir, exist_ok=True)
+    import db
+
+    report = {
+        "benchmark": "bench_db",
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "data_version": DATA_VERSION,
+            "calibration_ms": calibrate(),
+        },
+        "scales": {},
+    }
+    for scale in args.scales:
+        path, generate_seconds = database_for(args.data_dir, scale, args.seed, args.regenerate)
+        if generate_seconds is not None:
+            print(f"generated {scale} in {generate_seconds:.1f}s", file=sys.stderr)
+
+        db.configure(f"sqlite:///{path}")
+        counter = QueryCounter(db.get_engine())
+        results = {}
+        for name, (f, arguments) in cases(path, args.seed).items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = time_calls(f, arguments, args.repeat, counter)
+        db.get_engine().dispose()
+
+        report["scales"][scale] = {
+            "sizes": SCALES[scale],
+            "generate_seconds": None if generate_seconds is None else round(generate_seconds, 2),
+            "functions": results,
+        }
+    return report
+
+
+def print_table(report: dict):
+    scales = list(report["scales"])
+    names = list(dict.fromkeys(name for scale in scales for name in report["scales"][scale]["functions"]))
+    print(f"{report['benchmark']}: median ms per call", file=sys.stderr)
+    print(f"{'function':<30}" + "".join(f"{scale:>12}" for scale in scales), file=sys.stderr)
+    for name in names:
+        cells = []
+        for scale in scales:
+            result = report["scales"][scale]["functions"].get(name)
+            cells.append(f"{result['median_ms']:>12.3f}" if result else f"{'-':>12}")
+        print(f"{name:<30}" + "".join(cells), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="db.py benchmarks on generated databases")
+    parser.add_argument("--scales", default=DEFAULT_SCALES, type=lambda value: value.split(","),
+                        help=f"comma separated, from {', '.join(SCALES)} (default {DEFAULT_SCALES})")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=2222)
+    parser.add_argument("--only", type=lambda value: value.split(","), help="comma separated function names")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "chat_bench_db"))
+    parser.add_argument("--regenerate", action="store_true", help="rebuild the cached databases")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    for scale in args.scales:
+        if scale not in SCALES:
+            parser.error(f"unknown scale {scale!r}, pick from {', '.join(SCALES)}")
+    args.data_dir = os.path.abspath(args.data_dir)
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    report = run(args)
+    print_table(report)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
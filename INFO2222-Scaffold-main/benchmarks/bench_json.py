@@ -0,0 +1,77 @@
+'''
+bench_json
+compares encode time of the standard json module (what Flask and Socket.IO used before)
+against json_codec on payloads shaped like the biggest ones the app sends
+
+run from the project folder with
+    python benchmarks/bench_json.py [--rows 5000] [--repeat 20]
+'''
+
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json_codec
+
+
+# /get_friends
+def friends_payload(rows: int) -> list:
+    return [{"username": f"user{i}", "is_online": i % 3 == 0, "role": "student", "unread": i % 7} for i in range(rows)]
+
+# /api/comments/<id>, datetimes are left to the codec
+def comments_payload(rows: int) -> list:
+    start = datetime(2024, 1, 1)
+    return [{
+        "id": i,
+        "commenter": f"user{i % 50}",
+        "commenter_role": "student",
+        "content": "a fairly ordinary comment about the article " * 3,
+        "comment_date": start + timedelta(minutes=i)
+    } for i in range(rows)]
+
+# incoming_messages_list, as it is sent now (one array per field) and as it was (one dict per message)
+def history_payload(rows: int) -> dict:
+    return {
+        "id": list(range(rows)),
+        "seq": list(range(1, rows + 1)),
+        "sender": [f"user{i % 2}" for i in range(rows)],
+        "content": [f"message number {i}, with a bit of text in it" for i in range(rows)],
+        "reset": True
+    }
+
+def history_rows_payload(rows: int) -> dict:
+    history = history_payload(rows)
+    return {"messages": [{"id": history["id"][i], "seq": history["seq"][i], "sender": history["sender"][i],
+                          "content": history["content"][i]} for i in range(rows)], "reset": True}
+
+
+# what the old code paths did: Flask's default provider and python-socketio both went through json.dumps
+def stdlib_dumps(obj) -> str:
+    return json.dumps(obj, default=json_codec.default, separators=(",", ":"))
+
+
+def bench(label: str, payload, repeat: int):
+    stdlib = min(timeit.repeat(lambda: stdlib_dumps(payload), number=1, repeat=repeat))
+    codec = min(timeit.repeat(lambda: json_codec.dumps_bytes(payload), number=1, repeat=repeat))
+    size = len(json_codec.dumps_bytes(payload))
+    print(f"{label:<16} {size / 1024:>9.1f} KiB {stdlib * 1000:>10.2f} ms {codec * 1000:>10.2f} ms {stdlib / codec:>8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON encode benchmark")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    backend = "orjson" if json_codec.orjson is not None else "stdlib json (orjson not installed)"
+    print(f"json_codec backend: {backend}, {args.rows} rows, best of {args.repeat}")
+    print(f"{'payload':<16} {'size':>13} {'stdlib':>13} {'json_codec':>13} {'speedup':>9}")
+    bench("friends", friends_payload(args.rows), args.repeat)
+    bench("comments", comments_payload(args.rows), args.repeat)
+    bench("history", history_payload(args.rows), args.repeat)
+    bench("history (rows)", history_rows_payload(args.rows), args.repeat)
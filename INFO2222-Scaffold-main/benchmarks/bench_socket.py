@@ -0,0 +1,179 @@
+'''
+bench_socket
+times the socket events and the busiest routes in-process, through the Flask-SocketIO
+and Flask test clients, against a fresh SQLite database in a temporary directory
+no server or network is involved, so it runs anywhere the app itself imports
+
+run from the project folder with
+    python benchmarks/bench_socket.py [--users 20] [--repeat 10] [--output results.json]
+the JSON report (same layout as bench_db) goes to --output, or stdout, a summary table to stderr
+'''
+
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT)
+
+from bench_db import QueryCounter, summarize, calibrate, git_commit, print_table
+
+# each user is friends with the next FRIENDS users around a ring
+FRIENDS = 3
+GROUP_SIZE = 5
+# messages stored in every room before timing, so history reads return full pages
+HISTORY = 200
+BATCH_SIZE = 10
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="chat_bench_socket_")
+    # the app keeps database/ and session_files/ under the working directory
+    os.chdir(workdir)
+    # one address drives every user so the limits would throttle the run,
+    # and the N+1 warnings of query_stats would drown the report
+    os.environ["RATE_LIMITS"] = "off"
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    import db
+    import app
+    from app import socketio
+    from models import Friendship
+    from sqlalchemy.orm import Session
+
+    users = [f"user{i:03d}" for i in range(args.users)]
+    for username in users:
+        db.insert_user(username, "password")
+    pairs = [(users[i], users[(i + step) % len(users)]) for i in range(len(users)) for step in range(1, FRIENDS + 1)]
+    # both directions, like an approved friend request (db.add_friend only stores one)
+    with Session(db.engine) as session:
+        session.add_all(Friendship(user_username=x, friend_username=y) for a, b in pairs for x, y in ((a, b), (b, a)))
+        session.commit()
+    groups = []
+    for i in range(0, len(users) - 1, GROUP_SIZE):
+        members = users[i:i + GROUP_SIZE]
+        groups.append((db.create_group(f"group {i}", members[0], members)["group_id"], members))
+
+    http = {}
+    sockets = {}
+    for username in users:
+        http[username] = app.app.test_client()
+        http[username].post("/login/user", json={"username": username, "password": "password"})
+        sockets[username] = socketio.test_client(app.app, flask_test_client=http[username])
+
+    rooms = {}
+    for a, b in pairs:
+        rooms[(a, b)] = sockets[a].emit("join", a, b, callback=True)
+        sockets[b].emit("join", b, a, callback=True)
+    for group_id, members in groups:
+        for username in members:
+            sockets[username].emit("join_group", {"group_id": group_id, "username": username}, callback=True)
+    for (a, b), room_id in rooms.items():
+        for _ in range(0, HISTORY, 50):
+            db.insert_messages(room_id, a, [f"history message from {a}"] * 50)
+    for group_id, members in groups:
+        for _ in range(0, HISTORY, 50):
+            db.insert_group_messages(group_id, members[0], [f"history message from {members[0]}"] * 50)
+
+    def drain():
+        for client in sockets.values():
+            client.get_received()
+
+    group_of = {username: (group_id, members) for group_id, members in groups for username in members}
+    member_users = [username for username in users if username in group_of]
+    first_pairs = [(username, next(b for a, b in pairs if a == username)) for username in users]
+
+    # name -> (function, arguments of each probe)
+    cases = {
+        "event send": (
+            lambda a, b: sockets[a].emit("send", a, "benchmark message", rooms[(a, b)]), first_pairs),
+        "event send_batch": (
+            lambda a, b: sockets[a].emit("send_batch", a, [{"client_id": n, "message": "benchmark message"}
+                                                           for n in range(BATCH_SIZE)], rooms[(a, b)], callback=True),
+            first_pairs),
+        "event join": (
+            lambda a, b: sockets[a].emit("join", a, b, HISTORY, callback=True), first_pairs),
+        "event GetHistoryMessages": (
+            lambda a, b: sockets[a].emit("GetHistoryMessages", a, b), first_pairs),
+        "event send_group_message": (
+            lambda username: sockets[username].emit("send_group_message", {
+                "group_id": group_of[username][0], "sender": username, "message": "benchmark message"}),
+            [(username,) for username in member_users]),
+        "event join_group": (
+            lambda username: sockets[username].emit("join_group", {
+                "group_id": group_of[username][0], "username": username, "last_seq": HISTORY}, callback=True),
+            [(username,) for username in member_users]),
+        "event GetGroupHistoryMessages": (
+            lambda username: sockets[username].emit("GetGroupHistoryMessages", {"group_id": group_of[username][0]}),
+            [(username,) for username in member_users]),
+        "GET /get_friends": (
+            lambda username: http[username].get(f"/get_friends?username={username}"), [(username,) for username in users]),
+        "GET /get_groups": (
+            lambda username: http[username].get(f"/get_groups?username={username}"), [(username,) for username in users]),
+        "GET /get_conversations": (
+            lambda username: http[username].get("/get_conversations"), [(username,) for username in users]),
+    }
+
+    counter = QueryCounter(db.engine)
+    results = {}
+    for name, (f, arguments) in cases.items():
+        if args.only and name not in args.only:
+            continue
+        for call in arguments:
+            f(*call)
+        drain()
+        timings = []
+        queries = counter.count
+        for _ in range(args.repeat):
+            for call in arguments:
+                started = time.perf_counter()
+                f(*call)
+                timings.append(time.perf_counter() - started)
+            drain()
+        results[name] = summarize(timings, counter.count - queries)
+
+    for client in sockets.values():
+        client.disconnect()
+
+    return {
+        "benchmark": "bench_socket",
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "calibration_ms": calibrate(),
+        },
+        "scales": {
+            "in_process": {
+                "sizes": {"users": len(users), "friendships": len(pairs), "groups": len(groups), "history": HISTORY},
+                "generate_seconds": None,
+                "functions": results,
+            }
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="in-process socket event and route benchmarks")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--only", type=lambda value: value.split(","), help="comma separated operation names")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    report = run(args)
+    print_table(report)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
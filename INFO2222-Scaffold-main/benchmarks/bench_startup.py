@@ -0,0 +1,142 @@
+'''
+bench_startup
+how long a worker takes to boot: every probe is a fresh interpreter that imports app,
+builds an app with create_app() on an in-memory database and serves its first request,
+then python -X importtime of the same import lists the modules that cost the most
+
+run from the project folder with
+    python benchmarks/bench_startup.py [--repeat 10] [--top 15] [--output results.json]
+the JSON report (same layout as bench_db) goes to --output, or stdout, a summary table
+and the slowest imports to stderr
+'''
+
+from datetime import datetime
+from typing import Dict, List
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT)
+
+from bench_db import summarize, calibrate, git_commit, print_table
+
+# runs in the fresh interpreter, prints the seconds of each step as JSON
+PROBE = """
+import json, os, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app({"DATABASE_URL": "sqlite://", "TESTING": True})
+created = time.perf_counter()
+response = flask_app.test_client().get("/")
+served = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({"import app": imported - started, "create_app": created - imported, "first request": served - created}))
+os._exit(0)
+"""
+
+
+def environment() -> Dict[str, str]:
+    # the app's logs would end up between the probe's output
+    return {**os.environ, "PYTHONPATH": PROJECT, "LOG_LEVEL": "ERROR"}
+
+def probe(workdir: str) -> Dict[str, float]:
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", PROBE], cwd=workdir, env=environment(),
+                            capture_output=True, text=True, check=True)
+    steps = json.loads(result.stdout.strip().splitlines()[-1])
+    # interpreter start and exit included, what a process manager waits for
+    steps["process"] = time.perf_counter() - started
+    return steps
+
+
+# "import time: self [us] | cumulative | imported package" lines, nesting shown by indentation
+def import_times(workdir: str) -> List[dict]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=workdir,
+                            env=environment(), capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        imports.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": round(int(own) / 1000, 3),
+            "cumulative_ms": round(int(cumulative) / 1000, 3),
+        })
+    return imports
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="chat_bench_startup_")
+    # the first probe pays for cold .pyc files and page cache, it is not counted
+    probe(workdir)
+    timings: Dict[str, List[float]] = {}
+    for _ in range(args.repeat):
+        for step, seconds in probe(workdir).items():
+            timings.setdefault(step, []).append(seconds)
+
+    imports = import_times(workdir)
+    # the lines are written as each import finishes, so app comes last and its tree is
+    # everything after the interpreter's own startup imports (the depth 0 lines before it)
+    end = max(i for i, item in enumerate(imports) if item["module"] == "app")
+    start = max((i for i, item in enumerate(imports[:end]) if item["depth"] == 0), default=-1) + 1
+    total, imports = imports[end], imports[start:end]
+    return {
+        "benchmark": "bench_startup",
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "calibration_ms": calibrate(),
+        },
+        "scales": {
+            "startup": {
+                "sizes": {},
+                "generate_seconds": None,
+                # booting runs no queries, create_app leaves the engine to the first one
+                "functions": {step: summarize(seconds, 0) for step, seconds in timings.items()},
+            }
+        },
+        "imports": {
+            "total_ms": total["cumulative_ms"],
+            # what app pulls in directly, and where the time goes wherever it is imported from
+            "direct": sorted((item for item in imports if item["depth"] == 1),
+                             key=lambda item: -item["cumulative_ms"])[:args.top],
+            "by_self": sorted(imports, key=lambda item: -item["self_ms"])[:args.top],
+        },
+    }
+
+
+def print_imports(report: dict):
+    imports = report["imports"]
+    print(f"\nimport app: {imports['total_ms']} ms, slowest direct imports", file=sys.stderr)
+    for item in imports["direct"]:
+        print(f"{item['module']:<30}{item['cumulative_ms']:>12.3f}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="worker boot time and import profile")
+    parser.add_argument("--repeat", type=int, default=10, help="fresh interpreters to time")
+    parser.add_argument("--top", type=int, default=15, help="imports to list")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_table(report)
+    print_imports(report)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,192 @@
+'''
+compare
+performance regression gate, reruns bench_db, bench_socket and bench_startup with the settings of their
+stored baselines (benchmarks/baselines/*.json) and compares every operation:
+    - queries per call must not go up at all, that is how an N+1 creeps back in
+    - the median and p99 must not get slower than the tolerance allows
+exits with 1 when anything regressed or disappeared, so it can gate a deploy
+everything runs offline against temporary SQLite files
+
+run from the project folder with
+    python benchmarks/compare.py                    compare against the baselines
+    python benchmarks/compare.py --update           record new baselines (commit them)
+    python benchmarks/compare.py --current a.json   compare result files instead of rerunning
+
+every report carries the time of a fixed calibration workload and timings are scaled by it,
+which absorbs a busier or somewhat slower machine, but baselines are best recorded where the gate runs
+'''
+
+from typing import Dict, List, Optional
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(HERE, "baselines")
+BENCHMARKS = ("bench_db", "bench_socket", "bench_startup")
+
+# slower by more than this share of the baseline...
+MEDIAN_TOLERANCE = 0.3
+P99_TOLERANCE = 1.0
+# ...and by more than this many ms, sub-millisecond calls jitter by more than that
+MIN_DELTA_MS = 0.25
+RETRIES = 2
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+def baseline_path(name: str) -> str:
+    return os.path.join(BASELINES, f"{name}.json")
+
+
+# the arguments that make a rerun comparable to a baseline
+def rerun_arguments(name: str, baseline: Optional[dict]) -> List[str]:
+    if baseline is None:
+        return []
+    meta = baseline["meta"]
+    if name == "bench_db":
+        return ["--scales", ",".join(baseline["scales"]), "--repeat", str(meta["repeat"]), "--seed", str(meta["seed"])]
+    if name == "bench_socket":
+        sizes = baseline["scales"]["in_process"]["sizes"]
+        return ["--users", str(sizes["users"]), "--repeat", str(meta["repeat"])]
+    return ["--repeat", str(meta["repeat"])]
+
+def run_benchmark(name: str, baseline: Optional[dict]) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, f"{name}.json")
+        command = [sys.executable, os.path.join(HERE, f"{name}.py"), *rerun_arguments(name, baseline), "--output", output]
+        print(f"running {' '.join(command[1:-2])}", file=sys.stderr)
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0 or not os.path.exists(output):
+            sys.stderr.write(result.stdout + result.stderr)
+            raise SystemExit(f"{name} failed with exit code {result.returncode}")
+        return load(output)
+
+
+# how much faster the machine ran the calibration workload for the baseline than now
+def machine_speed(baseline: dict, current: dict) -> float:
+    before, after = baseline["meta"].get("calibration_ms"), current["meta"].get("calibration_ms")
+    return before / after if before and after else 1.0
+
+# one row per operation: (scale, operation, status, details)
+def compare(baseline: dict, current: dict, median_tolerance: float, p99_tolerance: float,
+            min_delta_ms: float) -> List[tuple]:
+    # current timings are brought to the speed the machine had when the baseline was recorded
+    speed = machine_speed(baseline, current)
+    rows = []
+    for scale, base_scale in baseline["scales"].items():
+        current_functions = current["scales"].get(scale, {}).get("functions", {})
+        for name, base in base_scale["functions"].items():
+            now = current_functions.get(name)
+            if now is None:
+                rows.append((scale, name, "missing", "not in the current results"))
+                continue
+            problems, gains = [], []
+            if now["queries"] > base["queries"] + 0.01:
+                problems.append(f"queries {base['queries']:g} -> {now['queries']:g}")
+            elif now["queries"] < base["queries"] - 0.01:
+                gains.append(f"queries {base['queries']:g} -> {now['queries']:g}")
+            for key, tolerance in (("median_ms", median_tolerance), ("p99_ms", p99_tolerance)):
+                before, after = base[key], now[key] * speed
+                change = f"{key[:-3]} {before:.3f} -> {after:.3f} ms ({(after - before) / before:+.0%})" if before else ""
+                if after > before * (1 + tolerance) and after - before > min_delta_ms:
+                    problems.append(change)
+                elif after < before / (1 + tolerance) and before - after > min_delta_ms:
+                    gains.append(change)
+            if problems:
+                rows.append((scale, name, "regressed", ", ".join(problems)))
+            elif gains:
+                rows.append((scale, name, "improved", ", ".join(gains)))
+            else:
+                rows.append((scale, name, "ok", f"median {now['median_ms']:.3f} ms, {now['queries']:g} queries"))
+        for name in current_functions:
+            if name not in base_scale["functions"]:
+                rows.append((scale, name, "new", "no baseline yet"))
+    return rows
+
+
+# a timing regression only counts if every rerun shows it too, one slow run on a busy machine is noise
+# queries per call do not depend on the machine, so those are never retried away
+def confirm(name: str, baseline: dict, rows: List[tuple], retries: int, args) -> List[tuple]:
+    for attempt in range(retries):
+        suspects = {(scale, operation) for scale, operation, status, details in rows
+                    if status == "regressed" and "queries" not in details}
+        if not suspects:
+            break
+        print(f"rerunning {name} to confirm {len(suspects)} regression(s), attempt {attempt + 1} of {retries}",
+              file=sys.stderr)
+        rerun = compare(baseline, run_benchmark(name, baseline), args.tolerance, args.p99_tolerance, args.min_delta_ms)
+        still = {(scale, operation) for scale, operation, status, _ in rerun if status == "regressed"}
+        rows = [(scale, operation, "ok", f"{details} in one run only") if (scale, operation) in suspects - still
+                else (scale, operation, status, details) for scale, operation, status, details in rows]
+    return rows
+
+
+def main(args) -> int:
+    os.makedirs(BASELINES, exist_ok=True)
+    currents: Dict[str, dict] = {}
+    if args.current:
+        for path in args.current:
+            result = load(path)
+            currents[result["benchmark"]] = result
+    else:
+        for name in args.benchmarks:
+            baseline = load(baseline_path(name)) if os.path.exists(baseline_path(name)) else None
+            currents[name] = run_benchmark(name, baseline)
+
+    if args.update:
+        for name, result in currents.items():
+            with open(baseline_path(name), "w") as f:
+                f.write(json.dumps(result, indent=2) + "\n")
+            print(f"wrote {os.path.relpath(baseline_path(name))}")
+        return 0
+
+    failed = False
+    report = {}
+    for name, current in currents.items():
+        if not os.path.exists(baseline_path(name)):
+            print(f"{name}: no baseline, record one with --update")
+            continue
+        baseline = load(baseline_path(name))
+        rows = compare(baseline, current, args.tolerance, args.p99_tolerance, args.min_delta_ms)
+        if not args.current:
+            rows = confirm(name, baseline, rows, args.retries, args)
+        report[name] = [{"scale": scale, "operation": operation, "status": status, "details": details}
+                        for scale, operation, status, details in rows]
+        print(f"{name} (baseline {baseline['meta'].get('commit') or 'unknown commit'}, "
+              f"timings scaled by {machine_speed(baseline, current):.2f} for machine speed)")
+        for scale, operation, status, details in rows:
+            if status != "ok" or args.verbose:
+                print(f"  {status:<10} {scale:<11} {operation:<32} {details}")
+        counts = {status: sum(1 for row in rows if row[2] == status) for status in ("ok", "improved", "regressed", "missing", "new")}
+        print("  " + ", ".join(f"{count} {status}" for status, count in counts.items() if count))
+        failed = failed or counts["regressed"] > 0 or counts["missing"] > 0
+
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare benchmark results against the stored baselines")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), type=lambda value: value.split(","),
+                        help=f"comma separated, from {', '.join(BENCHMARKS)}")
+    parser.add_argument("--current", nargs="+", help="result files to compare instead of rerunning the benchmarks")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=MEDIAN_TOLERANCE, help="allowed median slowdown, as a share")
+    parser.add_argument("--p99-tolerance", type=float, default=P99_TOLERANCE, help="allowed p99 slowdown, as a share")
+    parser.add_argument("--min-delta-ms", type=float, default=MIN_DELTA_MS, help="slowdowns below this are ignored")
+    parser.add_argument("--retries", type=int, default=RETRIES, help="reruns that must confirm a timing regression")
+    parser.add_argument("--json", help="also write the comparison here")
+    parser.add_argument("--verbose", action="store_true", help="list the operations that are ok too")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}, pick from {', '.join(BENCHMARKS)}")
+    sys.exit(main(args))
@@ -0,0 +1,561 @@
+'''
+load_test
+simulates chat users against a running server with the python-socketio client
+signs up N users, makes them friends and puts them in groups, then drives a mix of
+DM sends, group sends, history fetches and friend list reads, and prints a JSON report
+with throughput, end-to-end delivery latency percentiles and error rates
+
+needs the client side packages, which the server itself does not:
+    pip install "python-socketio[client]"      (requests and websocket-client)
+
+rate limits are per client address and would throttle the whole run, so start the server with
+    RATE_LIMITS=off python app.py
+then, from the project folder
+    python benchmarks/load_test.py --users 50 --duration 30 --rate 1 --mix dm=60,group=20,history=10,friends=10
+
+--soak runs for that many seconds of churn instead: in every --cycle the users log in, connect, join
+their rooms, chat, leave, (some) log out and disconnect, and the server's memory is sampled in between
+through the admin memory endpoints, so it needs an admin account (role 'admin' in the user table)
+    python benchmarks/load_test.py --users 50 --soak 14400 --cycle 60 --admin admin:password
+the report lists the allocation sites that grew the most and the run exits with 1 if the memory
+kept per connection does not return to the baseline, or connection state (rooms, sockets) is left over
+'''
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import json
+import random
+import secrets
+import sys
+import threading
+import time
+
+import requests
+import socketio
+
+DEFAULT_MIX = "dm=60,group=20,history=10,friends=10"
+OPERATIONS = ("dm", "group", "history", "friends")
+# which operation a rate_limited event was for
+LIMITED_EVENTS = {"send": "dm", "send_group_message": "group", "GetHistoryMessages": "history"}
+HTTP_TIMEOUT = 10
+MAX_RETRIES = 5
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(share * len(values)) - 1))]
+
+
+class Stats():
+    def __init__(self):
+        self.sent = Counter()
+        self.failed = Counter()
+        self.errors = Counter()
+        self.expected = Counter()
+        self.delivered = Counter()
+        self.latencies: Dict[str, List[float]] = {name: [] for name in OPERATIONS}
+        self.lock = threading.Lock()
+
+    def record_sent(self, operation: str, expected: int = 0):
+        with self.lock:
+            self.sent[operation] += 1
+            self.expected[operation] += expected
+
+    def record_latency(self, operation: str, seconds: float, delivered: bool = False):
+        with self.lock:
+            self.latencies[operation].append(seconds)
+            if delivered:
+                self.delivered[operation] += 1
+
+    def record_error(self, kind: str, operation: Optional[str] = None):
+        with self.lock:
+            self.errors[kind] += 1
+            if operation is not None:
+                self.failed[operation] += 1
+
+    def report(self, seconds: float) -> dict:
+        with self.lock:
+            operations = {}
+            for name in OPERATIONS:
+                latencies = self.latencies[name]
+                operations[name] = {
+                    "sent": self.sent[name],
+                    "errors": self.failed[name],
+                    "error_rate": round(self.failed[name] / self.sent[name], 4) if self.sent[name] else 0,
+                    "latency_ms": {
+                        "count": len(latencies),
+                        "p50": ms(percentile(latencies, 0.50)),
+                        "p95": ms(percentile(latencies, 0.95)),
+                        "p99": ms(percentile(latencies, 0.99)),
+                        "max": ms(max(latencies) if latencies else None),
+                    }
+                }
+            delivery = {}
+            for name in ("dm", "group"):
+                lost = max(0, self.expected[name] - self.delivered[name])
+                delivery[name] = {
+                    "expected": self.expected[name],
+                    "delivered": self.delivered[name],
+                    "lost": lost,
+                    # more deliveries than sends means messages reached sockets outside their room
+                    "unexpected": max(0, self.delivered[name] - self.expected[name]),
+                    "loss_rate": round(lost / self.expected[name], 4) if self.expected[name] else 0,
+                }
+            total = sum(self.sent.values())
+            return {
+                "throughput": {
+                    "operations_per_second": round(total / seconds, 1),
+                    "deliveries_per_second": round(sum(self.delivered.values()) / seconds, 1),
+                },
+                "operations": operations,
+                "delivery": delivery,
+                "errors": dict(self.errors),
+                "error_rate": round(sum(self.failed.values()) / total, 4) if total else 0,
+            }
+
+def ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+class SimulatedUser():
+    def __init__(self, url: str, username: str, password: str, stats: Stats):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.stats = stats
+        # friend -> dm room id, group id -> member count
+        self.rooms: Dict[str, int] = {}
+        self.groups: Dict[int, int] = {}
+        self.open()
+
+    # a fresh HTTP session and socket client, like a new browser tab
+    def open(self):
+        self.http = requests.Session()
+        self.sio = socketio.Client(http_session=self.http, reconnection=False, handle_sigint=False)
+        # start times of history requests waiting for their incoming_messages_list
+        self.pending_history = deque()
+        self.stopping = False
+
+        self.sio.on("incoming", lambda data: self.on_message("dm", data))
+        self.sio.on("incoming_group_message", lambda data: self.on_message("group", data))
+        self.sio.on("incoming_messages_list", self.on_history)
+        self.sio.on("rate_limited", self.on_rate_limited)
+        self.sio.on("error", lambda data: self.stats.record_error("server_error"))
+        self.sio.on("disconnect", self.on_disconnect)
+
+    ##########################################################################
+    # setup, over HTTP
+    ##########################################################################
+
+    # retries what the server throttled, in case it runs with rate limits on
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        for _ in range(MAX_RETRIES):
+            response = self.http.request(method, self.url + path, timeout=HTTP_TIMEOUT, **kwargs)
+            if response.status_code != 429:
+                return response
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+        return response
+
+    def sign_up(self):
+        response = self.request("POST", "/signup/user", json={"username": self.username, "password": self.password})
+        if response.text.startswith("Error"):
+            response = self.request("POST", "/login/user", json={"username": self.username, "password": self.password})
+        if response.status_code != 200 or response.text.startswith("Error"):
+            raise RuntimeError(f"{self.username} could not sign up or log in: {response.text}")
+
+    def log_in(self):
+        response = self.request("POST", "/login/user", json={"username": self.username, "password": self.password})
+        if response.status_code != 200 or response.text.startswith("Error"):
+            raise RuntimeError(f"{self.username} could not log in: {response.text}")
+
+    def log_out(self):
+        self.request("GET", "/logout", allow_redirects=False)
+
+    def send_friend_request(self, receiver: str):
+        self.request("POST", "/send_friend_request", json={"receiver": receiver})
+
+    def accept_friend_requests(self, senders: set):
+        received = self.request("GET", "/get_friend_requests", params={"username": self.username}).json()
+        for friend_request in received:
+            if friend_request["receiver"] == self.username and friend_request["sender"] in senders \
+                    and friend_request["status"] == "pending":
+                self.request("POST", "/update_friend_request",
+                             json={"request_id": friend_request["id"], "status": "approved"})
+
+    def create_group(self, name: str, members: List[str]) -> int:
+        result = self.request("POST", "/create_group", json={"name": name, "usernames": members}).json()
+        if "group_id" not in result:
+            raise RuntimeError(f"{self.username} could not create {name}: {result}")
+        return result["group_id"]
+
+    ##########################################################################
+    # socket
+    ##########################################################################
+
+    def connect(self, transports: List[str]):
+        self.sio.connect(self.url, transports=transports, wait_timeout=HTTP_TIMEOUT)
+
+    def join_rooms(self, friends: List[str]):
+        for friend in friends:
+            room_id = self.sio.call("join", (self.username, friend), timeout=HTTP_TIMEOUT)
+            if isinstance(room_id, int):
+                self.rooms[friend] = room_id
+            else:
+                self.stats.record_error(f"join: {room_id}")
+        for group_id in self.groups:
+            self.sio.call("join_group", {"group_id": group_id, "username": self.username}, timeout=HTTP_TIMEOUT)
+
+    def leave_rooms(self):
+        for room_id in self.rooms.values():
+            self.sio.emit("leave", (self.username, room_id))
+
+    # every message carries the time it was sent, so whoever receives it can work out the delay
+    def message(self) -> str:
+        return f"load test {time.perf_counter():.6f}"
+
+    def on_message(self, operation: str, data: dict):
+        sender, message = data.get("sender"), data.get("message")
+        if sender == self.username or not isinstance(message, str) or not message.startswith("load test "):
+            return
+        self.stats.record_latency(operation, time.perf_counter() - float(message.rsplit(" ", 1)[1]), delivered=True)
+
+    def on_history(self, data: dict):
+        if self.pending_history:
+            self.stats.record_latency("history", time.perf_counter() - self.pending_history.popleft())
+
+    def on_rate_limited(self, data: dict):
+        operation = LIMITED_EVENTS.get(data.get("event"))
+        if operation == "history" and self.pending_history:
+            self.pending_history.popleft()
+        self.stats.record_error("rate_limited", operation)
+
+    def on_disconnect(self):
+        if not self.stopping:
+            self.stats.record_error("disconnected")
+
+    ##########################################################################
+    # operations
+    ##########################################################################
+
+    def run(self, operation: str):
+        try:
+            getattr(self, f"do_{operation}")()
+        except Exception as e:
+            self.stats.record_error(f"{operation}: {type(e).__name__}", operation)
+
+    def do_dm(self):
+        if not self.rooms:
+            return
+        friend = random.choice(list(self.rooms))
+        self.stats.record_sent("dm", expected=1)
+        self.sio.emit("send", (self.username, self.message(), self.rooms[friend]))
+
+    def do_group(self):
+        if not self.groups:
+            return
+        group_id = random.choice(list(self.groups))
+        self.stats.record_sent("group", expected=self.groups[group_id] - 1)
+        self.sio.emit("send_group_message", {"group_id": group_id, "sender": self.username, "message": self.message()})
+
+    def do_history(self):
+        if not self.rooms:
+            return
+        self.stats.record_sent("history")
+        self.pending_history.append(time.perf_counter())
+        self.sio.emit("GetHistoryMessages", (self.username, random.choice(list(self.rooms))))
+
+    def do_friends(self):
+        self.stats.record_sent("friends")
+        start = time.perf_counter()
+        response = self.request("GET", "/get_friends", params={"username": self.username})
+        if response.status_code == 200:
+            self.stats.record_latency("friends", time.perf_counter() - start)
+        else:
+            self.stats.record_error(f"friends: HTTP {response.status_code}", "friends")
+
+    # runs operations picked from the mix, rate times a second on average, until the deadline
+    def drive(self, mix: Dict[str, float], rate: float, deadline: float):
+        names, weights = list(mix), list(mix.values())
+        while True:
+            wait = random.expovariate(rate)
+            if time.perf_counter() + wait >= deadline:
+                break
+            time.sleep(wait)
+            self.run(random.choices(names, weights)[0])
+
+    def close(self):
+        self.stopping = True
+        try:
+            self.sio.disconnect()
+        finally:
+            self.http.close()
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for item in value.split(","):
+        name, weight = item.split("=")
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, pick from {', '.join(OPERATIONS)}")
+        mix[name.strip()] = float(weight)
+    if not any(weight > 0 for weight in mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs at least one operation with a positive weight")
+    return mix
+
+
+def in_parallel(pool: ThreadPoolExecutor, f, items):
+    # list() raises the first error of any of the calls
+    return list(pool.map(f, items))
+
+
+# signs the users up, makes them friends and puts them in groups, all over HTTP
+# returns each user's friends, the friendships and the groups
+def set_up(args, users: List[SimulatedUser], pool: ThreadPoolExecutor, run_id: str) -> tuple:
+    in_parallel(pool, SimulatedUser.sign_up, users)
+
+    # each user befriends the next --friends users around the ring
+    friends = {user.username: set() for user in users}
+    pairs = []
+    for i, user in enumerate(users):
+        for step in range(1, min(args.friends, args.users - 1) + 1):
+            friend = users[(i + step) % args.users]
+            if friend.username not in friends[user.username]:
+                friends[user.username].add(friend.username)
+                friends[friend.username].add(user.username)
+                pairs.append((user, friend))
+    in_parallel(pool, lambda pair: pair[0].send_friend_request(pair[1].username), pairs)
+    senders = {user.username: set() for user in users}
+    for user, friend in pairs:
+        senders[friend.username].add(user.username)
+    in_parallel(pool, lambda user: user.accept_friend_requests(senders[user.username]), users)
+
+    # consecutive users form groups of --group-size, the first one creates it
+    groups = [users[i:i + args.group_size] for i in range(0, args.users, args.group_size)] if args.group_size > 1 else []
+    groups = [members for members in groups if len(members) > 1]
+    def create(members):
+        group_id = members[0].create_group(f"load {run_id} {members[0].username}", [member.username for member in members])
+        for member in members:
+            member.groups[group_id] = len(members)
+    in_parallel(pool, create, groups)
+    return friends, pairs, groups
+
+
+def connect_and_join(args, users: List[SimulatedUser], pool: ThreadPoolExecutor, friends: Dict[str, set]):
+    in_parallel(pool, lambda user: user.connect(args.transports.split(",")), users)
+    in_parallel(pool, lambda user: user.join_rooms(sorted(friends[user.username])), users)
+
+# every user runs the mix on its own thread for the given seconds, returns how long that took
+def drive(args, users: List[SimulatedUser], seconds: float) -> float:
+    started = time.perf_counter()
+    deadline = started + seconds
+    threads = [threading.Thread(target=user.drive, args=(args.mix, args.rate, deadline), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    driven = time.perf_counter() - started
+    # let messages still on the wire arrive before counting the lost ones
+    time.sleep(args.drain)
+    return driven
+
+
+# reads the server's memory through the admin endpoints
+class Admin():
+    def __init__(self, url: str, credentials: str):
+        self.url = url
+        self.http = requests.Session()
+        username, _, password = credentials.partition(":")
+        response = self.http.post(url + "/login/user", json={"username": username, "password": password}, timeout=HTTP_TIMEOUT)
+        if response.status_code != 200 or response.text.startswith("Error"):
+            raise RuntimeError(f"admin {username} could not log in: {response.text}")
+
+    def call(self, method: str, path: str, **kwargs) -> dict:
+        # the first snapshots walk the whole heap, give them time
+        response = self.http.request(method, self.url + path, timeout=HTTP_TIMEOUT * 6, **kwargs)
+        if response.status_code == 403:
+            raise RuntimeError("the --admin account is not an admin on the server")
+        response.raise_for_status()
+        return response.json()
+
+    def baseline(self) -> dict:
+        return self.call("POST", "/admin/memory/baseline")
+
+    def memory(self, top: int = 0) -> dict:
+        return self.call("GET", "/admin/memory", params={"top": top})
+
+    def stop(self):
+        self.call("POST", "/admin/memory/stop")
+
+
+# least squares slope of ys over xs
+def slope(xs: List[float], ys: List[float]) -> Optional[float]:
+    if len(xs) < 2:
+        return None
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread if spread else None
+
+
+def load(args, stats: Stats, users: List[SimulatedUser], pool: ThreadPoolExecutor, friends: Dict[str, set]) -> dict:
+    connect_and_join(args, users, pool, friends)
+    print(f"driving {len(users)} users for {args.duration}s", file=sys.stderr)
+    driven = drive(args, users, args.duration)
+    for user in users:
+        user.close()
+    report = {"duration_seconds": round(driven, 2)}
+    report.update(stats.report(driven))
+    return report
+
+
+# one round of churn: everyone logs in, connects, joins, chats, leaves and disconnects,
+# args.logout of them log out first, the others leave their session behind like a closed tab
+def churn(args, users: List[SimulatedUser], pool: ThreadPoolExecutor, friends: Dict[str, set]) -> float:
+    in_parallel(pool, SimulatedUser.log_in, users)
+    connect_and_join(args, users, pool, friends)
+    driven = drive(args, users, args.cycle)
+    in_parallel(pool, SimulatedUser.leave_rooms, users)
+    in_parallel(pool, SimulatedUser.log_out, users[:round(len(users) * args.logout)])
+    for user in users:
+        user.close()
+        user.open()
+    # give the server time to handle the disconnects before it is sampled
+    time.sleep(args.drain)
+    return driven
+
+
+def soak(args, stats: Stats, users: List[SimulatedUser], pool: ThreadPoolExecutor, friends: Dict[str, set]) -> dict:
+    admin = Admin(args.url, args.admin)
+    # tracemalloc only sees what is allocated after it started, so it starts before the warm up,
+    # and the unmeasured warm up cycles put imports, pools and bounded buffers that fill once into the baseline
+    admin.baseline()
+    print(f"warming up for {args.warmup} cycle(s) of {args.cycle}s", file=sys.stderr)
+    for _ in range(args.warmup):
+        churn(args, users, pool, friends)
+    baseline = admin.baseline()
+
+    samples = []
+    connections = 0
+    driven = 0.0
+    started = time.perf_counter()
+    deadline = started + args.soak
+    while time.perf_counter() + args.cycle <= deadline or not samples:
+        driven += churn(args, users, pool, friends)
+        connections += len(users)
+        memory = admin.memory()
+        samples.append({
+            "cycle": len(samples) + 1,
+            "seconds": round(time.perf_counter() - started, 1),
+            "connections": connections,
+            "rss_bytes": memory["rss_bytes"],
+            "traced_bytes": memory["traced_bytes"],
+            "connection_state": memory["state"]["connection"],
+        })
+        print(f"cycle {len(samples)}: {connections} connections, traced {memory['traced_bytes'] - baseline['traced_bytes']:+,} "
+              f"bytes, rss {(memory['rss_bytes'] or 0) - (baseline['rss_bytes'] or 0):+,} bytes", file=sys.stderr)
+    final = admin.memory(args.top)
+    admin.stop()
+
+    # growth per connection over the samples, what the caches took in the first cycles levels off
+    growth = slope([sample["connections"] for sample in samples], [sample["traced_bytes"] for sample in samples])
+    retained = final["traced_bytes"] - baseline["traced_bytes"]
+    per_connection = growth if growth is not None else retained / connections
+    before, after = baseline["state"], final["state"]
+    leftover = {key: value - before["connection"].get(key, 0) for key, value in after["connection"].items()
+                if value > before["connection"].get(key, 0)}
+    failures = []
+    if per_connection > args.max_growth:
+        failures.append(f"memory grows by {per_connection:,.0f} bytes per connection, "
+                        f"more than the {args.max_growth:,} allowed")
+    if leftover:
+        failures.append("connection state did not drain: " + ", ".join(f"{key} +{value}" for key, value in leftover.items()))
+
+    report = {
+        "duration_seconds": round(time.perf_counter() - started, 2),
+        "soak": {
+            "passed": not failures,
+            "failures": failures,
+            "cycles": len(samples),
+            "connections": connections,
+            "baseline": {"rss_bytes": baseline["rss_bytes"], "traced_bytes": baseline["traced_bytes"]},
+            "final": {"rss_bytes": final["rss_bytes"], "traced_bytes": final["traced_bytes"]},
+            "retained_bytes": retained,
+            "retained_bytes_per_connection": round(retained / connections, 1),
+            "growth_bytes_per_connection": None if growth is None else round(growth, 1),
+            "rss_growth_bytes": final["rss_bytes"] - baseline["rss_bytes"] if final["rss_bytes"] and baseline["rss_bytes"] else None,
+            "leftover_connection_state": leftover,
+            "state_growth": {key: value - before["other"].get(key, 0) for key, value in after["other"].items()
+                             if value != before["other"].get(key, 0)},
+            "top_growth": final["top"],
+            "samples": samples,
+        },
+    }
+    report.update(stats.report(driven))
+    return report
+
+
+def main(args) -> dict:
+    stats = Stats()
+    run_id = secrets.token_hex(3)
+    users = [SimulatedUser(args.url, f"load_{run_id}_{i}", secrets.token_hex(8), stats) for i in range(args.users)]
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        setup_started = time.perf_counter()
+        friends, pairs, groups = set_up(args, users, pool, run_id)
+        setup_seconds = time.perf_counter() - setup_started
+        print(f"{len(users)} users, {len(pairs)} friendships, {len(groups)} groups set up in {setup_seconds:.1f}s",
+              file=sys.stderr)
+        results = soak(args, stats, users, pool, friends) if args.soak else load(args, stats, users, pool, friends)
+
+    report = {
+        "config": {"url": args.url, "users": args.users, "duration": args.duration, "rate": args.rate,
+                   "mix": args.mix, "friends": args.friends, "group_size": args.group_size,
+                   "transports": args.transports},
+        "setup": {"friendships": len(pairs), "groups": len(groups), "seconds": round(setup_seconds, 2)},
+    }
+    if args.soak:
+        report["config"].update({"soak": args.soak, "cycle": args.cycle, "warmup": args.warmup, "logout": args.logout,
+                                 "max_growth": args.max_growth})
+    report.update(results)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Socket.IO load test with simulated users")
+    parser.add_argument("--url", default="http://127.0.0.1:8998")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30, help="seconds to drive the mix for")
+    parser.add_argument("--rate", type=float, default=1, help="operations per second per user")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"weights, default {DEFAULT_MIX}")
+    parser.add_argument("--friends", type=int, default=2, help="friends of each user, around a ring")
+    parser.add_argument("--group-size", type=int, default=5, help="members per group, 0 for no groups")
+    parser.add_argument("--transports", default="websocket", help="websocket, polling or both comma separated")
+    parser.add_argument("--concurrency", type=int, default=20, help="parallel requests while setting up")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for late deliveries")
+    parser.add_argument("--output", help="write the report here instead of stdout")
+    parser.add_argument("--soak", type=float, help="seconds of churn cycles with memory tracking, instead of --duration")
+    parser.add_argument("--cycle", type=float, default=30, help="seconds users stay connected in each soak cycle")
+    parser.add_argument("--admin", help="username:password of an admin, needed by --soak")
+    parser.add_argument("--warmup", type=int, default=2, help="soak cycles before the memory baseline is taken")
+    parser.add_argument("--logout", type=float, default=0.5, help="share of users that log out at the end of a cycle")
+    parser.add_argument("--max-growth", type=int, default=1024, help="bytes a connection may leave behind in --soak")
+    parser.add_argument("--top", type=int, default=20, help="allocation sites to list in the --soak report")
+    args = parser.parse_args()
+    if args.soak and not args.admin:
+        parser.error("--soak reads the server's memory through the admin endpoints, pass --admin username:password")
+    if not 0 <= args.logout <= 1:
+        parser.error("--logout is a share between 0 and 1")
+
+    result = main(args)
+    report = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    if args.soak and not result["soak"]["passed"]:
+        print("soak failed: " + "; ".join(result["soak"]["failures"]), file=sys.stderr)
+        sys.exit(1)
@@ -3,31 +3,161 @@ db
 database file, containing all the logic to interface with the sql database
 '''
 
-from sqlalchemy import and_, create_engine, MetaData, or_, Table
+from sqlalchemy import and_, case, create_engine, func, inspect, MetaData, or_, Table, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import Session,sessionmaker, scoped_session
 from sqlalchemy.exc import SQLAlchemyError
 from models import *  
 from pathlib import Path
 from sqlalchemy.exc import SQLAlchemyError
 from datetime import datetime
+from typing import Callable, List, Optional
+import logging
+import threading
 
-# for hash and salt
-from bcrypt import gensalt, hashpw, checkpw
-
-# creates the database directory
-Path("database") \
-    .mkdir(exist_ok=True)
+logger = logging.getLogger(__name__)
+# one record per stored message, sampled by logging_setup, never with the content
+message_log = logging.getLogger("db.messages")
 
 # "database/main.db" specifies the database file
-# change it if you wish
-# turn echo = True to display the sql output
-engine = create_engine("sqlite:///database/main.db", echo=False)
-# initializes the database
-Base.metadata.create_all(engine)
+# change it if you wish, or pass another url to configure(), "sqlite://" keeps everything in memory
+DATABASE_URL = "sqlite:///database/main.db"
+
+# the engine is only created, and the schema only set up, by the first call that needs it,
+# so importing db (from a script, a test or a worker that never queries) costs no disk access
+database_url = DATABASE_URL
+_engine: Optional[Engine] = None
+engine_lock = threading.Lock()
+# called with every engine created, for instrumentation
+engine_hooks: List[Callable[[Engine], None]] = []
+
+
+# points the module at a database, the engine is created on first use
+# the current one is dropped even for the same url, so every app gets its own
+# (two in-memory apps would otherwise share one database)
+def configure(url: str = DATABASE_URL):
+    global database_url, _engine
+    with engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+        database_url = url
+
+# runs hook(engine) for the engine, now if there already is one
+def on_engine(hook: Callable[[Engine], None]):
+    engine_hooks.append(hook)
+    if _engine is not None:
+        hook(_engine)
+
+def get_engine() -> Engine:
+    global _engine
+    if _engine is not None:
+        return _engine
+    with engine_lock:
+        if _engine is None:
+            _engine = create_database(database_url)
+            for hook in engine_hooks:
+                hook(_engine)
+    return _engine
+
+# db.engine still works for callers outside this module, and creates the engine when needed
+def __getattr__(name: str):
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def create_database(url: str) -> Engine:
+    if url == "sqlite://" or url.startswith("sqlite:///:memory:"):
+        # one shared connection, otherwise every thread would see its own empty database
+        engine = create_engine(url, echo=False, poolclass=StaticPool, connect_args={"check_same_thread": False})
+    else:
+        if url.startswith("sqlite:///"):
+            # creates the database directory
+            Path(url[len("sqlite:///"):]).parent.mkdir(parents=True, exist_ok=True)
+        # turn echo = True to display the sql output
+        engine = create_engine(url, echo=False)
+    # initializes the database, tables that are new to an existing one are filled from its messages
+    existing_tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+    upgrade_schema(engine, existing_tables)
+    return engine
+
+# create_all only creates missing tables, so columns and indexes added to
+# existing tables are created here for databases made by older versions
+def upgrade_schema(engine: Engine, existing_tables: set):
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        added_columns = [column for column in table.columns if column.name not in existing_columns]
+        with engine.begin() as connection:
+            for column in added_columns:
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column_ddl}'))
+
+        if any(column.name == "seq" for column in added_columns):
+            backfill_seq(engine, table.name)
+
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(engine)
+
+    # a new database has no messages to fill them from
+    if existing_tables and "conversation_counter" not in existing_tables:
+        backfill_counters(engine, "messages")
+        backfill_counters(engine, "group_messages")
+    if existing_tables and "conversation_summary" not in existing_tables:
+        backfill_summaries(engine)
+
+# number the messages stored before the seq column existed,
+# and rebuild the counters so new messages continue from there
+def backfill_seq(engine: Engine, table_name: str):
+    room_column = "room_id" if table_name == "messages" else "group_id"
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"UPDATE {table_name} SET seq = (SELECT COUNT(*) FROM {table_name} AS m "
+            f"WHERE m.{room_column} = {table_name}.{room_column} AND m.id <= {table_name}.id)"))
+    backfill_counters(engine, table_name)
+
+# count the messages of every room, for databases made before conversation_counter existed
+# or whose messages were just numbered, read counts are taken against these
+def backfill_counters(engine: Engine, table_name: str):
+    room_column, offset = ("room_id", 0) if table_name == "messages" else ("group_id", GROUP_ROOM_OFFSET)
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"INSERT OR REPLACE INTO conversation_counter (room_id, message_count, last_message_id) "
+            f"SELECT {room_column} + {offset}, COUNT(*), MAX(id) FROM {table_name} GROUP BY {room_column}"))
+
+# one summary row per participant of every room with messages, as summarize_message would have left it
+# direct messages have no timestamp, those rooms sort after the others until their next message
+def backfill_summaries(engine: Engine):
+    participants = {
+        "messages": ("room_id", 0, "NULL", "0",
+                     "SELECT room_id, user_a AS username, user_b AS title FROM RoomInfo "
+                     "UNION ALL SELECT room_id, user_b, user_a FROM RoomInfo"),
+        "group_messages": ("group_id", GROUP_ROOM_OFFSET, "m.timestamp", "1",
+                           "SELECT group_users.group_id AS room_id, group_users.username, group_chats.name AS title "
+                           "FROM group_users JOIN group_chats ON group_chats.id = group_users.group_id"),
+    }
+    with engine.begin() as connection:
+        for table_name, (room_column, offset, last_at, is_group, members) in participants.items():
+            # unread are the messages of the others after the user's read cursor
+            connection.execute(text(
+                f"INSERT OR IGNORE INTO conversation_summary (username, room_id, title, is_group, "
+                f"last_message_id, last_sender, snippet, last_at, unread_count) "
+                f"SELECT p.username, p.room_id + {offset}, p.title, {is_group}, m.id, m.sender, "
+                f"substr(m.content, 1, {SNIPPET_LENGTH}), {last_at}, "
+                f"(SELECT COUNT(*) FROM {table_name} AS u WHERE u.{room_column} = p.room_id "
+                f"AND u.sender != p.username AND u.id > COALESCE((SELECT c.last_message_id FROM read_cursor AS c "
+                f"WHERE c.username = p.username AND c.room_id = p.room_id + {offset}), 0)) "
+                f"FROM ({members}) AS p JOIN {table_name} AS m "
+                f"ON m.id = (SELECT MAX(id) FROM {table_name} WHERE {room_column} = p.room_id)"))
 
 
 def print_user_friendships(username):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         user = session.query(User).filter_by(username=username).first()
         if not user:
             print(f"User '{username}' not found.")
@@ -43,7 +173,7 @@ def print_user_friendships(username):
             print(f"Friend Username: {friend_username}")
 
 def insert_user(username: str, password: str, role: str = 'student', is_muted: bool = False):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         user = User(username=username, password=password, role=role, is_muted=is_muted)
         user_online = UserOnline(username=username, is_online=False)
         session.add(user)
@@ -52,40 +182,56 @@ def insert_user(username: str, password: str, role: str = 'student', is_muted: b
 
 
 def get_user(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         return session.get(User, username)
 
 
 def get_all_users():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         return session.query(User).all()
 
 def update_user(user):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         session.merge(user)
         session.commit()
 
 
 def get_online_user(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         return session.get(UserOnline, username)
 
+# batch update of online flags, statuses maps username -> is_online
+def set_users_online(statuses: dict):
+    with Session(get_engine()) as session:
+        for is_online in (True, False):
+            usernames = [username for username, online in statuses.items() if online == is_online]
+            if usernames:
+                session.query(UserOnline).filter(UserOnline.username.in_(usernames)) \
+                    .update({UserOnline.is_online: is_online}, synchronize_session=False)
+        session.commit()
+
+# nobody is connected when the server starts, whatever the table says
+def reset_online_users():
+    with Session(get_engine()) as session:
+        session.query(UserOnline).update({UserOnline.is_online: False}, synchronize_session=False)
+        session.commit()
+
 # add roominfo record to the database
 def insert_room(room_id: int, user_a: str, user_b: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         room_info = RoomInfo(room_id=room_id, user_a=user_a, user_b=user_b)
         session.add(room_info)
         try:
             session.commit()
-            print(f"Room {room_id} created with users {user_a} and {user_b}.")
+            logger.info("room created", extra={"room_id": room_id, "users": [user_a, user_b]})
         except Exception as e:
             session.rollback()  # rollback if error occurs
-            print(f"Failed to insert room info: {e}")
+            logger.error("failed to insert room info: %s", e, extra={"room_id": room_id})
         finally:
             session.close()  # ensure the session is properly closed 
 
 def find_room_id_by_users(user_a: str, user_b: str) -> int:
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # use or_ to construct logical OR conditions
         room_info = session.query(RoomInfo).filter(
             or_(
@@ -99,11 +245,19 @@ def find_room_id_by_users(user_a: str, user_b: str) -> int:
         
         return None
 
+# whether the user takes part in a direct message room or, for group_id + GROUP_ROOM_OFFSET, a group
+def is_room_member(username: str, room_id: int) -> bool:
+    if room_id >= GROUP_ROOM_OFFSET:
+        return is_user_in_group(username, room_id - GROUP_ROOM_OFFSET)
+    with Session(get_engine()) as session:
+        room_info = session.get(RoomInfo, room_id)
+        return room_info is not None and username in (room_info.user_a, room_info.user_b)
+
 def find_free_room_id():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # get all existing room IDs, sorted in ascending order
         existing_ids = session.query(RoomInfo.room_id).order_by(RoomInfo.room_id).all()
-        existing_ids = [id[0] for id in existing_ids]  # convert the result to a single list of numbers
+        existing_ids = {id[0] for id in existing_ids}  # a set, so each membership check below is O(1)
 
         # find the first available ID
         free_id = 1
@@ -112,8 +266,75 @@ def find_free_room_id():
 
         return free_id
 
+# bump the per room message counter, in the same transaction as the insert
+# the new count is the seq of the message, the write lock taken by the
+# insert keeps it unique within the room
+# a batch of `count` messages gets the seqs up to and including the new count
+def count_message(session, room_id: int, message_id: int, count: int = 1) -> int:
+    updated = session.query(ConversationCounter).filter(ConversationCounter.room_id == room_id).update({
+        ConversationCounter.message_count: ConversationCounter.message_count + count,
+        ConversationCounter.last_message_id: message_id
+    }, synchronize_session=False)
+    if not updated:
+        session.add(ConversationCounter(room_id=room_id, message_count=count, last_message_id=message_id))
+        return count
+    return session.query(ConversationCounter.message_count).filter(ConversationCounter.room_id == room_id).scalar()
+
+# longest message preview kept in conversation_summary
+SNIPPET_LENGTH = 80
+
+# (username, title, is_group) for everyone taking part in a room
+def conversation_participants(session, room_id: int) -> list:
+    if room_id >= GROUP_ROOM_OFFSET:
+        group = session.get(GroupChat, room_id - GROUP_ROOM_OFFSET)
+        if group is None:
+            return []
+        members = session.query(GroupUser.username).filter(GroupUser.group_id == group.id).all()
+        return [(member.username, group.name, True) for member in members]
+
+    room_info = session.get(RoomInfo, room_id)
+    if room_info is None:
+        return []
+    return [(room_info.user_a, room_info.user_b, False), (room_info.user_b, room_info.user_a, False)]
+
+# refresh the summary rows of everyone in the room, in the same transaction as the insert
+# the rows of a room are created by its first message
+# for a batch, pass the last message and the number of messages in it
+def summarize_message(session, room_id: int, message_id: int, sender: str, content: str, count: int = 1):
+    now = datetime.utcnow()
+    snippet = (content or "")[:SNIPPET_LENGTH]
+    updated = session.query(ConversationSummary).filter(ConversationSummary.room_id == room_id).update({
+        ConversationSummary.last_message_id: message_id,
+        ConversationSummary.last_sender: sender,
+        ConversationSummary.snippet: snippet,
+        ConversationSummary.last_at: now,
+        ConversationSummary.unread_count: ConversationSummary.unread_count
+            + case((ConversationSummary.username != sender, count), else_=0)
+    }, synchronize_session=False)
+    if updated:
+        return
+
+    for username, title, is_group in conversation_participants(session, room_id):
+        session.add(ConversationSummary(
+            username=username, room_id=room_id, title=title, is_group=is_group,
+            last_message_id=message_id, last_sender=sender, snippet=snippet, last_at=now,
+            unread_count=0 if username == sender else count
+        ))
+
+# a user joining a group that already has messages gets its summary row too
+def add_summary_member(session, room_id: int, username: str):
+    latest = session.query(ConversationSummary).filter(ConversationSummary.room_id == room_id).first()
+    if latest is None or session.get(ConversationSummary, (username, room_id)) is not None:
+        return
+    session.add(ConversationSummary(
+        username=username, room_id=room_id, title=latest.title, is_group=latest.is_group,
+        last_message_id=latest.last_message_id, last_sender=latest.last_sender,
+        snippet=latest.snippet, last_at=latest.last_at, unread_count=0
+    ))
+
+# returns (id, seq) of the new message, or None if it could not be stored
 def insert_message(room_id: int, sender: str, content: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # create a message instance
         message = Message(room_id=room_id, sender=sender, content=content)
         
@@ -122,18 +343,45 @@ def insert_message(room_id: int, sender: str, content: str):
         
         # commit the sessino to the database
         try:
+            session.flush()
+            message.seq = count_message(session, room_id, message.id)
+            summarize_message(session, room_id, message.id, sender, content)
+            message_key = (message.id, message.seq)
             session.commit()
-            print(f"Message added: {sender}: {content} in room {room_id}")
+            message_log.info("message stored", extra={"room_id": room_id, "sender": sender, "message_id": message.id})
+            return message_key
         except Exception as e:
             #roll back if error
             session.rollback()
-            print(f"Failed to insert message: {e}")
+            logger.error("failed to insert message: %s", e, extra={"room_id": room_id, "sender": sender})
         finally:
             # close the session
             session.close()
 
+# stores several messages from one sender in one transaction
+# returns [(id, seq), ...] in the order given, or None if they could not be stored
+def insert_messages(room_id: int, sender: str, contents: list):
+    with Session(get_engine()) as session:
+        messages = [Message(room_id=room_id, sender=sender, content=content) for content in contents]
+        session.add_all(messages)
+        try:
+            session.flush()
+            total = count_message(session, room_id, messages[-1].id, len(messages))
+            for i, message in enumerate(messages):
+                message.seq = total - len(messages) + 1 + i
+            summarize_message(session, room_id, messages[-1].id, sender, contents[-1], len(messages))
+            message_keys = [(message.id, message.seq) for message in messages]
+            session.commit()
+            message_log.info("messages stored", extra={"room_id": room_id, "sender": sender, "count": len(messages)})
+            return message_keys
+        except Exception as e:
+            session.rollback()
+            logger.error("failed to insert messages: %s", e, extra={"room_id": room_id, "sender": sender})
+        finally:
+            session.close()
+
 def get_all_messages():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # query all records in the messages table
         messages = session.query(Message).all()
 
@@ -150,13 +398,24 @@ def get_all_messages():
         # Return a list of detailed information for all messages
         return all_messages
 
-def get_messages_by_room_id(room_id: int) -> list:
-    with Session(engine) as session:
+# oldest first, limited to the most recent `limit` messages if given
+def get_messages_by_room_id(room_id: int, limit: int = None) -> list:
+    with Session(get_engine()) as session:
         # query all messages for the specified room_id
-        messages = session.query(Message.sender, Message.content).filter(Message.room_id == room_id).all()
+        query = session.query(Message.id, Message.seq, Message.sender, Message.content).filter(Message.room_id == room_id)
+        if limit is None:
+            return query.order_by(Message.id).all()
+
+        # messages is already a list containing many tuples, each tuple containing (id, seq, sender, content)
+        messages = query.order_by(Message.id.desc()).limit(limit).all()
+        return messages[::-1]
 
-        # messages is already a list containing many tuples, each tuple containing (sender, content)
-        return messages
+# messages with a seq above after_seq, oldest first, at most `limit` of them
+def get_messages_since(room_id: int, after_seq: int, limit: int) -> list:
+    with Session(get_engine()) as session:
+        return session.query(Message.id, Message.seq, Message.sender, Message.content).filter(
+            Message.room_id == room_id, Message.seq > after_seq
+        ).order_by(Message.seq).limit(limit).all()
 
 
 
@@ -176,7 +435,7 @@ def drop_all_tables(database_url: str):
     print("all tables have been successfully deleted.")
 
 def print_all_users():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # query all records in the user table
         users = session.query(User).all()
         # Iterate through each user object and print its detailed information
@@ -185,7 +444,7 @@ def print_all_users():
 
 
 def get_all_room_info():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # query all records in the roominfo table
         rooms = session.query(RoomInfo).all()
 
@@ -195,9 +454,9 @@ def get_all_room_info():
         return rooms
 
 def drop_room_info_table():
-    with engine.begin() as connection:
+    with get_engine().begin() as connection:
         # directly delete the roominfo table
-        RoomInfo.__table__.drop(bind=engine, checkfirst=True)
+        RoomInfo.__table__.drop(bind=get_engine(), checkfirst=True)
         print("RoomInfo tabSle has been dropped.")
 
 def view_tables():
@@ -229,12 +488,9 @@ def view_tables():
 ##############################################################################
 
 def send_friend_request(sender_username: str, receiver_username: str):
-    print(f"sender:{sender_username}")
-    print(f"receiver:{receiver_username}")
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # check if the recipient exists
         receiver = session.get(User, receiver_username)
-        print(receiver)
         if not receiver:
             return "Receiver does not exist."
     
@@ -251,9 +507,9 @@ def send_friend_request(sender_username: str, receiver_username: str):
         session.add(new_request)
         try:
             session.commit()
-            print("Friend request successfully added.")
+            logger.info("friend request sent", extra={"sender": sender_username, "receiver": receiver_username})
         except Exception as e:
-            print(f"Failed to insert friend request: {e}")
+            logger.error("failed to insert friend request: %s", e, extra={"sender": sender_username, "receiver": receiver_username})
             session.rollback()
         session.commit()
         
@@ -261,7 +517,7 @@ def send_friend_request(sender_username: str, receiver_username: str):
 
 
 def add_friend(user_username, friend_username):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # check if they are already friends
         existing_friendship = session.query(Friendship).filter(
             ((Friendship.user_username == user_username) & (Friendship.friend_username == friend_username)) |
@@ -278,7 +534,7 @@ def add_friend(user_username, friend_username):
         return "Friend added successfully."
     
 def db_remove_friend(user_username, friend_username):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
 
         friendships = session.query(Friendship).filter(
             or_(
@@ -315,7 +571,7 @@ def can_join_chatroom(username1, username2):
         return bool(friendship)  # return true if the friendship is found
 
 def get_friend_requests_for_user(username: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # query all friend requests sent to the specified user
         friend_requests = session.query(FriendRequest).filter(
             or_(
@@ -329,7 +585,7 @@ def get_friend_requests_for_user(username: str):
 
 
 def are_friends(user1: str, user2: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # check if the two users are friends
         friendship = session.query(Friendship).filter(
             or_(
@@ -340,7 +596,7 @@ def are_friends(user1: str, user2: str):
         return friendship is not None
     
 def print_all_friend_requests():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         friend_requests = session.query(FriendRequest).all()
         print("All Friend Requests:")
         for request in friend_requests:
@@ -349,14 +605,26 @@ def print_all_friend_requests():
 from sqlalchemy.engine.reflection import Inspector
 
 def print_table_names():
-    inspector = Inspector.from_engine(engine)
+    inspector = Inspector.from_engine(get_engine())
     table_names = inspector.get_table_names()
     print("All table names in the database:")
     for name in table_names:
         print(name)
 
+def get_friend_request(request_id: int):
+    with Session(get_engine()) as session:
+        return session.get(FriendRequest, request_id)
+
+def find_pending_friend_request(sender_username: str, receiver_username: str):
+    with Session(get_engine()) as session:
+        return session.query(FriendRequest).filter(
+            (FriendRequest.sender_id == sender_username) &
+            (FriendRequest.receiver_id == receiver_username) &
+            (FriendRequest.status == RequestStatus.PENDING.value)
+        ).first()
+
 def update_friend_request_status(request_id: int, new_status: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         try:
             # find the friend request record by ID
             friend_request = session.query(FriendRequest).filter(FriendRequest.id == request_id).first()
@@ -378,13 +646,13 @@ def update_friend_request_status(request_id: int, new_status: str):
                     new_friendship2 = Friendship(user_username=friend_request.receiver_id, friend_username=friend_request.sender_id)
                     session.add(new_friendship1)
                     session.add(new_friendship2)
-                    print(f"We are friends: {new_friendship1.user_username} <--> {new_friendship2.user_username}")
+                    logger.info("friendship created", extra={"users": [new_friendship1.user_username, new_friendship2.user_username]})
 
             session.commit()
             return True, "Friend request status updated successfully."
         except SQLAlchemyError as e:
             session.rollback()
-            print(f"Error updating friend request status: {e}")
+            logger.error("error updating friend request status: %s", e, extra={"request_id": request_id})
             return False, "Error occurred during the update."
 
 # def get_friends_for_user(username: str):
@@ -392,7 +660,7 @@ def update_friend_request_status(request_id: int, new_status: str):
 #     print(username)
 #     print(online_user.get_online())
 #     online_user.set_online(True)
-#     with Session(engine) as session:
+#     with Session(get_engine()) as session:
 #         # check friendship
 #         friendships = session.query(Friendship).filter(
 #             (Friendship.user_username == username)
@@ -410,11 +678,7 @@ def update_friend_request_status(request_id: int, new_status: str):
 #         return friends
 
 def get_friends_for_user(username: str):
-    online_user = get_online_user(username)
-    print(username)
-    print(online_user.get_online())
-    online_user.set_online(True)
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # check friendship
         friendships = session.query(Friendship).filter(
             (Friendship.user_username == username)
@@ -431,12 +695,30 @@ def get_friends_for_user(username: str):
                     'is_online': friend.is_online,
                     'role': user_info.role  # Add role here
                 })
-        print("Friends and their online status:", friends)
         return friends
 
 
+def get_friend_usernames(username: str) -> list:
+    with Session(get_engine()) as session:
+        friendships = session.query(Friendship.friend_username).filter(Friendship.user_username == username).all()
+        return [friendship.friend_username for friendship in friendships]
+
+# a single friend list entry, in the same shape as get_friends_for_user
+def get_friend_entry(username: str):
+    with Session(get_engine()) as session:
+        user_info = session.get(User, username)
+        if user_info is None:
+            return None
+        online_user = session.get(UserOnline, username)
+        return {
+            "username": username,
+            'is_online': online_user.is_online if online_user else False,
+            'role': user_info.role
+        }
+
+
 def print_all_friends():
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         # retrieve all users
         users = session.query(User).all()
 
@@ -456,18 +738,18 @@ def print_all_friends():
 
 #=================================
 def insert_article(title: str, content: str, author: str, publish_date: datetime):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         article = Article(title=title, content=content, author=author, publish_date=publish_date)
         session.add(article)
         session.commit()
 
 
 def get_all_articles():
-    with Session(engine) as session:  
+    with Session(get_engine()) as session:  
         return session.query(Article).all()
 
 def get_article_by_id(article_id):
-    with Session(engine) as session: 
+    with Session(get_engine()) as session: 
         article = session.query(Article).get(article_id)
         if article is None:
            
@@ -476,7 +758,7 @@ def get_article_by_id(article_id):
 
 
 def delete_article(article_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         try:
 
             article = session.query(Article).filter_by(id=article_id).one()
@@ -488,17 +770,17 @@ def delete_article(article_id: int):
 
             session.delete(article)
             session.commit()
-            print(f"Article ID {article_id} and its comments deleted successfully.")
+            logger.info("article deleted", extra={"article_id": article_id})
         except SQLAlchemyError as e:
             session.rollback()
-            print(f"Failed to delete article and its comments: {e}")
+            logger.error("failed to delete article and its comments: %s", e, extra={"article_id": article_id})
         finally:
             session.close()  
 
 
 
 def edit_article(article_id: int, title: str, content: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         article = session.get(Article, article_id)
         if article:
             article.title = title
@@ -506,7 +788,7 @@ def edit_article(article_id: int, title: str, content: str):
             session.commit()
 
 def add_comment(article_id: int, commenter: str, content: str) -> int:
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         comment = Comment(article_id=article_id, commenter=commenter, content=content, comment_date=datetime.now())
         session.add(comment)
         session.commit()
@@ -514,17 +796,17 @@ def add_comment(article_id: int, commenter: str, content: str) -> int:
 
 
 def get_comments_by_article_id(article_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         comments = session.query(Comment).filter(Comment.article_id == article_id).all()
         return comments
 
 
 def get_comment_by_id(comment_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         return session.get(Comment, comment_id)
 
 def delete_comment(comment_id: int):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         comment = session.get(Comment, comment_id)
         if comment:
             session.delete(comment)
@@ -535,14 +817,14 @@ def delete_comment(comment_id: int):
 ##########
 
 def is_user_muted(username):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         user = session.get(User, username)
         return user.is_muted if user else False
 
 
 def create_group(group_name,creator_username, usernames):
     try:
-        with Session(engine) as session:
+        with Session(get_engine()) as session:
             group_chat = GroupChat(name=group_name)
             session.add(group_chat)
             session.commit()
@@ -558,14 +840,14 @@ def create_group(group_name,creator_username, usernames):
             return {"message": "Group created successfully", "group_id": group_chat.id}
     except Exception as e:
         session.rollback()
-        print(f"Error in create_group: {e}")
+        logger.error("error in create_group: %s", e)
         return {"error": str(e)}
     finally:
         session.close()
 
 def get_groups_for_user(username):
     try:
-        session = Session(engine)
+        session = Session(get_engine())
         groups = session.query(GroupChat).join(GroupUser).filter(GroupUser.username == username).all()
         group_list = []
         for group in groups:
@@ -577,44 +859,94 @@ def get_groups_for_user(username):
             })
         return group_list
     except Exception as e:
-        print(f"Error in get_groups_for_user: {e}")
+        logger.error("error in get_groups_for_user: %s", e)
         return []
     finally:
         session.close()
 
+def get_group(group_id):
+    with Session(get_engine()) as session:
+        return session.get(GroupChat, group_id)
+
+def add_group_user(group_id, username):
+    with Session(get_engine()) as session:
+        group_user = GroupUser(group_id=group_id, username=username)
+        session.add(group_user)
+        add_summary_member(session, group_id + GROUP_ROOM_OFFSET, username)
+        session.commit()
+
 def create_group_message(group_id, sender, message):
     try:
-        session = Session(engine)
+        session = Session(get_engine())
         group_message = GroupMessage(group_id=group_id, sender=sender, content=message)
         session.add(group_message)
         session.commit()
     except Exception as e:
         session.rollback()
-        print(f"Error in create_group_message: {e}")
+        logger.error("error in create_group_message: %s", e)
     finally:
         session.close()
 
-def get_group_messages(group_id):
-    with Session(engine) as session:
-        messages = session.query(GroupMessage).filter_by(group_id=group_id).all()
-        return messages
+# oldest first, limited to the most recent `limit` messages if given
+def get_group_messages(group_id, limit: int = None):
+    with Session(get_engine()) as session:
+        query = session.query(GroupMessage).filter_by(group_id=group_id)
+        if limit is None:
+            return query.order_by(GroupMessage.id).all()
+        messages = query.order_by(GroupMessage.id.desc()).limit(limit).all()
+        return messages[::-1]
 
+# group messages with a seq above after_seq, oldest first, at most `limit` of them
+def get_group_messages_since(group_id, after_seq: int, limit: int) -> list:
+    with Session(get_engine()) as session:
+        return session.query(GroupMessage).filter(
+            GroupMessage.group_id == group_id, GroupMessage.seq > after_seq
+        ).order_by(GroupMessage.seq).limit(limit).all()
 
+
+# returns (id, seq) of the new message, or None if it could not be stored
 def insert_group_message(group_id: int, sender: str, content: str):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         group_message = GroupMessage(group_id=group_id, sender=sender, content=content)
         session.add(group_message)
         try:
+            session.flush()
+            group_message.seq = count_message(session, group_id + GROUP_ROOM_OFFSET, group_message.id)
+            summarize_message(session, group_id + GROUP_ROOM_OFFSET, group_message.id, sender, content)
+            message_key = (group_message.id, group_message.seq)
             session.commit()
-            print(f"Group message added: {sender}: {content} in group {group_id}")
+            message_log.info("group message stored", extra={"group_id": group_id, "sender": sender, "message_id": group_message.id})
+            return message_key
         except Exception as e:
             session.rollback()
-            print(f"Failed to insert group message: {e}")
+            logger.error("failed to insert group message: %s", e, extra={"group_id": group_id, "sender": sender})
+        finally:
+            session.close()
+
+# like insert_messages, for a group
+def insert_group_messages(group_id: int, sender: str, contents: list):
+    with Session(get_engine()) as session:
+        group_messages = [GroupMessage(group_id=group_id, sender=sender, content=content) for content in contents]
+        session.add_all(group_messages)
+        try:
+            session.flush()
+            room_id = group_id + GROUP_ROOM_OFFSET
+            total = count_message(session, room_id, group_messages[-1].id, len(group_messages))
+            for i, group_message in enumerate(group_messages):
+                group_message.seq = total - len(group_messages) + 1 + i
+            summarize_message(session, room_id, group_messages[-1].id, sender, contents[-1], len(group_messages))
+            message_keys = [(group_message.id, group_message.seq) for group_message in group_messages]
+            session.commit()
+            message_log.info("group messages stored", extra={"group_id": group_id, "sender": sender, "count": len(group_messages)})
+            return message_keys
+        except Exception as e:
+            session.rollback()
+            logger.error("failed to insert group messages: %s", e, extra={"group_id": group_id, "sender": sender})
         finally:
             session.close()
 
 def is_user_in_group(username, group_id):
-    with Session(engine) as session:
+    with Session(get_engine()) as session:
         group_user = session.query(GroupUser).filter_by(username=username, group_id=group_id).first()
         return group_user is not None
     
@@ -623,7 +955,7 @@ def add_member_to_group(group_id, owner_username, new_member_username):
         return {"error": "Only group owners can add new members"}
 
     try:
-        with Session(engine) as session:
+        with Session(get_engine()) as session:
 
             new_member = session.query(User).filter_by(username=new_member_username).first()
             if not new_member:
@@ -637,11 +969,12 @@ def add_member_to_group(group_id, owner_username, new_member_username):
 
             new_member = GroupUser(group_id=group_id, username=new_member_username)
             session.add(new_member)
+            add_summary_member(session, group_id + GROUP_ROOM_OFFSET, new_member_username)
             session.commit()
             return {"message": "New member added successfully"}
     except Exception as e:
         session.rollback()
-        print(f"Error in add_member_to_group: {e}")
+        logger.error("error in add_member_to_group: %s", e)
         return {"error": str(e)}
     finally:
         session.close()
@@ -651,7 +984,7 @@ def remove_member_from_group(group_id, owner_username, remove_member_username):
         return {"error": "Only group owners can remove members"}
 
     try:
-        with Session(engine) as session:
+        with Session(get_engine()) as session:
 
             existing_member = session.query(GroupUser).filter_by(group_id=group_id, username=remove_member_username).first()
             if not existing_member:
@@ -659,22 +992,94 @@ def remove_member_from_group(group_id, owner_username, remove_member_username):
 
 
             session.delete(existing_member)
+            session.query(ConversationSummary).filter(
+                ConversationSummary.username == remove_member_username,
+                ConversationSummary.room_id == group_id + GROUP_ROOM_OFFSET
+            ).delete(synchronize_session=False)
             session.commit()
             return {"message": "Member removed successfully"}
     except Exception as e:
         session.rollback()
-        print(f"Error in remove_member_from_group: {e}")
+        logger.error("error in remove_member_from_group: %s", e)
         return {"error": str(e)}
     finally:
         session.close()
 
 def is_user_owner_of_group(username, group_id):
     try:
-        session = Session(engine)
+        session = Session(get_engine())
         owner = session.query(GroupUser).filter_by(group_id=group_id, username=username, is_owner=True).first()
         return owner is not None
     except Exception as e:
-        print(f"Error in is_user_owner_of_group: {e}")
+        logger.error("error in is_user_owner_of_group: %s", e)
         return False
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+##############################################################################
+# read cursors
+##############################################################################
+
+# cursors maps (username, room_id) -> last read message id, written in one transaction
+def save_read_cursors(cursors: dict):
+    with Session(get_engine()) as session:
+        try:
+            for (username, room_id), last_message_id in cursors.items():
+                cursor = session.get(ReadCursor, (username, room_id))
+                if cursor is None:
+                    cursor = ReadCursor(username=username, room_id=room_id, last_message_id=0, read_count=0)
+                    session.add(cursor)
+                elif cursor.last_message_id >= last_message_id:
+                    continue
+
+                counter = session.get(ConversationCounter, room_id)
+                if counter is None:
+                    continue
+                # only the few messages sent after the cursor are counted, via the room index
+                # the user's own ones are not unread for the summary, like in summarize_message
+                if room_id >= GROUP_ROOM_OFFSET:
+                    newer, newer_own = session.query(
+                        func.count(GroupMessage.id), func.count(case((GroupMessage.sender == username, 1)))
+                    ).filter(GroupMessage.group_id == room_id - GROUP_ROOM_OFFSET, GroupMessage.id > last_message_id).one()
+                else:
+                    newer, newer_own = session.query(
+                        func.count(Message.id), func.count(case((Message.sender == username, 1)))
+                    ).filter(Message.room_id == room_id, Message.id > last_message_id).one()
+                cursor.last_message_id = last_message_id
+                cursor.read_count = counter.message_count - newer
+                session.query(ConversationSummary).filter(
+                    ConversationSummary.username == username, ConversationSummary.room_id == room_id
+                ).update({ConversationSummary.unread_count: newer - newer_own}, synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error("failed to save read cursors: %s", e, extra={"count": len(cursors)})
+
+# room_id -> (unread count, last message id) for the given rooms of a user
+def get_unread_counts(username: str, room_ids: list) -> dict:
+    if not room_ids:
+        return {}
+    with Session(get_engine()) as session:
+        counters = session.query(ConversationCounter).filter(ConversationCounter.room_id.in_(room_ids)).all()
+        cursors = session.query(ReadCursor).filter(
+            ReadCursor.username == username, ReadCursor.room_id.in_(room_ids)).all()
+        read_counts = {cursor.room_id: cursor.read_count for cursor in cursors}
+        return {
+            counter.room_id: (counter.message_count - read_counts.get(counter.room_id, 0), counter.last_message_id)
+            for counter in counters
+        }
+
+# other user -> direct message room id, for every room the user is part of
+def get_rooms_for_user(username: str) -> dict:
+    with Session(get_engine()) as session:
+        rooms = session.query(RoomInfo).filter(or_(RoomInfo.user_a == username, RoomInfo.user_b == username)).all()
+        return {(room.user_b if room.user_a == username else room.user_a): room.room_id for room in rooms}
+
+# one page of a user's conversations, most recently active first
+# returns (summaries, has_more)
+def get_conversation_summaries(username: str, page: int, per_page: int):
+    with Session(get_engine()) as session:
+        summaries = session.query(ConversationSummary).filter(ConversationSummary.username == username) \
+            .order_by(ConversationSummary.last_at.desc()) \
+            .offset(page * per_page).limit(per_page + 1).all()
+        return summaries[:per_page], len(summaries) > per_page
@@ -0,0 +1,67 @@
+'''
+json_codec
+one JSON codec for both Flask responses (app.json) and Socket.IO packets
+backed by orjson when it is installed, the standard json module otherwise
+either way datetimes are written as ISO 8601 strings, so routes can return them as they are
+'''
+
+from datetime import date, datetime
+from decimal import Decimal
+import json
+import uuid
+
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# types neither codec handles on its own
+def default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    # orjson only takes str keys unless told otherwise, the standard module takes ints too
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(obj) -> bytes:
+        return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+else:
+    def dumps_bytes(obj) -> bytes:
+        return json.dumps(obj, default=default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    def loads(s, **kwargs):
+        return json.loads(s)
+
+
+# python-socketio and python-engineio pass the standard module's keyword arguments
+# (separators and so on), the output is always compact so they are ignored
+def dumps(obj, **kwargs) -> str:
+    return dumps_bytes(obj).decode("utf-8")
+
+
+class FastJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    # skip the str round trip, the response body is the encoded bytes
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_bytes(obj), mimetype="application/json")
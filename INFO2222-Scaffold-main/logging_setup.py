@@ -0,0 +1,128 @@
+'''
+logging_setup
+structured (one JSON object per line) logging for the whole app
+records are put on a queue by the caller and written to stdout by a listener thread,
+so a handler never blocks on I/O, and the noisiest loggers can be sampled
+
+configured through the environment:
+    LOG_LEVEL=INFO                              level of every logger not listed below
+    LOG_LEVELS=db=WARNING,socket_routes=DEBUG   per module levels
+    LOG_SAMPLE=db.messages=0.01                 share of INFO and lower records kept per logger
+'''
+
+from typing import Dict
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+import json_codec
+
+# high volume loggers, only this share of their records below WARNING is written
+DEFAULT_SAMPLE_RATES = {
+    "db.messages": 0.01,
+}
+
+# attributes every LogRecord has, anything else was passed through extra= and is logged as a field
+STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json_codec.dumps(entry)
+
+
+# the stock QueueHandler flattens the traceback into the message before queueing,
+# this keeps it apart so the formatter can write it as its own field
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# keeps one in every 1 / rate records of the sampled loggers, deterministically
+# warnings and errors always get through
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.every = {name: max(1, round(1 / rate)) for name, rate in rates.items() if rate > 0}
+        self.dropped_all = {name for name, rate in rates.items() if rate <= 0}
+        self.seen: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if record.name in self.dropped_all:
+            return False
+        every = self.every.get(record.name)
+        if every is None or every == 1:
+            return True
+        with self.lock:
+            seen = self.seen.get(record.name, 0)
+            self.seen[record.name] = seen + 1
+        if seen % every:
+            return False
+        record.sample_rate = 1 / every
+        return True
+
+
+def parse_pairs(value: str) -> Dict[str, str]:
+    pairs = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            pairs[name.strip()] = setting.strip()
+    return pairs
+
+
+listener = None
+
+def setup_logging():
+    global listener
+    if listener is not None:
+        return
+
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    for name, level in parse_pairs(os.environ.get("LOG_LEVELS", "")).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    rates.update({name: float(rate) for name, rate in parse_pairs(os.environ.get("LOG_SAMPLE", "")).items()})
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+
+    records = queue.SimpleQueue()
+    handler = StructuredQueueHandler(records)
+    # sampling happens before the record is queued, so dropped records cost next to nothing
+    handler.addFilter(SamplingFilter(rates))
+    root.handlers = [handler]
+
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    # write out whatever is still queued when the process exits
+    atexit.register(listener.stop)
@@ -0,0 +1,130 @@
+'''
+memwatch
+memory growth tracking for soak tests
+a tracemalloc snapshot taken as the baseline is compared with later ones to find the allocation
+sites that keep growing, next to the resident set size and the sizes of the in-memory state
+(rooms, sockets, caches) that is expected to shrink back once everyone disconnected
+tracemalloc makes every allocation slower, so it only runs between start() and stop()
+'''
+
+from typing import Callable, Dict, Optional
+import gc
+import logging
+import os
+import threading
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# frames stored per allocation, enough to see which handler a site was reached from
+FRAMES = 10
+TOP = 20
+
+# name -> (collect, whether it counts things that belong to a connection)
+# collect returns a number or a dict of numbers
+watched: Dict[str, tuple] = {}
+
+lock = threading.Lock()
+baseline: Optional[dict] = None
+baseline_snapshot: Optional[tracemalloc.Snapshot] = None
+
+
+# connection=True marks state that must be back at its baseline once every client disconnected,
+# caches and buffers that are allowed to fill up to their caps are left False
+def watch(name: str, collect: Callable, connection: bool = False):
+    watched[name] = (collect, connection)
+
+
+# current resident set size, from /proc where there is one, otherwise None
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# the watched state flattened to "name.key" -> number, split into connection bound and the rest
+def state() -> dict:
+    result = {"connection": {}, "other": {}}
+    for name, (collect, connection) in watched.items():
+        try:
+            value = collect()
+        except Exception:
+            logger.exception("could not collect watched state", extra={"name": name})
+            continue
+        values = {f"{name}.{key}": v for key, v in value.items()} if isinstance(value, dict) else {name: value}
+        result["connection" if connection else "other"].update(
+            (key, v) for key, v in values.items() if isinstance(v, (int, float)))
+    return result
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    # garbage that is only waiting for a collection is not growth
+    gc.collect()
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+
+def summary() -> dict:
+    traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (None, None)
+    return {
+        "tracing": tracemalloc.is_tracing(),
+        "rss_bytes": rss_bytes(),
+        "traced_bytes": traced,
+        "peak_traced_bytes": peak,
+        "state": state(),
+    }
+
+
+# starts tracing if it is not running yet and makes the current memory the baseline
+def start(frames: int = FRAMES) -> dict:
+    global baseline, baseline_snapshot
+    with lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        baseline_snapshot = take_snapshot()
+        baseline = summary()
+        baseline["traced_bytes"] = sum(stat.size for stat in baseline_snapshot.statistics("filename"))
+    logger.info("memory baseline taken", extra={"rss_bytes": baseline["rss_bytes"],
+                                                "traced_bytes": baseline["traced_bytes"]})
+    return baseline
+
+
+def stop():
+    global baseline, baseline_snapshot
+    with lock:
+        baseline = baseline_snapshot = None
+        tracemalloc.stop()
+
+
+# memory now against the baseline, with the top allocation sites by growth
+# group is "lineno" for single lines or "traceback" for whole call chains
+def report(top: int = TOP, group: str = "lineno") -> dict:
+    with lock:
+        result = {**summary(), "baseline": baseline, "top": []}
+        if baseline_snapshot is None or not tracemalloc.is_tracing():
+            return result
+        snapshot = take_snapshot()
+        result["traced_bytes"] = sum(stat.size for stat in snapshot.statistics("filename"))
+        # compare_to orders by the size of the change either way, only growth is of interest here
+        growth = sorted(snapshot.compare_to(baseline_snapshot, group), key=lambda stat: stat.size_diff, reverse=True)
+        for stat in growth[:top]:
+            if stat.size_diff <= 0:
+                break
+            frame = stat.traceback[-1]
+            result["top"].append({
+                "site": f"{frame.filename}:{frame.lineno}",
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+                "size": stat.size,
+                "count": stat.count,
+                # innermost frame last, like a Python traceback
+                "traceback": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+            })
+    return result
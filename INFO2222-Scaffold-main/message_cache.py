@@ -0,0 +1,165 @@
+'''
+message_cache
+ring buffers with the most recent messages of the busiest rooms and groups,
+filled by the send path so opening a chat is usually served without touching SQLite
+group chats are keyed by their room id, group_id + GROUP_ROOM_OFFSET, like everywhere else
+'''
+
+from collections import OrderedDict, deque
+from typing import Dict, NamedTuple
+import sys
+import threading
+
+# messages kept per room, a bit more than one history page
+CACHE_ROOM_SIZE = 100
+# rough upper bound of the memory used by all buffers together
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+
+class CachedMessage(NamedTuple):
+    id: int
+    seq: int
+    sender: str
+    content: str
+
+    # content and sender strings plus the tuple itself
+    def size(self) -> int:
+        return sys.getsizeof(self.content) + sys.getsizeof(self.sender) + 120
+
+    @classmethod
+    def from_row(cls, row) -> "CachedMessage":
+        return cls(row.id, row.seq, row.sender, row.content)
+
+
+class RoomBuffer():
+    def __init__(self, messages: list, room_size: int):
+        self.messages = deque(messages, maxlen=room_size)
+        # the buffer was seeded with fewer messages than it can hold,
+        # so it still has the whole history of the room
+        self.complete = len(messages) < room_size
+        self.bytes = sum(message.size() for message in messages)
+
+
+class MessageCache():
+    def __init__(self, room_size: int = CACHE_ROOM_SIZE, max_bytes: int = CACHE_MAX_BYTES):
+        self.room_size = room_size
+        self.max_bytes = max_bytes
+
+        # least recently used rooms first
+        self.rooms: "OrderedDict[int, RoomBuffer]" = OrderedDict()
+        # room id -> messages appended while a miss reads the room from the database,
+        # they may be newer than what it read and are added once it seeds the buffer
+        self.loading: Dict[int, list] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # the latest `limit` messages of a room, oldest first
+    # load(n) reads the latest n messages from the database and is only called on a miss
+    def get_latest(self, room_id: int, limit: int, load) -> list:
+        with self.lock:
+            buffer = self.rooms.get(room_id)
+            if buffer is not None and (len(buffer.messages) >= limit or buffer.complete):
+                self.hits += 1
+                self.rooms.move_to_end(room_id)
+                return list(buffer.messages)[-limit:] if limit else []
+            self.misses += 1
+            # only the first miss seeds the room, concurrent ones just read
+            seeding = room_id not in self.loading
+            if seeding:
+                self.loading[room_id] = []
+
+        messages = [CachedMessage.from_row(row) for row in load(self.room_size)]
+        if seeding:
+            with self.lock:
+                appended = self.loading.pop(room_id, None)
+                if appended is not None and room_id not in self.rooms:
+                    self.seed(room_id, messages, appended)
+        return messages[-limit:] if limit else []
+
+    # a message stored after load() read the room was appended to self.loading meanwhile,
+    # those the load did not see go on top, a room whose tail does not line up is left unseeded
+    def seed(self, room_id: int, messages: list, appended: list):
+        last_seq = messages[-1].seq if messages else 0
+        newer = sorted((message for message in appended if message.seq > last_seq), key=lambda message: message.seq)
+        if any(message.seq != last_seq + i + 1 for i, message in enumerate(newer)):
+            return
+        buffer = RoomBuffer(messages, self.room_size)
+        self.rooms[room_id] = buffer
+        self.bytes += buffer.bytes
+        for message in newer:
+            self.push(buffer, message)
+        self.evict()
+
+    # up to `limit` messages with a seq above after_seq, oldest first
+    # load(after_seq, limit) reads them from the database when the buffer does not reach back far enough
+    def get_since(self, room_id: int, after_seq: int, limit: int, load) -> list:
+        with self.lock:
+            buffer = self.rooms.get(room_id)
+            if buffer is not None and (buffer.complete or (buffer.messages and buffer.messages[0].seq <= after_seq + 1)):
+                self.hits += 1
+                self.rooms.move_to_end(room_id)
+                return [message for message in buffer.messages if message.seq > after_seq][:limit]
+            self.misses += 1
+        return [CachedMessage.from_row(row) for row in load(after_seq, limit)]
+
+    # called by the send path once the message is stored
+    # rooms that are not cached are left alone, they are seeded on their next read
+    def append(self, room_id: int, message: CachedMessage):
+        with self.lock:
+            buffer = self.rooms.get(room_id)
+            if buffer is None:
+                if room_id in self.loading:
+                    self.loading[room_id].append(message)
+                return
+            # a gap means a concurrent insert was missed, drop the room and reseed it later
+            if buffer.messages and message.seq != buffer.messages[-1].seq + 1:
+                self.drop(room_id)
+                return
+            self.push(buffer, message)
+            self.rooms.move_to_end(room_id)
+            self.evict()
+
+    def push(self, buffer: RoomBuffer, message: CachedMessage):
+        if len(buffer.messages) == buffer.messages.maxlen:
+            buffer.bytes -= buffer.messages[0].size()
+            self.bytes -= buffer.messages[0].size()
+            # the oldest message falls out, older history has to come from the database now
+            buffer.complete = False
+        buffer.messages.append(message)
+        buffer.bytes += message.size()
+        self.bytes += message.size()
+
+    # forget every room, e.g. when the database behind them changes
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+            self.loading.clear()
+            self.bytes = 0
+
+    def drop(self, room_id: int):
+        buffer = self.rooms.pop(room_id, None)
+        if buffer is not None:
+            self.bytes -= buffer.bytes
+
+    # evict the coldest rooms until the cache fits its memory cap again
+    def evict(self):
+        while self.bytes > self.max_bytes and len(self.rooms) > 1:
+            _, buffer = self.rooms.popitem(last=False)
+            self.bytes -= buffer.bytes
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "rooms": len(self.rooms),
+                "messages": sum(len(buffer.messages) for buffer in self.rooms.values()),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
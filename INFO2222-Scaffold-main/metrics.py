@@ -0,0 +1,196 @@
+'''
+metrics
+in-process counters, latency histograms and gauges, served in the Prometheus text format
+recording is a dict lookup and a couple of additions under a lock, cheap enough to leave on
+gauges are callbacks, they cost nothing until /metrics is scraped
+'''
+
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, Tuple
+import logging
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, +Inf is implied
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value == value else "NaN"
+    return str(value)
+
+
+class Counter():
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        with self.lock:
+            values = dict(self.values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+
+class Histogram():
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (last one is +Inf), sum of observations]
+        self.values: Dict[Tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        with self.lock:
+            values = {label_values: (list(counts), total) for label_values, (counts, total) in self.values.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge():
+    # collect returns a number, or {label values: number} when the gauge has labels
+    # kind "counter" is for totals that something else already keeps count of
+    def __init__(self, name: str, help: str, collect: Callable, labels: Tuple[str, ...] = (), kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labels = labels
+        self.kind = kind
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.collect()
+        except Exception:
+            logger.exception("error collecting %s", self.name)
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            if not isinstance(label_values, tuple):
+                label_values = (label_values,)
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+
+class Registry():
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, collect: Callable, labels: Tuple[str, ...] = (), kind: str = "gauge") -> Gauge:
+        return self.add(Gauge(name, help, collect, labels, kind))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests handled", ("endpoint", "method", "status"))
+http_latency = registry.histogram("http_request_duration_seconds", "Time spent handling HTTP requests", ("endpoint",))
+socket_events = registry.counter("socketio_events_total", "Socket.IO events handled", ("event", "outcome"))
+socket_latency = registry.histogram("socketio_event_duration_seconds", "Time spent handling Socket.IO events", ("event",))
+db_checkouts = registry.counter("db_pool_checkouts_total", "Connections checked out of the SQLAlchemy pool")
+
+
+# times every request of a Flask app, per endpoint
+def instrument_app(app):
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            endpoint = request.endpoint or "unmatched"
+            http_latency.observe(time.perf_counter() - start, endpoint)
+            http_requests.inc(endpoint, request.method, response.status_code)
+        return response
+
+
+# times a socket event handler, errors are counted and raised again
+def timed_event(name: str):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = f(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                socket_latency.observe(time.perf_counter() - start, name)
+                socket_events.inc(name, outcome)
+        return wrapper
+    return decorator
+
+
+# counts pool checkouts and exposes how many connections are out right now
+def instrument_engine(engine):
+    event.listen(engine, "checkout", lambda *args: db_checkouts.inc())
+    registry.gauge("db_pool_checked_out", "Connections currently checked out of the SQLAlchemy pool",
+                   lambda: engine.pool.checkedout() if hasattr(engine.pool, "checkedout") else 0)
@@ -10,13 +10,15 @@ Prisma docs also looks so much better in comparison
 or use SQLite, if you're not into fancy ORMs (but be mindful of Injection attacks :) )
 '''
 
-from sqlalchemy import Boolean, Column, Integer, String, Text, DateTime, ForeignKey ,CheckConstraint
+from sqlalchemy import Boolean, Column, Integer, String, Text, DateTime, ForeignKey ,CheckConstraint, Index
 
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime 
 
-from typing import Dict
+from typing import Callable, Dict, Optional, Set
+import sys
+import threading
 from enum import Enum as PyEnum
 import db
 
@@ -59,33 +61,141 @@ class Counter():
         return db.find_free_room_id()
 
 # Room class, used to keep track of which username is in which room
+# and which socket ids belong to which user (one per open tab)
+# every mapping is indexed in both directions so membership queries are O(1),
+# and everything a user owns is dropped once their last socket disconnects
 class Room():
-    def __init__(self):
+    def __init__(self, max_sids_per_user: int = 16, max_rooms_per_user: int = 64):
         self.counter = Counter()
-
-        self.dict: Dict[str, int] = {}
+        self.max_sids_per_user = max_sids_per_user
+        self.max_rooms_per_user = max_rooms_per_user
+
+        # dicts with None values are used as insertion ordered sets,
+        # so the oldest entry can be evicted when a user hits a limit
+        self.user_rooms: Dict[str, Dict[int, None]] = {}
+        self.room_users: Dict[int, Set[str]] = {}
+        self.user_sids: Dict[str, Dict[str, None]] = {}
+        self.sid_user: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.create_lock = threading.Lock()
+
+        # called with (user, room_id) and (user, sid) for what a limit evicted, outside the lock,
+        # so the caller can drop the same room or socket from Socket.IO as well
+        self.on_evict_room: Optional[Callable[[str, int], None]] = None
+        self.on_evict_sid: Optional[Callable[[str, str], None]] = None
 
     def create_room(self, sender: str, receiver: str) -> int:
-        # try to find this room by 2 uses
-        room_id = db.find_room_id_by_users(sender,receiver)
-        if not room_id:
-            room_id = self.counter.get()
-            db.insert_room(room_id,sender,receiver)
-
-        self.dict[sender] = room_id
-        self.dict[receiver] = room_id
+        # one room is created at a time, otherwise two first joins racing each other
+        # both see the same free id, or the same pair gets two rooms
+        with self.create_lock:
+            # try to find this room by 2 uses
+            room_id = db.find_room_id_by_users(sender,receiver)
+            if not room_id:
+                room_id = self.counter.get()
+                db.insert_room(room_id,sender,receiver)
+
+        self.join_room(sender, room_id)
         return room_id
     
-    def join_room(self,  sender: str, room_id: int) -> int:
-        self.dict[sender] = room_id
-
-    def leave_room(self, user):
-        if user not in self.dict.keys():
+    def join_room(self,  sender: str, room_id: int):
+        evicted = None
+        with self.lock:
+            rooms = self.user_rooms.setdefault(sender, {})
+            if room_id in rooms:
+                return
+            if len(rooms) >= self.max_rooms_per_user:
+                evicted = next(iter(rooms))
+                self._leave(sender, evicted)
+            rooms[room_id] = None
+            self.room_users.setdefault(room_id, set()).add(sender)
+        if evicted is not None and self.on_evict_room is not None:
+            self.on_evict_room(sender, evicted)
+
+    # leave a single room, or every room the user is in if room_id is None
+    def leave_room(self, user: str, room_id: Optional[int] = None):
+        with self.lock:
+            if room_id is None:
+                for r_id in list(self.user_rooms.get(user, ())):
+                    self._leave(user, r_id)
+            else:
+                self._leave(user, room_id)
+
+    def _leave(self, user: str, room_id: int):
+        rooms = self.user_rooms.get(user)
+        if rooms is None or room_id not in rooms:
             return
-        del self.dict[user]
+        del rooms[room_id]
+        if not rooms:
+            del self.user_rooms[user]
+
+        users = self.room_users[room_id]
+        users.discard(user)
+        if not users:
+            del self.room_users[room_id]
 
     def get_users_in_room(self, room_id: int) -> list[str]:
-        return [user for user, r_id in self.dict.items() if r_id == room_id]
+        return list(self.room_users.get(room_id, ()))
+
+    def get_rooms_for_user(self, user: str) -> list[int]:
+        return list(self.user_rooms.get(user, ()))
+
+    def is_in_room(self, user: str, room_id: int) -> bool:
+        return room_id in self.user_rooms.get(user, ())
+
+    # register a socket for a user, returns True if it is the user's first one
+    def add_sid(self, user: str, sid: str) -> bool:
+        oldest = None
+        with self.lock:
+            sids = self.user_sids.setdefault(user, {})
+            first = not sids
+            if len(sids) >= self.max_sids_per_user:
+                oldest = next(iter(sids))
+                del sids[oldest]
+                del self.sid_user[oldest]
+            sids[sid] = None
+            self.sid_user[sid] = user
+        if oldest is not None and self.on_evict_sid is not None:
+            self.on_evict_sid(user, oldest)
+        return first
+
+    # forget a socket, returns the user if that was their last one
+    # in which case the user also leaves every room
+    def remove_sid(self, sid: str) -> Optional[str]:
+        with self.lock:
+            user = self.sid_user.pop(sid, None)
+            if user is None:
+                return None
+            sids = self.user_sids[user]
+            del sids[sid]
+            if sids:
+                return None
+            del self.user_sids[user]
+            for r_id in list(self.user_rooms.get(user, ())):
+                self._leave(user, r_id)
+            return user
+
+    def get_sids(self, user: str) -> list[str]:
+        return list(self.user_sids.get(user, ()))
+
+    def get_user(self, sid: str) -> Optional[str]:
+        return self.sid_user.get(sid)
+
+    def is_online(self, user: str) -> bool:
+        return user in self.user_sids
+
+    # sizes of the indexes plus a shallow estimate of the bytes they hold
+    def stats(self) -> dict:
+        with self.lock:
+            containers = [self.user_rooms, self.room_users, self.user_sids, self.sid_user]
+            containers += list(self.user_rooms.values()) + list(self.room_users.values())
+            containers += list(self.user_sids.values())
+            return {
+                "users": len(self.user_sids),
+                "sids": len(self.sid_user),
+                "rooms": len(self.room_users),
+                "memberships": sum(len(rooms) for rooms in self.user_rooms.values()),
+                "bytes": sum(sys.getsizeof(container) for container in containers),
+            }
 
 
 class RoomInfo(Base):
@@ -99,10 +209,16 @@ class Message(Base):
     __tablename__ = "messages"
 
     id = Column(Integer, primary_key=True)
-    room_id = Column(Integer)
+    room_id = Column(Integer, index=True)
+    # position of the message in its room, 1, 2, 3... used to resume after a reconnect
+    seq = Column(Integer)
     sender = Column(String)
     content = Column(String)
 
+    __table_args__ = (
+        Index("ix_messages_room_seq", "room_id", "seq"),
+    )
+
 
 class Article(Base):
     __tablename__ = "articles"
@@ -150,6 +266,10 @@ class Friendship(Base):
 ##############################################################################
 # group chat
 ##############################################################################
+
+# group chats share the room id space with direct messages, shifted by this offset
+GROUP_ROOM_OFFSET = 10000
+
 class GroupChat(Base):
     __tablename__ = "group_chats"
 
@@ -172,7 +292,55 @@ class GroupMessage(Base):
     __tablename__ = "group_messages"
 
     id = Column(Integer, primary_key=True)
-    group_id = Column(Integer, ForeignKey("group_chats.id"), nullable=False)
+    group_id = Column(Integer, ForeignKey("group_chats.id"), nullable=False, index=True)
+    # position of the message in its group, see Message.seq
+    seq = Column(Integer)
     sender = Column(String, nullable=False)
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_group_messages_group_seq", "group_id", "seq"),
+    )
+
+##############################################################################
+# read cursors
+##############################################################################
+
+# one row per direct message room or group (room_id = group_id + GROUP_ROOM_OFFSET)
+# incremented on every insert, so unread counts never need a COUNT(*) over the messages
+class ConversationCounter(Base):
+    __tablename__ = "conversation_counter"
+
+    room_id = Column(Integer, primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0)
+    last_message_id = Column(Integer, nullable=False, default=0)
+
+# how far a user has read in a room, unread = message_count - read_count
+class ReadCursor(Base):
+    __tablename__ = "read_cursor"
+
+    username = Column(String, primary_key=True)
+    room_id = Column(Integer, primary_key=True)
+    last_message_id = Column(Integer, nullable=False, default=0)
+    read_count = Column(Integer, nullable=False, default=0)
+
+# materialized "recent conversations" view, one row per user and room
+# kept up to date by every message insert so the landing page is a single indexed read
+class ConversationSummary(Base):
+    __tablename__ = "conversation_summary"
+
+    username = Column(String, primary_key=True)
+    room_id = Column(Integer, primary_key=True, index=True)
+    # the other user of a direct message room, or the group name
+    title = Column(String, nullable=False)
+    is_group = Column(Boolean, nullable=False, default=False)
+    last_message_id = Column(Integer, nullable=False, default=0)
+    last_sender = Column(String)
+    snippet = Column(String)
+    last_at = Column(DateTime)
+    unread_count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_conversation_summary_user_last_at", "username", "last_at"),
+    )
@@ -0,0 +1,180 @@
+'''
+outbound
+bounded per connection queues for the events fanned out to rooms
+an event is handed to a socket right away while its engine.io queue is short,
+otherwise it waits in a small queue of ours that is drained as the client catches up,
+so one stalled client can no longer make the server buffer without limit
+'''
+
+from collections import deque
+from typing import Deque, Dict, NamedTuple, Optional
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# a socket with this many engine.io packets still unsent is considered slow
+HIGH_WATER = 64
+# most events and bytes a slow socket may have waiting in our queue
+MAX_QUEUED = 256
+MAX_QUEUED_BYTES = 256 * 1024
+# how often queued events are handed over to sockets that caught up
+DRAIN_INTERVAL = 0.05
+
+# kinds of events and what happens to them when a queue is full
+MESSAGE = "message"             # chat messages are never dropped, the slow socket is disconnected instead
+NOTIFICATION = "notification"   # coalesced, a newer one replaces the queued one with the same key
+SYSTEM = "system"               # "x has connected" lines, the oldest are dropped first
+PRESENCE = "presence"           # online flags, the oldest are dropped first
+
+DROPPABLE = (SYSTEM, PRESENCE)
+
+
+class OutboundEvent(NamedTuple):
+    event: str
+    data: dict
+    kind: str
+    key: Optional[str]
+    size: int
+
+
+class OutboundQueues():
+    def __init__(self, socketio, high_water: int = HIGH_WATER,
+                 max_queued: int = MAX_QUEUED, max_bytes: int = MAX_QUEUED_BYTES):
+        self.socketio = socketio
+        self.high_water = high_water
+        self.max_queued = max_queued
+        self.max_bytes = max_bytes
+
+        # sid -> events waiting for the socket to catch up, only slow sockets have one
+        self.queues: Dict[str, Deque[OutboundEvent]] = {}
+        self.queued_bytes: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        # sid -> lock held from deciding how an event goes out until it is emitted,
+        # so a direct send cannot overtake queued events that are being drained to the same socket
+        # always taken before self.lock
+        self.sid_locks: Dict[str, threading.Lock] = {}
+        # set on shutdown, drain_loop returns at its next wakeup
+        self.stopping = threading.Event()
+
+        self.counters = {"direct": 0, "queued": 0, "drained": 0, "dropped": 0, "coalesced": 0, "disconnected": 0}
+
+    # number of packets engine.io still has to write to the socket
+    # sockets it does not know about (like the test client) are never slow
+    def backlog(self, sid: str, namespace: str = "/") -> int:
+        server = self.socketio.server
+        eio_socket = server.eio.sockets.get(server.manager.eio_sid_from_sid(sid, namespace))
+        return eio_socket.queue.qsize() if eio_socket is not None else 0
+
+    # emit an event to everyone in a room, through the queue of each socket
+    def emit(self, event: str, data: dict, room, kind: str = MESSAGE, key: Optional[str] = None,
+             skip_sid: Optional[str] = None, namespace: str = "/"):
+        if namespace not in self.socketio.server.manager.rooms:
+            return
+        for sid, _ in list(self.socketio.server.manager.get_participants(namespace, room)):
+            if sid != skip_sid:
+                self.send(sid, event, data, kind, key, namespace)
+
+    def sid_lock(self, sid: str) -> threading.Lock:
+        with self.lock:
+            return self.sid_locks.setdefault(sid, threading.Lock())
+
+    def send(self, sid: str, event: str, data: dict, kind: str = MESSAGE,
+             key: Optional[str] = None, namespace: str = "/"):
+        with self.sid_lock(sid):
+            with self.lock:
+                direct = sid not in self.queues and self.backlog(sid, namespace) < self.high_water
+                if direct:
+                    self.counters["direct"] += 1
+                else:
+                    overflow = self.enqueue(sid, OutboundEvent(event, data, kind, key, len(json.dumps(data, default=str))))
+            if direct:
+                self.socketio.emit(event, data, to=sid, namespace=namespace)
+        if not direct and overflow:
+            self.disconnect(sid, namespace)
+
+    # returns True if the queue is over its limits with nothing left to drop
+    def enqueue(self, sid: str, item: OutboundEvent) -> bool:
+        queue = self.queues.setdefault(sid, deque())
+
+        if item.key is not None:
+            for i, queued in enumerate(queue):
+                if queued.key == item.key:
+                    queue[i] = item
+                    self.queued_bytes[sid] += item.size - queued.size
+                    self.counters["coalesced"] += 1
+                    return False
+
+        queue.append(item)
+        self.queued_bytes[sid] = self.queued_bytes.get(sid, 0) + item.size
+        self.counters["queued"] += 1
+
+        while len(queue) > self.max_queued or self.queued_bytes[sid] > self.max_bytes:
+            victim = next((queued for queued in queue if queued.kind in DROPPABLE), None)
+            if victim is None:
+                return True
+            queue.remove(victim)
+            self.queued_bytes[sid] -= victim.size
+            self.counters["dropped"] += 1
+        return False
+
+    # a socket that cannot keep up even with its droppable events gone is cut off,
+    # the client reconnects and resumes from its last seq
+    def disconnect(self, sid: str, namespace: str = "/"):
+        self.forget(sid)
+        with self.lock:
+            self.counters["disconnected"] += 1
+        self.socketio.server.disconnect(sid, namespace=namespace)
+
+    def forget(self, sid: str):
+        with self.lock:
+            self.queues.pop(sid, None)
+            self.queued_bytes.pop(sid, None)
+            self.sid_locks.pop(sid, None)
+
+    # hand queued events to the sockets that caught up, in order
+    # each socket's events are emitted under its lock, before a direct send can go out
+    def drain(self, namespace: str = "/"):
+        with self.lock:
+            sids = list(self.queues)
+        for sid in sids:
+            with self.sid_lock(sid):
+                ready = []
+                with self.lock:
+                    queue = self.queues.get(sid)
+                    if queue is None:
+                        continue
+                    room = self.high_water - self.backlog(sid, namespace)
+                    while queue and room > 0:
+                        item = queue.popleft()
+                        self.queued_bytes[sid] -= item.size
+                        ready.append(item)
+                        room -= 1
+                    if not queue:
+                        del self.queues[sid]
+                        del self.queued_bytes[sid]
+                    self.counters["drained"] += len(ready)
+                for item in ready:
+                    self.socketio.emit(item.event, item.data, to=sid, namespace=namespace)
+
+    def drain_loop(self):
+        while True:
+            self.socketio.sleep(DRAIN_INTERVAL)
+            if self.stopping.is_set():
+                return
+            try:
+                self.drain()
+            except Exception:
+                logger.exception("error draining outbound queues")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.counters,
+                "slow_sockets": len(self.queues),
+                "queued_events": sum(len(queue) for queue in self.queues.values()),
+                "queued_bytes": sum(self.queued_bytes.values()),
+                "max_queued_bytes": max(self.queued_bytes.values(), default=0),
+                "sid_locks": len(self.sid_locks),
+            }
@@ -0,0 +1,80 @@
+'''
+presence
+in-memory tracking of which users are online, fed by the socket lifecycle and heartbeats
+the user_online table is only written in periodic batches, so connecting and
+disconnecting no longer costs a commit each
+'''
+
+from typing import Dict, Optional
+import threading
+import time
+
+from models import Room
+import db
+
+# a socket that has not sent a heartbeat for this many seconds is considered dead
+HEARTBEAT_TIMEOUT = 60
+# how often expired sockets are swept and pending changes are written to user_online
+FLUSH_INTERVAL = 10
+
+
+class Presence():
+    def __init__(self, registry: Room, timeout: float = HEARTBEAT_TIMEOUT):
+        self.registry = registry
+        self.timeout = timeout
+
+        # sid -> time of the last sign of life
+        self.last_seen: Dict[str, float] = {}
+        # username -> online flag that still has to be written to user_online
+        self.pending: Dict[str, bool] = {}
+        self.lock = threading.Lock()
+
+    # returns True if the user just came online
+    def connect(self, username: str, sid: str) -> bool:
+        first = self.registry.add_sid(username, sid)
+        with self.lock:
+            self.last_seen[sid] = time.monotonic()
+            if first:
+                self.pending[username] = True
+        return first
+
+    # returns False for a socket that is not registered, e.g. one expire() already swept
+    # because its tab was throttled in the background, the caller registers it again
+    def heartbeat(self, sid: str) -> bool:
+        with self.lock:
+            if sid not in self.last_seen:
+                return False
+            self.last_seen[sid] = time.monotonic()
+            return True
+
+    # returns the user if they just went offline
+    def disconnect(self, sid: str) -> Optional[str]:
+        with self.lock:
+            self.last_seen.pop(sid, None)
+        username = self.registry.remove_sid(sid)
+        if username is not None:
+            with self.lock:
+                self.pending[username] = False
+        return username
+
+    # drop every socket that missed its heartbeats, returns the users that went offline
+    def expire(self) -> list[str]:
+        deadline = time.monotonic() - self.timeout
+        with self.lock:
+            dead = [sid for sid, seen in self.last_seen.items() if seen < deadline]
+        offline = []
+        for sid in dead:
+            username = self.disconnect(sid)
+            if username is not None:
+                offline.append(username)
+        return offline
+
+    def is_online(self, username: str) -> bool:
+        return self.registry.is_online(username)
+
+    # write all pending online flags to user_online in one transaction
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            db.set_users_online(pending)
@@ -0,0 +1,187 @@
+'''
+profiler
+statistical sampling profiler for a live server
+every interval it records the stack of each thread (sys._current_frames) and of each
+suspended greenlet, from a background thread so no request waits for it
+greenlets are only known once track_greenlets() is on, the only hook into the profiled code
+results are exported as collapsed stacks (flamegraph.pl, speedscope, inferno) or speedscope JSON
+'''
+
+from typing import Dict, List, Optional, Tuple
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+logger = logging.getLogger(__name__)
+
+MAX_SECONDS = 60
+DEFAULT_SECONDS = 5
+MIN_INTERVAL = 0.001
+DEFAULT_INTERVAL = 0.01
+# deeper stacks are cut at the root end
+MAX_DEPTH = 128
+
+# one profile at a time, a second request is turned away instead of doubling the overhead
+running = threading.Lock()
+# the last finished profile
+latest: Optional["Profile"] = None
+
+# every greenlet switched to since track_greenlets(), finished ones drop out on their own
+greenlets: "weakref.WeakSet" = weakref.WeakSet()
+
+
+class Profile():
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.started = time.time()
+        self.duration = 0.0
+        # (name, file, line) -> index into frames
+        self.frame_index: Dict[Tuple[str, str, int], int] = {}
+        self.frames: List[Tuple[str, str, int]] = []
+        # thread name -> [(stack as frame indexes from the root, seconds it stands for)]
+        self.samples: Dict[str, List[Tuple[Tuple[int, ...], float]]] = {}
+        self.sample_count = 0
+
+    def frame_id(self, code) -> int:
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        index = self.frame_index.get(key)
+        if index is None:
+            index = self.frame_index[key] = len(self.frames)
+            self.frames.append(key)
+        return index
+
+    def add(self, thread: str, frame, weight: float):
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(self.frame_id(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        self.samples.setdefault(thread, []).append((tuple(stack), weight))
+
+    def label(self, index: int) -> str:
+        name, filename, line = self.frames[index]
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    # one line per distinct stack: "thread;root;...;leaf count"
+    def collapsed(self) -> str:
+        counts: Dict[Tuple[str, Tuple[int, ...]], int] = {}
+        for thread, samples in self.samples.items():
+            for stack, _ in samples:
+                counts[(thread, stack)] = counts.get((thread, stack), 0) + 1
+        lines = []
+        for (thread, stack), count in sorted(counts.items(), key=lambda item: -item[1]):
+            names = [thread.replace(";", ":")] + [self.label(index).replace(";", ":") for index in stack]
+            lines.append(";".join(names) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    # https://www.speedscope.app/file-format-schema.json, one sampled profile per thread
+    def speedscope(self) -> dict:
+        profiles = []
+        for thread, samples in sorted(self.samples.items()):
+            profiles.append({
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weight for _, weight in samples),
+                "samples": [list(stack) for stack, _ in samples],
+                "weights": [weight for _, weight in samples],
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"profile {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))}",
+            "exporter": __name__,
+            "shared": {"frames": [{"name": name, "file": filename, "line": line} for name, filename, line in self.frames]},
+            "profiles": profiles,
+        }
+
+
+# greenlet trace functions are per thread, so this is called from the thread the greenlets
+# run in, for eventlet and gevent the one that builds the app
+def track_greenlets():
+    if greenlet is None:
+        return
+    previous = greenlet.gettrace()
+
+    def trace(event, args):
+        if event in ("switch", "throw"):
+            target = args[1]
+            if target not in greenlets:
+                greenlets.add(target)
+        if previous is not None:
+            previous(event, args)
+
+    greenlet.settrace(trace)
+
+
+def known_greenlets() -> list:
+    # a switch in another thread can add one while the set is copied
+    while True:
+        try:
+            return list(greenlets)
+        except RuntimeError:
+            continue
+
+
+# samples every thread but the calling one for the given time, blocking the caller meanwhile
+def sample(seconds: float = DEFAULT_SECONDS, interval: float = DEFAULT_INTERVAL) -> Profile:
+    seconds = min(max(seconds, interval), MAX_SECONDS)
+    interval = max(interval, MIN_INTERVAL)
+    profile = Profile(interval)
+    me = threading.get_ident()
+
+    start = last = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        # weight by the real gap, so a late wakeup does not undercount
+        weight = now - last if now > last else interval
+        last = now
+
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                profile.add(names.get(ident, f"thread-{ident}"), frame, weight)
+
+        if greenlets:
+            for glet in known_greenlets():
+                # running greenlets have no gr_frame, their stack is in the thread's frames above
+                if glet.gr_frame is not None:
+                    profile.add(f"greenlet-{id(glet):x}", glet.gr_frame, weight)
+
+        profile.sample_count += 1
+        time.sleep(max(0.0, interval - (time.perf_counter() - now)))
+
+    profile.duration = time.perf_counter() - start
+    logger.info("profile taken", extra={"seconds": round(profile.duration, 2), "samples": profile.sample_count,
+                                        "frames": len(profile.frames)})
+    return profile
+
+
+# takes a profile on a background thread, the result ends up in `latest`
+# returns False if one is already being taken
+def start(seconds: float = DEFAULT_SECONDS, interval: float = DEFAULT_INTERVAL) -> bool:
+    if not running.acquire(blocking=False):
+        return False
+
+    def run():
+        global latest
+        try:
+            latest = sample(seconds, interval)
+        except Exception:
+            logger.exception("profile failed")
+        finally:
+            running.release()
+
+    threading.Thread(target=run, name="profiler", daemon=True).start()
+    return True
@@ -0,0 +1,116 @@
+'''
+query_stats
+counts the SQL statements and DB time of each HTTP request and socket event
+through SQLAlchemy engine events, and warns about the ones that run too many
+queries or the same statement over and over (the usual sign of an N+1 loop)
+'''
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional
+import logging
+import time
+
+from flask import g, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# warn when one request or event runs more statements than this
+QUERY_WARN_THRESHOLD = 20
+# warn when the same statement runs more than this many times in one request or event
+REPEAT_WARN_THRESHOLD = 5
+
+
+class QueryStats():
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.seconds = 0.0
+        # statement text -> times it ran, the text is already parameterized so it is the shape
+        self.shapes = Counter()
+
+    def record(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[statement] += 1
+
+    def warnings(self) -> list:
+        found = []
+        if self.count > QUERY_WARN_THRESHOLD:
+            found.append(f"{self.label} ran {self.count} queries ({self.seconds * 1000:.1f} ms)")
+        for statement, times in self.shapes.most_common():
+            if times <= REPEAT_WARN_THRESHOLD:
+                break
+            shape = " ".join(statement.split())[:160]
+            found.append(f"possible N+1 in {self.label}: ran {times} times: {shape}")
+        return found
+
+
+# stats of whatever is being handled in this thread / context right now
+current_stats: ContextVar[Optional[QueryStats]] = ContextVar("current_stats", default=None)
+
+
+def start(label: str):
+    stats = QueryStats(label)
+    return stats, current_stats.set(stats)
+
+def finish(stats: QueryStats, token):
+    current_stats.reset(token)
+    for warning in stats.warnings():
+        logger.warning(warning, extra={"label": stats.label, "queries": stats.count, "db_ms": round(stats.seconds * 1000, 1)})
+
+@contextmanager
+def track(label: str):
+    stats, token = start(label)
+    try:
+        yield stats
+    finally:
+        finish(stats, token)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_stats.get() is not None:
+            conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats.get()
+        if stats is not None and conn.info.get("query_start"):
+            stats.record(statement, time.perf_counter() - conn.info["query_start"].pop())
+
+
+# tracks every request of a Flask app, in debug mode the totals are sent back as headers
+def instrument_app(app):
+    @app.before_request
+    def start_tracking():
+        g.query_stats, g.query_token = start(f"{request.method} {request.endpoint or request.path}")
+
+    @app.after_request
+    def add_query_headers(response):
+        stats = g.get("query_stats")
+        if stats is not None and app.debug:
+            response.headers["X-DB-Queries"] = str(stats.count)
+            response.headers["X-DB-Time-Ms"] = f"{stats.seconds * 1000:.1f}"
+        return response
+
+    @app.teardown_request
+    def finish_tracking(exc):
+        stats = g.pop("query_stats", None)
+        if stats is not None:
+            finish(stats, g.pop("query_token"))
+
+
+# tracks a socket event handler
+def track_event(name: str):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with track(f"event {name}"):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,201 @@
+'''
+ratelimit
+in-memory token buckets limiting how often a socket (or client address) and a user
+can call a socket event or an expensive route
+every check touches at most two buckets, so it costs O(1) no matter how many clients there are
+'''
+
+from functools import wraps
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+import logging
+import threading
+import time
+
+from flask import jsonify, request, session
+from flask_socketio import emit
+
+logger = logging.getLogger(__name__)
+
+
+class Limit(NamedTuple):
+    rate: float     # tokens added back per second
+    burst: int      # size of the bucket, how many calls can be made at once
+
+
+# limits per socket event and per route, one bucket per sid (or client address for routes)
+# and one per logged in user, so opening more tabs does not buy more throughput
+# names missing from here are not limited
+LIMITS: Dict[str, Dict[str, Limit]] = {
+    # socket events
+    "send":                    {"sid": Limit(5, 10),  "user": Limit(8, 20)},
+    "send_group_message":      {"sid": Limit(5, 10),  "user": Limit(8, 20)},
+    "send_batch":              {"sid": Limit(1, 3),   "user": Limit(2, 6)},
+    "send_group_batch":        {"sid": Limit(1, 3),   "user": Limit(2, 6)},
+    "GetHistoryMessages":      {"sid": Limit(1, 5),   "user": Limit(2, 10)},
+    "GetGroupHistoryMessages": {"sid": Limit(1, 5),   "user": Limit(2, 10)},
+    "join":                    {"sid": Limit(2, 10),  "user": Limit(4, 20)},
+    "join_group":              {"sid": Limit(2, 10),  "user": Limit(4, 20)},
+    "mark_read":               {"sid": Limit(10, 30), "user": Limit(20, 60)},
+    # routes
+    "login":                   {"sid": Limit(0.5, 5)},
+    "signup":                  {"sid": Limit(0.2, 3)},
+    "send_friend_request":     {"sid": Limit(1, 5),   "user": Limit(1, 5)},
+    "get_friends":             {"sid": Limit(2, 10),  "user": Limit(4, 20)},
+    "get_groups":              {"sid": Limit(2, 10),  "user": Limit(4, 20)},
+    "get_conversations":       {"sid": Limit(2, 10),  "user": Limit(4, 20)},
+    "create_group":            {"sid": Limit(0.5, 5), "user": Limit(0.5, 5)},
+}
+
+
+# LIMITS with the overrides of a RATE_LIMITS setting applied, a comma separated list of
+# name.scope=rate/burst, name.scope=off or name=off, e.g. send.sid=10/20,send.user=off,login=off
+# RATE_LIMITS=off turns every limit off, for load tests that drive many users from one address
+def parse_limits(spec: str, defaults: Dict[str, Dict[str, Limit]] = LIMITS) -> Dict[str, Dict[str, Limit]]:
+    spec = spec.strip()
+    if spec == "off":
+        return {}
+    limits = {name: dict(scopes) for name, scopes in defaults.items()}
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        key, _, setting = (part.strip() for part in item.partition("="))
+        name, _, scope = key.partition(".")
+        try:
+            if setting == "off":
+                if scope:
+                    limits.get(name, {}).pop(scope, None)
+                else:
+                    limits.pop(name, None)
+                continue
+            if scope not in ("sid", "user"):
+                raise ValueError("scope must be sid or user")
+            rate, _, burst = setting.partition("/")
+            limit = Limit(float(rate), int(burst))
+            if limit.rate <= 0 or limit.burst < 1:
+                raise ValueError("rate and burst must be positive")
+        except ValueError as e:
+            logger.warning("ignoring rate limit %r: %s", item, e)
+            continue
+        limits.setdefault(name, {})[scope] = limit
+    return {name: scopes for name, scopes in limits.items() if scopes}
+
+
+class RateLimiter():
+    def __init__(self, limits: Dict[str, Dict[str, Limit]] = LIMITS):
+        self.limits = limits
+        # (name, scope, key) -> [tokens left, time they were counted]
+        self.buckets: Dict[Tuple[str, str, str], list] = {}
+        # (name, scope) -> number of calls let through / turned away
+        self.allowed: Dict[str, int] = {}
+        self.throttled: Dict[Tuple[str, str], int] = {}
+        self.lock = threading.Lock()
+
+    # swaps the limits, the buckets of the old ones are dropped
+    def configure(self, limits: Dict[str, Dict[str, Limit]]):
+        with self.lock:
+            self.limits = limits
+            self.buckets.clear()
+
+    # refills the bucket up to now, returns it and how long to wait if it has no token to take
+    def refill(self, name: str, scope: str, key: str, limit: Limit, now: float) -> Tuple[list, float]:
+        bucket = self.buckets.get((name, scope, key))
+        if bucket is None:
+            bucket = self.buckets[(name, scope, key)] = [float(limit.burst), now]
+        bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+        bucket[1] = now
+        return bucket, 0 if bucket[0] >= 1 else (1 - bucket[0]) / limit.rate
+
+    # returns None if the call may go ahead, otherwise the seconds until it may be retried
+    # a token is only taken once both the sid and the user bucket have one,
+    # so a call turned away by one of them costs nothing in the other
+    # a call costing more than one token (a batch of messages) only needs one to go ahead,
+    # the rest is owed and the calls after it wait until the bucket has refilled past the debt
+    def check(self, name: str, sid: Optional[str], username: Optional[str] = None, cost: int = 1) -> Optional[float]:
+        limits = self.limits.get(name)
+        if not limits:
+            return None
+
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            wait = 0
+            for scope, key in (("sid", sid), ("user", username)):
+                limit = limits.get(scope)
+                if limit is None or key is None:
+                    continue
+                bucket, scope_wait = self.refill(name, scope, key, limit, now)
+                if scope_wait:
+                    self.throttled[(name, scope)] = self.throttled.get((name, scope), 0) + 1
+                    wait = max(wait, scope_wait)
+                buckets.append(bucket)
+            if wait:
+                return round(wait, 3)
+            for bucket in buckets:
+                bucket[0] -= cost
+            self.allowed[name] = self.allowed.get(name, 0) + 1
+        return None
+
+    # drop the buckets of a socket that went away
+    def forget_sid(self, sid: str):
+        with self.lock:
+            for name in self.limits:
+                self.buckets.pop((name, "sid", sid), None)
+
+    # drop buckets that have refilled completely, they are the same as no bucket at all
+    # called from the flush loop so idle users and addresses do not pile up
+    def prune(self):
+        now = time.monotonic()
+        with self.lock:
+            for key, (tokens, last) in list(self.buckets.items()):
+                limit = self.limits[key[0]][key[1]]
+                if tokens + (now - last) * limit.rate >= limit.burst:
+                    del self.buckets[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "allowed": dict(self.allowed),
+                "throttled": {f"{name}:{scope}": count for (name, scope), count in self.throttled.items()},
+                "buckets": len(self.buckets),
+            }
+
+
+# create_app() applies the app's RATE_LIMITS setting, see parse_limits
+limiter = RateLimiter()
+
+
+def rejection(name: str, retry_after: float) -> dict:
+    return {"error": "rate_limited", "event": name, "retry_after": retry_after}
+
+
+# limits a socket event handler per sid and per logged in user
+# a throttled call is not handled, the client gets a rate_limited event
+# and the same rejection as the acknowledgement if it asked for one
+# cost, given the handler's arguments, is how many tokens a call takes, 1 if not given
+def limit_event(name: str, cost: Optional[Callable[..., int]] = None):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tokens = cost(*args, **kwargs) if cost else 1
+            retry_after = limiter.check(name, request.sid, session.get("username"), tokens)
+            if retry_after is not None:
+                emit("rate_limited", rejection(name, retry_after), to=request.sid)
+                return rejection(name, retry_after)
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# limits a route per client address and per logged in user
+# a throttled request gets a 429 with a Retry-After header
+def limit_route(name: str):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            retry_after = limiter.check(name, request.remote_addr, session.get("username"))
+            if retry_after is not None:
+                response = jsonify(rejection(name, retry_after))
+                response.status_code = 429
+                response.headers["Retry-After"] = str(max(1, round(retry_after)))
+                return response
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,44 @@
+'''
+read_cursors
+buffers how far each user has read in each room, so marking a chat as read costs no commit
+the buffer is written to the read_cursor table in batches by the background loop in socket_routes
+'''
+
+from typing import Dict, Tuple
+import threading
+
+import db
+
+
+class ReadCursors():
+    def __init__(self):
+        # (username, room_id) -> last read message id, not yet written to read_cursor
+        self.pending: Dict[Tuple[str, int], int] = {}
+        self.lock = threading.Lock()
+
+    # cursors only ever move forward
+    def mark_read(self, username: str, room_id: int, last_message_id: int):
+        key = (username, room_id)
+        with self.lock:
+            if self.pending.get(key, 0) < last_message_id:
+                self.pending[key] = last_message_id
+
+    # room_id -> unread count, for the rooms that have any messages
+    def unread_counts(self, username: str, room_ids: list) -> dict:
+        counts = db.get_unread_counts(username, room_ids)
+        unread = {}
+        for room_id, (count, last_message_id) in counts.items():
+            unread[room_id] = 0 if self.covers(username, room_id, last_message_id) else count
+        return unread
+
+    # whether a cursor still waiting in the buffer already covers the given message,
+    # in which case the unread count stored in the database is stale and really 0
+    def covers(self, username: str, room_id: int, message_id: int) -> bool:
+        with self.lock:
+            return self.pending.get((username, room_id), 0) >= message_id
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            db.save_read_cursors(pending)
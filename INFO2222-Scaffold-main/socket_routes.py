@@ -3,74 +3,355 @@ socket_routes
 file containing all the routes related to socket.io
 '''
 
-from flask_socketio import join_room, emit, leave_room
+from flask_socketio import SocketIO, join_room, emit, leave_room, rooms
 from functools import wraps
 from flask import request, session
 from sqlalchemy.orm import Session
+from typing import Dict
+import atexit
+import logging
+import threading
 import time
 
-try:
-    from __main__ import socketio
-except ImportError:
-    from app import socketio
+# the handlers below are registered on this object at import time,
+# app.create_app() binds it to an app with socketio.init_app()
+socketio = SocketIO()
 
-from models import Room,User,GroupUser,GroupMessage,GroupChat
+from models import Room,User,GroupUser,GroupMessage,GroupChat,GROUP_ROOM_OFFSET
 
 import db
+from presence import Presence, FLUSH_INTERVAL
+from read_cursors import ReadCursors
+from message_cache import MessageCache, CachedMessage
+from ratelimit import limiter, limit_event
+from outbound import OutboundQueues, MESSAGE, NOTIFICATION, SYSTEM, PRESENCE
+from metrics import registry, timed_event
+from query_stats import track_event
+from tracing import traced_event
+import memwatch
+
+logger = logging.getLogger(__name__)
+
+# times, counts the queries of and traces a socket event handler
+def instrumented(name: str):
+    def decorator(f):
+        return timed_event(name)(track_event(name)(traced_event(name)(f)))
+    return decorator
 
 room = Room()
-
-
-
+presence = Presence(room)
+read_cursors = ReadCursors()
+message_cache = MessageCache()
+# everything fanned out to rooms goes through here so slow sockets are bounded
+outbound = OutboundQueues(socketio)
+
+# what the registry evicts to stay within its per user limits leaves Socket.IO too,
+# otherwise the sockets would keep getting events of a room the registry says they left
+def evict_room(username: str, room_id: int):
+    for sid in room.get_sids(username):
+        socketio.server.leave_room(sid, room_id)
+
+def evict_sid(username: str, sid: str):
+    socketio.server.disconnect(sid)
+
+room.on_evict_room = evict_room
+room.on_evict_sid = evict_sid
+
+# gauges read at scrape time from the in-memory state above
+registry.gauge("chat_connected_sockets", "Sockets of logged in users", lambda: room.stats()["sids"])
+registry.gauge("chat_online_users", "Users with at least one socket", lambda: room.stats()["users"])
+registry.gauge("chat_rooms", "Rooms with at least one member", lambda: room.stats()["rooms"])
+registry.gauge("chat_room_memberships", "User memberships over all rooms", lambda: room.stats()["memberships"])
+registry.gauge("chat_pending_writes", "Changes buffered in memory until the next flush",
+               lambda: {("presence",): len(presence.pending), ("read_cursors",): len(read_cursors.pending)}, ("kind",))
+registry.gauge("chat_outbound_queued_events", "Events waiting for slow sockets", lambda: outbound.stats()["queued_events"])
+registry.gauge("chat_outbound_queued_bytes", "Bytes waiting for slow sockets", lambda: outbound.stats()["queued_bytes"])
+registry.gauge("chat_outbound_events_total", "Fanned out events by what happened to them",
+               lambda: {(key,): value for key, value in outbound.stats().items()
+                        if key in ("direct", "queued", "dropped", "coalesced", "disconnected")}, ("outcome",), kind="counter")
+registry.gauge("chat_message_cache_hit_ratio", "Share of history reads served from the message cache",
+               lambda: message_cache.stats()["hit_rate"])
+registry.gauge("chat_message_cache_bytes", "Estimated size of the message cache", lambda: message_cache.stats()["bytes"])
+registry.gauge("chat_message_cache_evictions_total", "Rooms evicted from the message cache",
+               lambda: message_cache.stats()["evictions"], kind="counter")
+registry.gauge("ratelimit_throttled_total", "Calls turned away by a rate limit",
+               lambda: {tuple(key.split(":")): value for key, value in limiter.stats()["throttled"].items()},
+               ("name", "scope"), kind="counter")
+
+# the same state for soak tests, the connection bound part has to drain once everyone disconnected
+memwatch.watch("room", lambda: {key: value for key, value in room.stats().items() if key != "bytes"}, connection=True)
+# the top level dicts keep their size after emptying, so the bytes do not go back to the baseline
+memwatch.watch("room_bytes", lambda: room.stats()["bytes"])
+memwatch.watch("presence_sockets", lambda: len(presence.last_seen), connection=True)
+memwatch.watch("presence_pending", lambda: len(presence.pending))
+memwatch.watch("outbound", lambda: {key: value for key, value in outbound.stats().items()
+                                    if key in ("slow_sockets", "queued_events", "queued_bytes", "sid_locks")}, connection=True)
+memwatch.watch("message_cache", lambda: {key: value for key, value in message_cache.stats().items()
+                                         if key in ("rooms", "messages", "bytes")})
+memwatch.watch("read_cursors", lambda: len(read_cursors.pending))
+memwatch.watch("rate_limit_buckets", lambda: limiter.stats()["buckets"])
+
+# number of most recent messages sent when a chat is opened
+HISTORY_PAGE_SIZE = 50
+# most messages accepted in one send_batch / send_group_batch
+MAX_BATCH_SIZE = 50
+
+
+# every socket is joined to a private room named after its user,
+# so notifications can be addressed to the affected users only
+def user_room(username: str) -> str:
+    return f"user:{username}"
+
+# per user notification counter, every event sent to a user's private room
+# carries the next version so the client can detect a missed delta
+notification_versions: Dict[str, int] = {}
+notification_lock = threading.Lock()
+
+# emit an event to the private rooms of the given users
+# this can be called from both socket handlers and flask routes
+# a slow socket only keeps the latest queued event of each name, the
+# version gap then makes the client refetch instead of replaying every delta
+def notify_users(event: str, data: dict, *usernames: str, kind: str = NOTIFICATION):
+    for username in set(usernames):
+        if not username:
+            continue
+        with notification_lock:
+            version = notification_versions.get(username, 0) + 1
+            notification_versions[username] = version
+        outbound.emit(event, {**data, "version": version}, user_room(username),
+                      kind=kind, key=event if kind == NOTIFICATION else None)
+
+# tell the friends of a user that their online flag flipped
+def notify_friends_presence(username: str, is_online: bool):
+    notify_users("update_friend_list",
+                 {"action": "online", "friend": {"username": username, "is_online": is_online}},
+                 *db.get_friend_usernames(username), kind=PRESENCE)
+
+
+# the presence loop is started by the first connection, since the
+# background task has to run inside the socketio server
+background_started = False
+background_lock = threading.Lock()
+# set on shutdown, the background loops return at their next wakeup
+stopping = threading.Event()
+
+# engineio starts plain threads, and a loop that never ends on one keeps the process from
+# exiting (Ctrl-C on python app.py, a script that built the app), so in threading mode the
+# loops get daemon threads, greenlets do not hold the process up
+def start_background_task(target):
+    if socketio.async_mode == "threading":
+        threading.Thread(target=target, name=target.__name__, daemon=True).start()
+    else:
+        socketio.start_background_task(target)
+
+def start_background_tasks():
+    global background_started
+    with background_lock:
+        if background_started:
+            return
+        background_started = True
+    # nobody is connected yet, whatever the table still says from the last run
+    db.reset_online_users()
+    start_background_task(flush_loop)
+    start_background_task(outbound.drain_loop)
+    # registered after logging_setup's handler, so it runs before the log listener stops
+    atexit.register(stop_background_tasks)
+
+# daemon threads are not waited for, what they still buffer is written here
+def stop_background_tasks():
+    stopping.set()
+    outbound.stopping.set()
+    try:
+        presence.flush()
+        read_cursors.flush()
+    except Exception:
+        logger.exception("error in the final flush")
+
+# sweeps sockets that stopped sending heartbeats and writes
+# presence and read cursors to the database in batches
+def flush_loop():
+    while True:
+        socketio.sleep(FLUSH_INTERVAL)
+        if stopping.is_set():
+            return
+        try:
+            for username in presence.expire():
+                notify_friends_presence(username, False)
+            presence.flush()
+            read_cursors.flush()
+            limiter.prune()
+        except Exception:
+            logger.exception("error in flush loop")
 
 
 # when the client connects to a socket
 # this event is emitted when the io() function is called in JS
 @socketio.on('connect')
-def connect():
-    with Session(db.engine) as session:
-        username = request.cookies.get("username")
-        room_id = request.cookies.get("room_id")
-        if room_id is None or username is None:
-            return
-        user = session.query(db.UserOnline).filter_by(username=username).first()
-        if user is None:
-            emit('error', {'message': 'User not found'})
-            return
-        user.is_online = True
-        session.commit()
-        join_room(int(room_id))
-        emit("incoming", {"sender": "system", "message": f"{username} has connected", "color": "green"}, to=int(room_id))
+@instrumented("connect")
+def connect(auth=None):
+    start_background_tasks()
+
+    # the private room is keyed on the logged in user, not on the username cookie
+    if session.get("username") is not None:
+        username = session["username"]
+        join_room(user_room(username))
+        # the client patches its lists from here on, starting at this version
+        emit("notification_version", {"version": notification_versions.get(username, 0)})
+        if presence.connect(username, request.sid):
+            notify_friends_presence(username, True)
+
+    username = request.cookies.get("username")
+    room_id = request.cookies.get("room_id")
+    if room_id is None or username is None:
+        return
+    if db.get_user(username) is None:
+        emit('error', {'message': 'User not found'})
+        return
+    join_room(int(room_id))
+    outbound.emit("incoming", {"sender": "system", "message": f"{username} has connected", "color": "green"}, int(room_id), kind=SYSTEM)
 
 
 # event when client disconnects
-# quite unreliable use sparingly
+# quite unreliable use sparingly, dead sockets are also swept by flush_loop
 @socketio.on('disconnect')
+@instrumented("disconnect")
 def disconnect():
-    with Session(db.engine) as session:
-        username = request.cookies.get("username")
-        room_id = request.cookies.get("room_id")
-        if room_id is None or username is None:
-            return
-        user = session.query(db.UserOnline).filter_by(username=username).first()
-        if user is None:
-            emit('error', {'message': 'User not found'})
-            return
-        user.is_online = False
-        session.commit()
-        leave_room(room_id)
-        emit("incoming", {"sender": "system", "message": f"{username} has disconnected", "color": "green"}, to=int(room_id))
+    # a user whose last tab just closed also leaves all of their rooms
+    username = presence.disconnect(request.sid)
+    if username is not None:
+        notify_friends_presence(username, False)
+    limiter.forget_sid(request.sid)
+    outbound.forget(request.sid)
+
+    username = request.cookies.get("username")
+    room_id = request.cookies.get("room_id")
+    if room_id is None or username is None:
+        return
+    leave_room(int(room_id))
+    outbound.emit("incoming", {"sender": "system", "message": f"{username} has disconnected", "color": "green"}, int(room_id), kind=SYSTEM)
+
+
+# sent by the client once it has shown the messages of a room up to last_message_id
+# group chats use their room id, group_id + GROUP_ROOM_OFFSET
+@socketio.on('mark_read')
+@instrumented("mark_read")
+@limit_event("mark_read")
+def mark_read(room_id, last_message_id):
+    username = session.get("username")
+    if username is None or not isinstance(room_id, int) or not isinstance(last_message_id, int):
+        return
+    # a cursor in someone else's room would count its messages as read by this user,
+    # the registry answers for rooms the user joined, the database for the rest
+    if not room.is_in_room(username, room_id) and not db.is_room_member(username, room_id):
+        return
+    read_cursors.mark_read(username, room_id, last_message_id)
 
 
+# sent by the client every few seconds to show its socket is still alive
+@socketio.on('heartbeat')
+@instrumented("heartbeat")
+def heartbeat():
+    if presence.heartbeat(request.sid):
+        return
+    username = session.get("username")
+    if username is None:
+        return
+    # swept by flush_loop but still connected, Socket.IO kept its rooms so the registry
+    # gets them back from there (chat rooms are the int ones)
+    if presence.connect(username, request.sid):
+        notify_friends_presence(username, True)
+    for room_id in rooms():
+        if isinstance(room_id, int):
+            room.join_room(username, room_id)
+
+
+
+# history is sent column by column rather than as a list of dicts,
+# so the field names are not repeated for every message
+def history_data(messages, reset: bool) -> dict:
+    return {
+        "id": [msg.id for msg in messages],
+        "seq": [msg.seq for msg in messages],
+        "sender": [msg.sender for msg in messages],
+        "content": [msg.content for msg in messages],
+        "reset": reset
+    }
+
+# send history to the requesting socket only
+# a client that already holds messages up to last_seq gets just the newer ones,
+# otherwise (or if it missed more than a page) it gets the latest page with reset set
+def send_history(event: str, messages_since, latest_page, last_seq=None):
+    if isinstance(last_seq, int):
+        newer = messages_since(last_seq, HISTORY_PAGE_SIZE + 1)
+        if len(newer) <= HISTORY_PAGE_SIZE:
+            emit(event, history_data(newer, False), to=request.sid)
+            return
+    emit(event, history_data(latest_page(), True), to=request.sid)
+
 
 @socketio.on('send')
+@instrumented("send")
+@limit_event("send")
 def handle_send_message(sender, message, room_id):
-    db.insert_message(room_id, sender, message)
-    emit('incoming', {'sender': sender, 'message': message}, room=room_id)
+    message_id, seq = db.insert_message(room_id, sender, message) or (None, None)
+    # the sender has obviously read their own message
+    if message_id is not None:
+        read_cursors.mark_read(sender, room_id, message_id)
+        message_cache.append(room_id, CachedMessage(message_id, seq, sender, message))
+    outbound.emit('incoming', {'sender': sender, 'message': message, 'id': message_id, 'seq': seq}, room_id, kind=MESSAGE)
+
+
+# a batch is a list of {"client_id": ..., "message": ...}, as sent by a client
+# replaying its outbox or pasting several lines
+# returns (client_ids, contents), or None if the batch is malformed
+def read_batch(messages):
+    if not isinstance(messages, list) or not 0 < len(messages) <= MAX_BATCH_SIZE:
+        return None
+    if not all(isinstance(msg, dict) and isinstance(msg.get("message"), str) for msg in messages):
+        return None
+    return [msg.get("client_id") for msg in messages], [msg["message"] for msg in messages]
+
+# a batch takes a token from the send limits for each message in it, so batching
+# does not get around them, a malformed batch is rejected and takes just one
+def batch_cost(messages) -> int:
+    return len(messages) if read_batch(messages) is not None else 1
+
+# stores a batch through insert and sends it to the room as one incoming_batch packet
+# the sender is acknowledged with the server id and seq of each client id so it can reconcile
+def store_batch(sender: str, room_id: int, messages, insert):
+    batch = read_batch(messages)
+    if batch is None:
+        return {"error": f"A batch is a list of 1 to {MAX_BATCH_SIZE} messages."}
+    client_ids, contents = batch
+
+    message_keys = insert(contents)
+    if message_keys is None:
+        return {"error": "Failed to store the messages."}
+    ids = [message_id for message_id, _ in message_keys]
+    seqs = [seq for _, seq in message_keys]
+
+    read_cursors.mark_read(sender, room_id, ids[-1])
+    for message_id, seq, content in zip(ids, seqs, contents):
+        message_cache.append(room_id, CachedMessage(message_id, seq, sender, content))
+    outbound.emit("incoming_batch", {"room_id": room_id, "sender": sender, "id": ids, "seq": seqs,
+                                     "message": contents, "client_id": client_ids}, room_id, kind=MESSAGE)
+    return {"client_id": client_ids, "id": ids, "seq": seqs}
+
+@socketio.on('send_batch')
+@instrumented("send_batch")
+@limit_event("send_batch")
+@limit_event("send", cost=lambda sender, messages, room_id: batch_cost(messages))
+def handle_send_batch(sender, messages, room_id):
+    return store_batch(sender, room_id, messages, lambda contents: db.insert_messages(room_id, sender, contents))
+
 # join room event handler
 # sent when the user joins a room
+# last_seq is the newest message a reconnecting client still holds,
+# it is then sent only what it missed instead of the whole history
 @socketio.on("join")
-def join(sender_name, receiver_name):
+@instrumented("join")
+@limit_event("join")
+def join(sender_name, receiver_name, last_seq=None):
     receiver = db.get_user(receiver_name)
     if receiver is None:
         return "Unknown receiver!"
@@ -96,47 +377,51 @@ def join(sender_name, receiver_name):
     if room_id_current is not None:
         room.join_room(sender_name, room_id_current)
         join_room(room_id_current)
-        emit("incoming", {"sender": "system", "message": f"{sender_name} has connected", "color": "green"}, to=room_id_current, include_self=False)
+        outbound.emit("incoming", {"sender": "system", "message": f"{sender_name} has connected", "color": "green"}, room_id_current,
+                      kind=SYSTEM, skip_sid=request.sid)
         emit("incoming", {"sender": "system", "message": f"{sender_name} has connected", "color": "green"})
+        if last_seq is not None:
+            send_history("incoming_messages_list",
+                         lambda after_seq, limit: message_cache.get_since(
+                             room_id_current, after_seq, limit, lambda *args: db.get_messages_since(room_id_current, *args)),
+                         lambda: message_cache.get_latest(
+                             room_id_current, HISTORY_PAGE_SIZE, lambda limit: db.get_messages_by_room_id(room_id_current, limit)),
+                         last_seq)
         return room_id_current
 
     room_id_current = room.create_room(sender_name, receiver_name)
     join_room(room_id_current)
-    emit("incoming", {"sender": "system", "message": f"{sender_name} has connected", "color": "green"}, to=room_id_current)
+    outbound.emit("incoming", {"sender": "system", "message": f"{sender_name} has connected", "color": "green"}, room_id_current, kind=SYSTEM)
     return room_id_current
 
 
 @socketio.on("GetHistoryMessages")
+@instrumented("GetHistoryMessages")
+@limit_event("GetHistoryMessages")
 def GetHisoryMessages(sender_name, receiver_name):
     room_id_stored = db.find_room_id_by_users(sender_name, receiver_name)
     if room_id_stored:
-        messages_list = db.get_messages_by_room_id(room_id_stored)
-        emit("incoming_messages_list", {"messages": [{"sender": msg.sender, "content": msg.content} for msg in messages_list]}, to=request.sid)
-        print(messages_list)
+        messages_list = message_cache.get_latest(
+            room_id_stored, HISTORY_PAGE_SIZE, lambda limit: db.get_messages_by_room_id(room_id_stored, limit))
+        emit("incoming_messages_list", history_data(messages_list, True), to=request.sid)
 
 # leave room event handler
 @socketio.on("leave")
+@instrumented("leave")
 def leave(username, room_id):
-    emit("incoming", {"sender": "system", "message": f"{username} has connected", "color": "green"}, to=room_id)
+    outbound.emit("incoming", {"sender": "system", "message": f"{username} has connected", "color": "green"}, room_id, kind=SYSTEM)
     leave_room(room_id)
-    room.leave_room(username)
-
+    room.leave_room(username, room_id)
 
-@socketio.on('friend_request_sent')
-def handle_friend_request_sent(data):
-    print("Friend request sent from:", data['sender'], "to:", data['receiver'])
-    # Here you can broadcast to specific rooms or globally as needed
-    print("Emitting friend_request_update event")
-    emit('friend_request_update', {'message': 'Update your friend requests list'})
-    print("done")
 
 ##############################################################################
 # group chat
 ##############################################################################
 
 @socketio.on("send_group_message")
+@instrumented("send_group_message")
+@limit_event("send_group_message")
 def handle_group_message(data):
-    print("send group message")
     group_id = data.get('group_id')
     sender = data.get('sender')
     message = data.get('message')
@@ -145,26 +430,49 @@ def handle_group_message(data):
     if not db.is_user_in_group(sender, group_id):
         emit("error", {"error": "You are not a member of this group."}, room=request.sid)
         return
-    db.insert_group_message(group_id, sender, message)
-    print(message)
+    message_id, seq = db.insert_group_message(group_id, sender, message) or (None, None)
 
-    room_id = group_id + 10000  
-    emit("incoming_group_message", {"sender": sender, "message": message}, room=room_id)
+    room_id = group_id + GROUP_ROOM_OFFSET  
+    if message_id is not None:
+        read_cursors.mark_read(sender, room_id, message_id)
+        message_cache.append(room_id, CachedMessage(message_id, seq, sender, message))
+    outbound.emit("incoming_group_message", {"sender": sender, "message": message, "id": message_id, "seq": seq}, room_id, kind=MESSAGE)
 
 
+# like send_batch, for a group
+@socketio.on("send_group_batch")
+@instrumented("send_group_batch")
+@limit_event("send_group_batch")
+@limit_event("send_group_message", cost=lambda data: batch_cost(data.get("messages")))
+def handle_group_batch(data):
+    group_id = data.get('group_id')
+    sender = data.get('sender')
+
+    if not db.is_user_in_group(sender, group_id):
+        return {"error": "You are not a member of this group."}
+    return store_batch(sender, group_id + GROUP_ROOM_OFFSET, data.get('messages'),
+                       lambda contents: db.insert_group_messages(group_id, sender, contents))
+
+
+# only the member who opened the group needs its history, and only the latest page of it
 @socketio.on("GetGroupHistoryMessages")
+@instrumented("GetGroupHistoryMessages")
+@limit_event("GetGroupHistoryMessages")
 def get_group_history_messages(data):
     group_id = data.get('group_id')
-    messages = db.get_group_messages(group_id)
-    room_id = group_id + 10000  
-    messages_data = [{"sender": msg.sender, "content": msg.content} for msg in messages]
-    emit("incoming_group_messages_list", {"messages": messages_data}, room=room_id)
+    messages = message_cache.get_latest(
+        group_id + GROUP_ROOM_OFFSET, HISTORY_PAGE_SIZE, lambda limit: db.get_group_messages(group_id, limit))
+    emit("incoming_group_messages_list", history_data(messages, True), to=request.sid)
 
 
+# like join, a reconnecting client passes the last_seq it holds
 @socketio.on("join_group")
+@instrumented("join_group")
+@limit_event("join_group")
 def join_group(data):
     group_id = data.get('group_id')
     username = data.get('username')
+    last_seq = data.get('last_seq')
 
     user = db.get_user(username)
     if user is None:
@@ -179,11 +487,19 @@ def join_group(data):
         emit("error", {"error": "You are not a member of this group."}, room=request.sid)
         return
 
-    room_id = group_id + 10000
+    room_id = group_id + GROUP_ROOM_OFFSET
     join_room(room_id)
-
-    emit("clear_messages", room=room_id)
-    messages = db.get_group_messages(group_id)
+    room.join_room(username, room_id)
+
+    if last_seq is None:
+        emit("clear_messages", to=request.sid)
+    else:
+        send_history("incoming_group_messages_list",
+                     lambda after_seq, limit: message_cache.get_since(
+                         room_id, after_seq, limit, lambda *args: db.get_group_messages_since(group_id, *args)),
+                     lambda: message_cache.get_latest(
+                         room_id, HISTORY_PAGE_SIZE, lambda limit: db.get_group_messages(group_id, limit)),
+                     last_seq)
     return {"group_id": group_id, "message": f"{username} has joined the room."}
 
 
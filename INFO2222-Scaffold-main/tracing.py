@@ -0,0 +1,261 @@
+'''
+tracing
+lightweight spans around Flask requests, socket events, db functions and SQL statements
+finished traces are kept in an in-memory ring (shown on /admin/traces) and, when
+TRACE_FILE is set, appended to that file as OpenTelemetry (OTLP) JSON, one trace per line
+'''
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Deque, List, Optional
+import inspect
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import event
+
+import json_codec
+
+logger = logging.getLogger(__name__)
+
+# how many finished traces the admin page can choose from
+TRACE_RING_SIZE = 200
+# spans past this many in one trace are counted but not kept
+MAX_SPANS_PER_TRACE = 500
+# longest SQL statement kept as a span attribute
+MAX_STATEMENT_LENGTH = 200
+SERVICE_NAME = "chat"
+
+
+class Span():
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace, name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes
+        self.error = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+
+class Trace():
+    def __init__(self):
+        # ids only have to be unique, not unguessable
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self.lock:
+            if len(self.spans) < MAX_SPANS_PER_TRACE:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+# finished traces, newest last
+recent_traces: Deque[Trace] = deque(maxlen=TRACE_RING_SIZE)
+
+
+def start_span(name: str, **attributes):
+    parent = current_span.get()
+    trace = parent.trace if parent is not None else Trace()
+    span = Span(trace, name, parent.span_id if parent is not None else None, attributes)
+    trace.add(span)
+    return span, current_span.set(span)
+
+def end_span(span: Span, token, error: Optional[BaseException] = None):
+    span.end_ns = time.time_ns()
+    if error is not None:
+        span.error = f"{type(error).__name__}: {error}"
+    current_span.reset(token)
+    if span.parent_id is None:
+        recent_traces.append(span.trace)
+        if exporter is not None:
+            exporter.export(span.trace)
+
+@contextmanager
+def span(name: str, **attributes):
+    current, token = start_span(name, **attributes)
+    try:
+        yield current
+    except BaseException as e:
+        end_span(current, token, e)
+        raise
+    else:
+        end_span(current, token)
+
+
+# wraps a function in a span, with root=False it is only traced when called inside another span
+def traced(name: str, root: bool = True):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not root and current_span.get() is None:
+                return f(*args, **kwargs)
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+##############################################################################
+# OTLP JSON export
+##############################################################################
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_span(span: Span) -> dict:
+    data = {
+        "traceId": span.trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        # 2 is SERVER for the root, 1 is INTERNAL
+        "kind": 2 if span.parent_id is None else 1,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns or span.start_ns),
+        "attributes": [{"key": key, "value": otlp_value(value)} for key, value in span.attributes.items()],
+        # 1 is OK, 2 is ERROR
+        "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+    }
+    if span.parent_id is not None:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+def otlp_trace(trace: Trace) -> dict:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": [otlp_span(span) for span in trace.spans]}]
+    }]}
+
+
+# appends traces to a file from a background thread, so requests never wait on the disk
+class FileExporter():
+    def __init__(self, path: str):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def export(self, trace: Trace):
+        self.queue.put(trace)
+
+    def write_loop(self):
+        while True:
+            trace = self.queue.get()
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json_codec.dumps(otlp_trace(trace)) + "\n")
+            except Exception:
+                logger.exception("failed to export trace", extra={"path": self.path})
+
+
+exporter = FileExporter(os.environ["TRACE_FILE"]) if os.environ.get("TRACE_FILE") else None
+
+
+##############################################################################
+# automatic spans
+##############################################################################
+
+# one root span per request
+def instrument_app(app):
+    @app.before_request
+    def start_request_span():
+        g.trace_span, g.trace_token = start_span(
+            f"{request.method} {request.endpoint or request.path}", **{"http.method": request.method, "http.target": request.path})
+
+    @app.after_request
+    def record_status(response):
+        current = g.get("trace_span")
+        if current is not None:
+            current.attributes["http.status_code"] = response.status_code
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc):
+        current = g.pop("trace_span", None)
+        if current is not None:
+            end_span(current, g.pop("trace_token"), exc)
+
+
+# a child span for every SQL statement
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_span.get() is not None:
+            conn.info.setdefault("trace_spans", []).append(
+                start_span("db.query", **{"db.statement": " ".join(statement.split())[:MAX_STATEMENT_LENGTH]}))
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get("trace_spans"):
+            end_span(*conn.info["trace_spans"].pop())
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        spans = context.connection.info.get("trace_spans") if context.connection is not None else None
+        if spans:
+            end_span(*spans.pop(), context.original_exception)
+
+
+# wraps every function defined in a module (the db module) in a span named after it,
+# callers going through the module attribute and the module's own calls both see the wrapper
+# calls from background threads outside any request or event are left alone, and so are the names in skip
+def instrument_module(module, skip: tuple = ()):
+    for name, f in list(vars(module).items()):
+        if inspect.isfunction(f) and f.__module__ == module.__name__ and not name.startswith("_") and name not in skip:
+            setattr(module, name, traced(f"{module.__name__}.{name}", root=False)(f))
+
+
+# a root span per socket event
+def traced_event(name: str):
+    return traced(f"event {name}")
+
+
+# the slowest of the recent traces, for the admin page
+def slowest_traces(limit: int = 20) -> List[Trace]:
+    return sorted(list(recent_traces), key=lambda trace: trace.root.duration_ms, reverse=True)[:limit]
+
+
+# the spans of a trace as (depth, span) in tree order, for printing indented
+def span_tree(trace: Trace) -> list:
+    children = {}
+    for span in trace.spans:
+        children.setdefault(span.parent_id, []).append(span)
+    rows = []
+    stack = [(0, trace.root)]
+    while stack:
+        depth, span = stack.pop()
+        rows.append((depth, span))
+        stack.extend((depth + 1, child) for child in reversed(children.get(span.span_id, [])))
+    return rows